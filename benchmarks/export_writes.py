@@ -0,0 +1,103 @@
+"""
+Benchmark of the TFS writes of a beam's ``TWISS`` results (full and monitors-only files for the
+nominal, bare waist and matched waist configurations), comparing the deep-copying selection the
+outputs used to go through with the export views of `pyrws.utils`. Synthetic full-ring dataframes
+are used, so no MAD-X is needed.
+
+Run with:
+    python benchmarks/export_writes.py [--elements 12000] [--repeats 5]
+"""
+import argparse
+import tempfile
+import time
+import tracemalloc
+
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import tfs
+
+from pyrws.constants import EXPORT_TWISS_COLUMNS
+from pyrws.utils import get_export_views, get_monitors_mask
+
+CONFIGURATIONS = ("nominal", "bare_waist", "matched_waist")
+
+
+def make_twiss(elements: int, seed: int, betabeating: bool) -> tfs.TfsDataFrame:
+    """A full-ring like TWISS dataframe with ~60 columns and one monitor every 12 elements."""
+    rng = np.random.default_rng(seed)
+    names = pd.Index([f"ELEMENT.{i}" for i in range(elements)], name="NAME")
+    columns = [column for column in EXPORT_TWISS_COLUMNS if column not in ("NAME", "KEYWORD", "BBX", "BBY")]
+    columns += [f"EXTRA{i}" for i in range(60 - len(columns))]  # columns which are not exported
+    dataframe = tfs.TfsDataFrame(rng.random((elements, len(columns))), index=names, columns=columns)
+    dataframe["KEYWORD"] = np.where(np.arange(elements) % 12 == 0, "monitor", "drift")
+    if betabeating:
+        dataframe["BBX"], dataframe["BBY"] = rng.random(elements), rng.random(elements)
+    dataframe.headers = {"NAME": "TWISS", "Q1": 62.31, "Q2": 60.32}
+    return dataframe
+
+
+def legacy_writes(directory: Path, twiss: dict, write=tfs.write) -> None:
+    """The writes as done before, deep-copying the dataframe for each selection."""
+
+    def only_export_columns(dataframe):
+        df = dataframe.reset_index().copy(deep=True)
+        return df[[val for val in df.columns if val in EXPORT_TWISS_COLUMNS]]
+
+    def only_monitors(dataframe):
+        df = dataframe.copy(deep=True)
+        return df[df.KEYWORD == "monitor"]
+
+    for name, dataframe in twiss.items():
+        write(directory / f"{name}.tfs", only_export_columns(dataframe))
+        write(directory / f"{name}_monitors.tfs", only_monitors(only_export_columns(dataframe)))
+
+
+def views_writes(directory: Path, twiss: dict, write=tfs.write) -> None:
+    """The writes as done by `~pyrws.utils.write_beam_outputs`."""
+    monitors = get_monitors_mask(twiss["nominal"])
+    for name, dataframe in twiss.items():
+        full, monitors_only = get_export_views(dataframe, monitors)
+        write(directory / f"{name}.tfs", full)
+        write(directory / f"{name}_monitors.tfs", monitors_only)
+
+
+def skip_write(file_path: Path, dataframe: pd.DataFrame) -> None:
+    """Stand-in for `tfs.write` to measure the selections alone."""
+
+
+def measure(function, directory: Path, twiss: dict, repeats: int, write=tfs.write):
+    """Returns the best wall time over *repeats* and the peak memory allocated during one call."""
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function(directory, twiss, write=write)
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    function(directory, twiss, write=write)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(times), peak
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--elements", type=int, default=12_000, help="Number of elements of the synthetic TWISS.")
+    parser.add_argument("--repeats", type=int, default=5, help="Number of timed repetitions.")
+    args = parser.parse_args()
+
+    twiss = {name: make_twiss(args.elements, seed, betabeating=name != "nominal") for seed, name in enumerate(CONFIGURATIONS)}
+    with tempfile.TemporaryDirectory() as legacy_dir, tempfile.TemporaryDirectory() as views_dir:
+        results = {
+            "legacy": measure(legacy_writes, Path(legacy_dir), twiss, args.repeats),
+            "views": measure(views_writes, Path(views_dir), twiss, args.repeats),
+            "legacy (selections only)": measure(legacy_writes, Path(legacy_dir), twiss, args.repeats, write=skip_write),
+            "views (selections only)": measure(views_writes, Path(views_dir), twiss, args.repeats, write=skip_write),
+        }
+        identical = all((Path(legacy_dir) / file.name).read_bytes() == file.read_bytes() for file in Path(views_dir).iterdir())
+
+    print(f"Six TFS writes of {args.elements} elements, best of {args.repeats}:")
+    for name, (best, peak) in results.items():
+        print(f"  {name:<25} {best:7.3f} s   peak memory {peak / 1e6:8.1f} MB")
+    print(f"Identical files: {identical}")
@@ -0,0 +1,104 @@
+"""
+Benchmark of the fields query of the affected magnets done after the nominal and matched
+configurations, comparing `pyhdtoolkit.cpymadtools.lhc.get_magnets_powering` (selections and one
+more ``TWISS`` with deferred expression columns) with `pyrws.fields.get_magnets_powering`, which
+computes the same from the ``TWISS`` table of the configuration. The affected magnets of IP1 are
+placed in a synthetic FODO ring of about the size of the LHC sequence, and the remote procedure
+calls to ``MAD-X`` are counted along with the wall time of the queries.
+
+Run with:
+    python benchmarks/fields_query.py [--cells 1500] [--repeats 5]
+"""
+import argparse
+import time
+
+from contextlib import contextmanager
+
+import numpy as np
+
+from cpymad.madx import Madx
+
+from pyhdtoolkit.cpymadtools import lhc, twiss
+from pyrws.fields import FIELDS_COLUMNS, get_affected_elements, get_magnets_powering
+
+IP, BEAM = 1, 1
+
+
+def define_ring(madx: Madx, cells: int) -> None:
+    """Defines a FODO ring of *cells* cells with the affected magnets of IP1 in its middle cells, powered by knobs."""
+    madx.input(
+        "qf: quadrupole, l=3, k1:=kqf, kmax=250, calib=0.02; qd: quadrupole, l=3, k1:=kqd, kmax=250, calib=0.02;"
+        "mk: hkicker, l=0, kick:=kick, kmax=1e-3, calib=1e-4; ms: sextupole, l=0.4, k2:=ksf, kmax=5000, calib=1;"
+        "kqf = 0.0085; kqd = -0.0085; kick = 1e-6; ksf = 0.01;"
+    )
+    affected = [element.lower() for element in get_affected_elements(IP, BEAM)]
+    positions, elements = 0.0, []
+    for cell in range(cells):
+        elements += [f"qf.{cell}: qf, at={positions};", f"mk.{cell}: mk, at={positions + 4};"]
+        elements += [f"ms.{cell}: ms, at={positions + 6};", f"qd.{cell}: qd, at={positions + 25};"]
+        index = cell - cells // 2
+        if 0 <= index < len(affected):  # one affected magnet per cell in the middle of the ring
+            name = affected[index]
+            madx.input(f"k{index} = {1e-6 * (index + 1)}; {name}: quadrupole, l=1, k1:=k{index}, kmax=200, calib=0.05;")
+            elements.append(f"{name}, at={positions + 35};")
+        positions += 50
+    madx.input(f"lhcb1: sequence, l={positions}, refer=entry; {' '.join(elements)} endsequence;")
+    madx.command.beam(sequence="lhcb1", particle="proton", energy=6800)
+    madx.use(sequence="lhcb1")
+    madx.input("brho := 6800 * 1e9 / clight;")
+
+
+@contextmanager
+def count_rpc(madx: Madx, counter: list):
+    """Counts the round trips to the ``MAD-X`` process while in the context, appending them to *counter*."""
+    service = madx._service
+    communicate = service._communicate
+    calls = [0]
+
+    def counting(*args, **kwargs):
+        calls[0] += 1
+        return communicate(*args, **kwargs)
+
+    service._communicate = counting
+    try:
+        yield
+    finally:
+        service._communicate = communicate
+        counter.append(calls[0])
+
+
+def measure(madx: Madx, function, repeats: int):
+    """Returns the RPC round trips, best wall time and result of *function*."""
+    rpcs, times = [], []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        with count_rpc(madx, rpcs):
+            result = function()
+        times.append(time.perf_counter() - start)
+    return rpcs[0], min(times), result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cells", type=int, default=1500, help="Number of FODO cells in the ring.")
+    parser.add_argument("--repeats", type=int, default=5, help="Number of timed repetitions.")
+    args = parser.parse_args()
+
+    with Madx(stdout=False) as madx:
+        define_ring(madx, args.cells)
+        twiss_tfs = twiss.get_twiss_tfs(madx, chrom=True)  # as done at the end of each configuration
+        patterns = [element.lower() for element in get_affected_elements(IP, BEAM)]
+        results = {
+            "TWISS with selections": measure(madx, lambda: lhc.get_magnets_powering(madx, patterns=patterns), args.repeats),
+            "from TWISS table": measure(
+                madx, lambda: get_magnets_powering(madx, twiss_tfs, get_affected_elements(IP, BEAM)), args.repeats
+            ),
+        }
+
+    print(f"Fields query of {len(patterns)} magnets in a ring of {len(twiss_tfs)} elements, best of {args.repeats}:")
+    for name, (rpcs, best, _) in results.items():
+        print(f"  {name:<22} {rpcs:5d} RPC round trips {best:8.3f} s")
+    legacy, new = results["TWISS with selections"][2], results["from TWISS table"][2]
+    columns = [column for column in FIELDS_COLUMNS if column not in ("name", "keyword")]
+    identical = legacy.index.equals(new.index) and all(np.array_equal(legacy[column], new[column]) for column in columns)
+    print(f"Identical fields: {identical}")
@@ -0,0 +1,99 @@
+"""
+Benchmark of the loading of knob files, comparing the line-by-line `shlex` parsing the loaders used
+to do with the precompiled regular expressions of `pyrws.utils`. Synthetic knob files are written
+for both beams of all IPs, as many times as requested to mimic loading the outputs of a scan.
+
+Run with:
+    python benchmarks/knob_files.py [--knobs 400] [--runs 50] [--repeats 5]
+"""
+import argparse
+import shlex
+import tempfile
+import time
+
+from pathlib import Path
+
+import numpy as np
+
+from pyrws.utils import (
+    load_knobs_change_file,
+    load_knobs_file,
+    load_knobs_files,
+    write_knob_delta,
+    write_knob_powering,
+)
+
+IPS = (1, 2, 5, 8)
+
+
+def make_knobs(knobs: int, seed: int) -> dict:
+    """Knob names as found in the LHC optics, with random powerings of both signs."""
+    rng = np.random.default_rng(seed)
+    names = [f"kq{i + 4}.{side}{ip}b{beam}" for ip in IPS for beam in (1, 2) for side in "lr" for i in range(knobs // 16)]
+    names += [f"kqx.{side}{ip}" for ip in IPS for side in "lr"]
+    return dict(zip(names, rng.normal(scale=1e-3, size=len(names))))
+
+
+def legacy_load_knobs_file(filepath: Path) -> dict:
+    """The loading as done before, with one `shlex.split` per line."""
+    with filepath.open("r") as file:
+        return {shlex.split(line)[0]: float(shlex.split(line)[-1][:-1]) for line in file.readlines() if line.strip()}
+
+
+def legacy_load_knobs_change_file(filepath: Path) -> dict:
+    """The loading of changes as done before, with one `shlex.split` per line."""
+    result = {}
+    with filepath.open("r") as file:
+        for line in file.readlines():
+            if line.strip():
+                elements = shlex.split(line)
+                sign, delta = elements[-2:]
+                result[elements[0]] = float(sign + delta.strip(";"))
+    return result
+
+
+def measure(function, filepaths: list, repeats: int):
+    """Returns the best wall time over *repeats* and the loaded knobs."""
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function(filepaths)
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--knobs", type=int, default=400, help="Number of knobs per file.")
+    parser.add_argument("--runs", type=int, default=50, help="Number of runs (pairs of powering and changes files).")
+    parser.add_argument("--repeats", type=int, default=5, help="Number of timed repetitions.")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        powerings, changes = [], []
+        for run in range(args.runs):
+            nominal, matched = make_knobs(args.knobs, seed=2 * run), make_knobs(args.knobs, seed=2 * run + 1)
+            powerings.append(Path(directory) / f"powering_{run}.madx")
+            changes.append(Path(directory) / f"changes_{run}.madx")
+            write_knob_powering(powerings[-1], matched)
+            write_knob_delta(changes[-1], nominal, matched)
+
+        results = {
+            "legacy powering": measure(lambda paths: [legacy_load_knobs_file(path) for path in paths], powerings, args.repeats),
+            "regex powering": measure(lambda paths: [load_knobs_file(path) for path in paths], powerings, args.repeats),
+            "regex powering (bulk)": measure(lambda paths: list(load_knobs_files(paths).values()), powerings, args.repeats),
+            "legacy changes": measure(
+                lambda paths: [legacy_load_knobs_change_file(path) for path in paths], changes, args.repeats
+            ),
+            "regex changes": measure(lambda paths: [load_knobs_change_file(path) for path in paths], changes, args.repeats),
+            "regex changes (bulk)": measure(
+                lambda paths: list(load_knobs_files(paths, deltas=True).values()), changes, args.repeats
+            ),
+        }
+
+    print(f"Loading {args.runs} files of {len(make_knobs(args.knobs, 0))} knobs, best of {args.repeats}:")
+    for name, (best, _) in results.items():
+        print(f"  {name:<25} {best:7.3f} s")
+    identical = results["legacy powering"][1] == results["regex powering"][1] == results["regex powering (bulk)"][1]
+    identical &= results["legacy changes"][1] == results["regex changes"][1] == results["regex changes (bulk)"][1]
+    print(f"Identical knobs: {identical}")
@@ -0,0 +1,104 @@
+"""
+Benchmark of the knob queries done after each stage, comparing the access of `madx.globals` one name
+at a time the queries used to do with the bulk query of `pyrws.utils.get_globals_values`. The knobs
+of all IPs and both beams are defined in a bare ``MAD-X`` process, and the remote procedure calls to
+it are counted along with the wall time of the queries.
+
+Run with:
+    python benchmarks/madx_globals.py [--repeats 200]
+"""
+import argparse
+import time
+
+from contextlib import contextmanager
+
+import numpy as np
+
+from cpymad.madx import Madx
+
+from pyhdtoolkit.cpymadtools.lhc import get_lhc_tune_and_chroma_knobs
+from pyrws.constants import VARIED_IR_QUADRUPOLES
+from pyrws.utils import get_all_powering_knobs
+
+IPS = (1, 2, 5, 8)
+
+
+def legacy_get_all_powering_knobs(madx: Madx, ip: int, beam: int) -> tuple:
+    """The queries as done before, with one access to `madx.globals` per knob."""
+    triplets = {knob: madx.globals[knob] for knob in (f"kqx.r{ip}", f"kqx.l{ip}")}
+    quads = {}
+    for quad in VARIED_IR_QUADRUPOLES:
+        for side in ("r", "l"):
+            knob = f"kq{'t' if quad >= 11 else ''}{'l' if quad == 11 else ''}{quad}.{side}{ip}b{beam}"
+            quads[knob] = madx.globals[knob]
+    working_point = {knob: madx.globals[knob] for knob in get_lhc_tune_and_chroma_knobs("lhc", beam, True)}
+    return triplets, quads, working_point
+
+
+def new_get_all_powering_knobs(madx: Madx, ip: int, beam: int) -> tuple:
+    """The queries as done now, in a single bulk query of the globals."""
+    return get_all_powering_knobs(madx, quad_numbers=VARIED_IR_QUADRUPOLES, ip=ip, beam=beam)
+
+
+def define_knobs(madx: Madx, seed: int = 0) -> None:
+    """Defines all the queried knobs with random values, as would loading the LHC optics."""
+    rng = np.random.default_rng(seed)
+    for ip in IPS:
+        madx.globals[f"kqx.r{ip}"], madx.globals[f"kqx.l{ip}"] = rng.normal(scale=1e-2, size=2)
+        for beam in (1, 2):
+            for quad in VARIED_IR_QUADRUPOLES:
+                for side in ("r", "l"):
+                    knob = f"kq{'t' if quad >= 11 else ''}{'l' if quad == 11 else ''}{quad}.{side}{ip}b{beam}"
+                    madx.globals[knob] = rng.normal(scale=1e-2)
+    for beam in (1, 2):
+        for knob in get_lhc_tune_and_chroma_knobs("lhc", beam, True):
+            madx.globals[knob] = rng.normal(scale=1e-3)
+
+
+@contextmanager
+def count_rpc(madx: Madx, counter: list):
+    """Counts the round trips to the ``MAD-X`` process while in the context, appending them to *counter*."""
+    service = madx._service
+    communicate = service._communicate
+    calls = [0]
+
+    def counting(*args, **kwargs):
+        calls[0] += 1
+        return communicate(*args, **kwargs)
+
+    service._communicate = counting
+    try:
+        yield
+    finally:
+        service._communicate = communicate
+        counter.append(calls[0])
+
+
+def measure(madx: Madx, function, repeats: int):
+    """Returns the RPC round trips and best wall time of a query of all IPs and beams, and the queried knobs."""
+    rpcs, times = [], []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        with count_rpc(madx, rpcs):
+            result = {(ip, beam): function(madx, ip, beam) for ip in IPS for beam in (1, 2)}
+        times.append(time.perf_counter() - start)
+    return rpcs[0] // (2 * len(IPS)), min(times) / (2 * len(IPS)), result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeats", type=int, default=200, help="Number of timed repetitions.")
+    args = parser.parse_args()
+
+    with Madx(stdout=False) as madx:
+        define_knobs(madx)
+        results = {
+            "per-name globals": measure(madx, legacy_get_all_powering_knobs, args.repeats),
+            "bulk globals": measure(madx, new_get_all_powering_knobs, args.repeats),
+        }
+
+    print(f"Querying the knobs after a stage (triplets, quadrupoles and working point), best of {args.repeats}:")
+    for name, (rpcs, best, _) in results.items():
+        print(f"  {name:<20} {rpcs:4d} RPC round trips {1e3 * best:8.3f} ms")
+    identical = results["per-name globals"][2] == results["bulk globals"][2]
+    print(f"Identical knobs: {identical}")
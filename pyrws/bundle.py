@@ -0,0 +1,217 @@
+"""
+.. _bundle:
+
+Result Bundles
+--------------
+
+Module to write all the results of a run in a single binary file, as an alternative to parsing the
+text ``TFS`` outputs. The bundle is an uncompressed ``.npz`` archive with one array per table column,
+so that it can be read with `numpy.load`, but the loader provided here memory-maps the requested
+columns directly from the file instead and only reads what is accessed. Tables headers, knobs and
+run metadata are stored as ``JSON`` in the archive.
+"""
+import json
+import struct
+import zipfile
+
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+import tfs
+
+from loguru import logger
+
+from pyrws.utils import get_export_views, get_monitors_mask
+
+if TYPE_CHECKING:
+    from pyrws.core import BeamConfig
+
+_METADATA_KEY = "metadata"
+_LOCAL_HEADER = struct.Struct("<4s5H3I2H")  # fixed part of a zip local file header, before name and extra fields
+
+
+def get_beam_bundle_contents(
+    beam: int,
+    nominal: "BeamConfig",
+    bare_waist: "BeamConfig",
+    matched_waist: "BeamConfig",
+    nominal_fields: tfs.TfsDataFrame,
+    matched_fields: tfs.TfsDataFrame,
+) -> Tuple[Dict[str, pd.DataFrame], Dict[str, Dict[str, Dict[str, float]]]]:
+    """
+    Gathers the tables and knobs of the given *beam* to write in a bundle, named after the ``TFS``
+    and knob files written by `~pyrws.utils.write_beam_outputs`. The ``TWISS`` tables have the
+    same columns as their ``TFS`` files.
+
+    Args:
+        beam (int): the beam number, used in the names.
+        nominal (BeamConfig): the nominal configuration.
+        bare_waist (BeamConfig): the bare waist shift configuration.
+        matched_waist (BeamConfig): the improved (matched) waist shift configuration.
+        nominal_fields (tfs.TfsDataFrame): the affected magnets powering in the nominal configuration.
+        matched_fields (tfs.TfsDataFrame): the affected magnets powering in the matched configuration.
+
+    Returns:
+        A `tuple` of the tables as a `dict` (for instance ``nominal_b1`` or ``matched_waist_b1_fields``)
+        and the knobs as a `dict` of configuration name (for instance ``matched_waist_b1``) to knob groups
+        (``triplets``, ``quadrupoles`` and ``working_point``).
+    """
+    tables, knobs = {}, {}
+    monitors = get_monitors_mask(nominal.twiss_tfs)
+    for config_name, config in (("nominal", nominal), ("bare_waist", bare_waist), ("matched_waist", matched_waist)):
+        tables[f"{config_name}_b{beam:d}"], _ = get_export_views(config.twiss_tfs, monitors)
+        knobs[f"{config_name}_b{beam:d}"] = dict(
+            triplets=config.triplets_knobs, quadrupoles=config.quads_knobs, working_point=config.working_point_knobs
+        )
+    tables[f"nominal_b{beam:d}_fields"] = nominal_fields
+    tables[f"matched_waist_b{beam:d}_fields"] = matched_fields
+    return tables, knobs
+
+
+def write_result_bundle(
+    file_path: Path, tables: Dict[str, pd.DataFrame], knobs: Dict[str, Dict[str, Dict[str, float]]], **metadata
+) -> None:
+    """
+    Writes the provided *tables* and *knobs* to a single uncompressed ``.npz`` bundle at *file_path*. Each
+    column is stored as its own array (strings as fixed-width unicode), so that it can be memory-mapped.
+
+    Args:
+        file_path (Path): `~pathlib.Path` to the bundle file, typically ``results.npz``.
+        tables (Dict[str, pd.DataFrame]): the tables to store by name, as given by `~.get_beam_bundle_contents`.
+            Their headers and named index are kept.
+        knobs (Dict[str, Dict[str, Dict[str, float]]]): the knobs to store, as given by `~.get_beam_bundle_contents`.
+        **metadata: any keyword argument is stored in the bundle for information.
+    """
+    arrays, tables_info = {}, {}
+    for table_name, dataframe in tables.items():
+        index = dataframe.index.name
+        columns = ([index] if index is not None else []) + [str(column) for column in dataframe.columns]
+        for column in columns:
+            values = dataframe.index.to_numpy() if column == index else dataframe[column].to_numpy()
+            arrays[f"{table_name}/{column}"] = values.astype(str) if values.dtype == object else values
+        tables_info[table_name] = dict(
+            columns=columns,
+            index=index,
+            headers={key: _jsonable(value) for key, value in getattr(dataframe, "headers", {}).items()},
+        )
+    contents = dict(
+        tables=tables_info,
+        knobs=knobs,
+        metadata={name: str(value) for name, value in metadata.items()},
+    )
+    arrays[_METADATA_KEY] = np.array(json.dumps(contents))
+    logger.debug(f"Writing result bundle of {len(tables)} tables to '{file_path}'")
+    with Path(file_path).open("wb") as bundle_file:  # a file object, so numpy does not change the file name
+        np.savez(bundle_file, **arrays)
+
+
+class ResultBundle:
+    """
+    Lazy loader for a bundle written by `~.write_result_bundle`. Only the bundle's metadata is read when
+    instanciated, and the columns of tables are memory-mapped from the file when accessed.
+
+    Args:
+        file_path (Path): `~pathlib.Path` to the bundle file.
+
+    Example:
+        .. code-block:: python
+
+            >>> bundle = ResultBundle(outputdir / "results.npz")
+            >>> matched_b1 = bundle.load_table("matched_waist_b1", columns=["S", "BETX", "BBX"])
+            >>> bundle.knobs("matched_waist_b1")["quadrupoles"]
+    """
+
+    def __init__(self, file_path: Path):
+        self.file_path = Path(file_path)
+        self._offsets = _get_members_offsets(self.file_path)
+        with np.load(self.file_path) as archive:
+            self._contents: Dict[str, Any] = json.loads(str(archive[_METADATA_KEY]))
+
+    @property
+    def tables(self) -> List[str]:
+        """The names of the tables in the bundle."""
+        return list(self._contents["tables"])
+
+    @property
+    def metadata(self) -> Dict[str, str]:
+        """The run metadata stored in the bundle."""
+        return self._contents["metadata"]
+
+    def tables_for(self, beam: int) -> List[str]:
+        """Returns the names of the tables of the given *beam*."""
+        return [name for name in self.tables if f"_b{beam:d}" in name]
+
+    def columns(self, table: str) -> List[str]:
+        """Returns the columns of *table*, including its index."""
+        return self._contents["tables"][table]["columns"]
+
+    def headers(self, table: str) -> Dict[str, Any]:
+        """Returns the headers of *table*."""
+        return self._contents["tables"][table]["headers"]
+
+    def knobs(self, config: str) -> Dict[str, Dict[str, float]]:
+        """Returns the knob groups (``triplets``, ``quadrupoles`` and ``working_point``) of *config*, for instance ``nominal_b1``."""
+        return self._contents["knobs"][config]
+
+    def column(self, table: str, column: str) -> np.ndarray:
+        """Returns the values of *column* in *table*, as a read-only array memory-mapped from the bundle file."""
+        if column not in self.columns(table):
+            raise KeyError(f"No column '{column}' in table '{table}' of the bundle")
+        offset, dtype, shape, fortran_order = self._offsets[f"{table}/{column}.npy"]
+        if not np.prod(shape):  # empty arrays cannot be memory-mapped
+            return np.empty(shape, dtype=dtype)
+        return np.memmap(self.file_path, dtype=dtype, mode="r", offset=offset, shape=shape, order="F" if fortran_order else "C")
+
+    def load_table(self, table: str, columns: Optional[Sequence[str]] = None) -> tfs.TfsDataFrame:
+        """
+        Loads *table* from the bundle, with its headers and index.
+
+        Args:
+            table (str): the name of the table, for instance ``matched_waist_b1``.
+            columns (Sequence[str]): if provided, only these columns are read (in addition to the index).
+
+        Returns:
+            A `~tfs.TfsDataFrame` of the table. Numeric columns are backed by the memory-mapped file.
+        """
+        if table not in self._contents["tables"]:
+            raise KeyError(f"No table '{table}' in the bundle, available tables are {self.tables}")
+        index = self._contents["tables"][table]["index"]
+        columns = [column for column in (columns or self.columns(table)) if column != index]
+        return tfs.TfsDataFrame(
+            {column: self.column(table, column) for column in columns},
+            index=pd.Index(self.column(table, index), name=index) if index is not None else None,
+            headers=dict(self.headers(table)),
+            copy=False,  # keep the memory-mapped arrays
+        )
+
+
+# ----- Helpers ----- #
+
+
+def _get_members_offsets(file_path: Path) -> Dict[str, Tuple[int, np.dtype, Tuple[int, ...], bool]]:
+    """
+    Finds where the array data of each member of an uncompressed ``.npz`` archive starts in the file, with
+    its dtype, shape and order, so that it can be memory-mapped.
+    """
+    offsets = {}
+    with zipfile.ZipFile(file_path) as archive, Path(file_path).open("rb") as bundle_file:
+        for info in archive.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError(f"Member '{info.filename}' of '{file_path}' is compressed and cannot be memory-mapped")
+            bundle_file.seek(info.header_offset)
+            header = _LOCAL_HEADER.unpack(bundle_file.read(_LOCAL_HEADER.size))
+            bundle_file.seek(info.header_offset + _LOCAL_HEADER.size + header[-2] + header[-1])  # skip name and extra
+            version = np.lib.format.read_magic(bundle_file)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(bundle_file)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(bundle_file)
+            offsets[info.filename] = (bundle_file.tell(), dtype, shape, fortran_order)
+    return offsets
+
+
+def _jsonable(value: Any) -> Any:
+    """Converts numpy scalars from ``TFS`` headers to their Python equivalents, for ``JSON`` serialization."""
+    return value.item() if isinstance(value, np.generic) else value
@@ -0,0 +1,392 @@
+"""
+.. _cache:
+
+Results Caching
+---------------
+
+Module with persistent on-disk caches for the nominal configurations, which only depend on the
+sequence, optics, energy, beam, IP and working point, and for the response matrices of the waist
+shift constraints. Runs that only differ by their waist shift setting can then skip the nominal
+working point rematching and the response matrix computation entirely.
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import pandas as pd
+import tfs
+
+from loguru import logger
+
+from pyrws.core import BeamConfig
+from pyrws.version import VERSION
+
+
+class NominalConfigCache:
+    """
+    A directory of cached nominal configurations, with one sub-directory per entry named after the
+    content hash of the inputs. Each entry holds the twiss table and the magnets powering table as
+    ``.npz`` files with one array per column and their headers as ``JSON`` (which is lossless, as opposed
+    to a round-trip through ``TFS``, and never unpickles anything from the shared directory), and the
+    knobs as a ``JSON`` file alongside the inputs they were computed from. The globals of the split
+    tunes configuration the bare waist shift starts from (see `~pyrws.core.get_split_tunes_globals`) are
+    stored as ``JSON`` too, if provided.
+
+    .. note::
+        Entries are written to a temporary directory first and then moved in place, so that several
+        processes can safely share the same cache. When the total size of the cache goes above
+        *max_size*, the least recently used entries are evicted.
+
+    Args:
+        directory (Path): `~pathlib.Path` to the cache directory, created if needed.
+        max_size (float): the maximum total size of the cache, in [MB]. Defaults to 1000.
+    """
+
+    def __init__(self, directory: Path, max_size: float = 1000):
+        self.directory = Path(directory)
+        self.max_size = max_size
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def get_key(sequence: Path, opticsfile: Path, energy: float, beam: int, ip: int, qx: float, qy: float) -> str:
+        """
+        Returns the cache key for the provided inputs, as a hash of the *sequence* and *opticsfile*
+        contents, the other inputs and the package version.
+
+        .. important::
+            Only the contents of the provided files are hashed, not of the files they could call
+            themselves. Clear the cache if these change.
+        """
+        return _hash_inputs((sequence, opticsfile), energy=energy, beam=beam, ip=ip, qx=qx, qy=qy)
+
+    def __contains__(self, key: str) -> bool:
+        """Whether there is a cached entry for *key*, without loading it."""
+        return (self.directory / key / "twiss.npz").is_file()
+
+    def load(self, key: str) -> Optional[Tuple[BeamConfig, tfs.TfsDataFrame, Optional[Dict[str, Union[float, str]]]]]:
+        """
+        Loads the cached entry for *key*, if it exists.
+
+        Args:
+            key (str): the cache key, as given by `~.NominalConfigCache.get_key`.
+
+        Returns:
+            The cached `~pyrws.core.BeamConfig`, magnets powering `~tfs.TfsDataFrame` and split tunes
+            globals (`None` if they were not stored), or `None` if there is no entry for this *key*.
+        """
+        entry = self.directory / key
+        if not (entry / "twiss.npz").is_file():  # also skips entries in an older format
+            logger.debug(f"No cached nominal configuration for key '{key[:12]}'")
+            return None
+        logger.debug(f"Loading cached nominal configuration from '{entry}'")
+        knobs: Dict[str, Dict[str, float]] = json.loads((entry / "knobs.json").read_text())
+        config = BeamConfig(
+            twiss_tfs=_load_table(entry / "twiss.npz"),
+            triplets_knobs=knobs["triplets"],
+            quads_knobs=knobs["quadrupoles"],
+            working_point_knobs=knobs["working_point"],
+        )
+        fields = _load_table(entry / "fields.npz")
+        split_tunes_file = entry / "split_tunes_globals.json"
+        split_tunes_globals = json.loads(split_tunes_file.read_text()) if split_tunes_file.is_file() else None
+        entry.touch()  # marks the entry as recently used for eviction
+        return config, fields, split_tunes_globals
+
+    def save(
+        self,
+        key: str,
+        config: BeamConfig,
+        fields: tfs.TfsDataFrame,
+        split_tunes_globals: Optional[Dict[str, Union[float, str]]] = None,
+        **metadata,
+    ) -> None:
+        """
+        Stores the provided nominal *config* and *fields* in the cache under *key*, then evicts the
+        least recently used entries if the cache went above its maximum size.
+
+        Args:
+            key (str): the cache key, as given by `~.NominalConfigCache.get_key`.
+            config (BeamConfig): the nominal `~pyrws.core.BeamConfig` to store.
+            fields (tfs.TfsDataFrame): the magnets powering table of the nominal configuration.
+            split_tunes_globals (Dict[str, Union[float, str]]): if provided, the globals of the split tunes
+                configuration, as given by `~pyrws.core.get_split_tunes_globals`.
+            **metadata: any keyword argument is stored in the ``JSON`` file for information.
+        """
+        entry = self.directory / key
+        if entry.is_dir():
+            return
+        logger.debug(f"Caching nominal configuration to '{entry}'")
+        tmpdir = Path(tempfile.mkdtemp(dir=self.directory, prefix=".tmp_"))
+        _save_table(tmpdir / "twiss.npz", config.twiss_tfs)
+        _save_table(tmpdir / "fields.npz", fields)
+        knobs = dict(
+            triplets=config.triplets_knobs,
+            quadrupoles=config.quads_knobs,
+            working_point=config.working_point_knobs,
+            metadata={name: str(value) for name, value in metadata.items()},
+        )
+        (tmpdir / "knobs.json").write_text(json.dumps(knobs, indent=2))
+        if split_tunes_globals is not None:
+            (tmpdir / "split_tunes_globals.json").write_text(json.dumps(split_tunes_globals))
+        try:
+            tmpdir.rename(entry)
+        except OSError:  # another process stored this entry in the meantime
+            shutil.rmtree(tmpdir, ignore_errors=True)
+        self.evict()
+
+    def evict(self) -> None:
+        """
+        Removes the least recently used entries until the cache is below its maximum size. The most
+        recently used entry is always kept.
+        """
+        entries = sorted(self._entries(), key=lambda path: path.stat().st_mtime)
+        sizes = {entry: sum(file.stat().st_size for file in entry.iterdir()) for entry in entries}
+        total = sum(sizes.values())
+        while len(entries) > 1 and total > self.max_size * 1e6:
+            oldest = entries.pop(0)
+            logger.debug(f"Evicting cache entry '{oldest.name}'")
+            shutil.rmtree(oldest, ignore_errors=True)
+            total -= sizes[oldest]
+
+    def invalidate(self, key: str) -> bool:
+        """
+        Removes the entry for *key* from the cache, if it exists.
+
+        Args:
+            key (str): the cache key, as given by `~.NominalConfigCache.get_key`.
+
+        Returns:
+            `True` if an entry was removed, `False` otherwise.
+        """
+        entry = self.directory / key
+        if not entry.is_dir():
+            return False
+        logger.debug(f"Invalidating cache entry '{key}'")
+        shutil.rmtree(entry, ignore_errors=True)
+        return True
+
+    def clear(self) -> None:
+        """Removes all entries from the cache."""
+        logger.debug(f"Clearing cache at '{self.directory}'")
+        for entry in self._entries():
+            shutil.rmtree(entry, ignore_errors=True)
+
+    def _entries(self) -> List[Path]:
+        """Returns the complete entries of the cache, ignoring the ones still being written."""
+        return [path for path in self.directory.iterdir() if path.is_dir() and not path.name.startswith(".")]
+
+
+class ResponseMatrixStore:
+    """
+    A directory of cached response matrices of the waist shift constraints to the independent IR
+    quadrupoles powering knobs, as computed by `~pyrws.response.get_response_matrix`. Each matrix
+    is stored in a ``[key].npz`` file named after the content hash of the inputs, together with the
+    observables and knobs names and the inputs it was computed from as ``JSON`` metadata.
+
+    .. note::
+        The matrices are small and are not subject to eviction. They can share a directory with a
+        `~.NominalConfigCache`, whose entries are sub-directories. Files are written under a temporary
+        name first and then moved in place, so that several processes can safely share the store.
+
+    Args:
+        directory (Path): `~pathlib.Path` to the store directory, created if needed.
+    """
+
+    def __init__(self, directory: Path):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def get_key(sequence: Path, opticsfile: Path, energy: float, beam: int, ip: int) -> str:
+        """
+        Returns the store key for the provided inputs, as a hash of the *sequence* and *opticsfile*
+        contents, the other inputs and the package version. The working point is not part of the key
+        as the trims of the tune and chroma knobs have a negligible impact on the response.
+
+        .. important::
+            Only the contents of the provided files are hashed, not of the files they could call
+            themselves. Invalidate the entries if these change.
+        """
+        return _hash_inputs((sequence, opticsfile), energy=energy, beam=beam, ip=ip, kind="response")
+
+    def __contains__(self, key: str) -> bool:
+        """Whether there is a stored response matrix for *key*, without loading it."""
+        return (self.directory / f"{key}.npz").is_file()
+
+    def load(self, key: str) -> Optional[pd.DataFrame]:
+        """
+        Loads the stored response matrix for *key*, if it exists.
+
+        Args:
+            key (str): the store key, as given by `~.ResponseMatrixStore.get_key`.
+
+        Returns:
+            The response matrix as a `~pandas.DataFrame`, or `None` if there is none for this *key*.
+        """
+        filepath = self.directory / f"{key}.npz"
+        if not filepath.is_file():
+            logger.debug(f"No stored response matrix for key '{key[:12]}'")
+            return None
+        logger.debug(f"Loading stored response matrix from '{filepath}'")
+        with np.load(filepath) as data:
+            index = pd.MultiIndex.from_arrays([data["elements"], data["columns"]], names=["ELEMENT", "COLUMN"])
+            return pd.DataFrame(data["matrix"], index=index, columns=data["knobs"].tolist())
+
+    def metadata(self, key: str) -> Optional[Dict[str, str]]:
+        """
+        Returns the metadata stored alongside the response matrix for *key*, if it exists.
+
+        Args:
+            key (str): the store key, as given by `~.ResponseMatrixStore.get_key`.
+
+        Returns:
+            A `dict` of the metadata, or `None` if there is no response matrix for this *key*.
+        """
+        filepath = self.directory / f"{key}.npz"
+        if not filepath.is_file():
+            return None
+        with np.load(filepath) as data:
+            return json.loads(str(data["metadata"]))
+
+    def save(self, key: str, response: pd.DataFrame, **metadata) -> None:
+        """
+        Stores the provided *response* matrix under *key*, replacing any existing one.
+
+        Args:
+            key (str): the store key, as given by `~.ResponseMatrixStore.get_key`.
+            response (pd.DataFrame): the response matrix, as given by `~pyrws.response.get_response_matrix`.
+            **metadata: any keyword argument is stored in the ``JSON`` metadata for information.
+        """
+        filepath = self.directory / f"{key}.npz"
+        logger.debug(f"Storing response matrix to '{filepath}'")
+        with tempfile.NamedTemporaryFile(dir=self.directory, prefix=".tmp_", suffix=".npz", delete=False) as tmpfile:
+            np.savez(
+                tmpfile,
+                matrix=response.to_numpy(dtype=float),
+                elements=response.index.get_level_values("ELEMENT").to_numpy(dtype=str),
+                columns=response.index.get_level_values("COLUMN").to_numpy(dtype=str),
+                knobs=response.columns.to_numpy(dtype=str),
+                metadata=json.dumps({name: str(value) for name, value in metadata.items()}),
+            )
+        os.replace(tmpfile.name, filepath)
+
+    def invalidate(self, key: str) -> bool:
+        """
+        Removes the response matrix for *key* from the store, if it exists.
+
+        Args:
+            key (str): the store key, as given by `~.ResponseMatrixStore.get_key`.
+
+        Returns:
+            `True` if a response matrix was removed, `False` otherwise.
+        """
+        filepath = self.directory / f"{key}.npz"
+        if not filepath.is_file():
+            return False
+        logger.debug(f"Invalidating stored response matrix '{key}'")
+        filepath.unlink(missing_ok=True)
+        return True
+
+    def clear(self) -> None:
+        """Removes all response matrices from the store."""
+        logger.debug(f"Clearing response matrices at '{self.directory}'")
+        for filepath in self.directory.glob("[!.]*.npz"):
+            filepath.unlink(missing_ok=True)
+
+
+def invalidate_entries(
+    cache: NominalConfigCache,
+    responses: ResponseMatrixStore,
+    sequence: Path,
+    opticsfile: Path,
+    energy: float,
+    ip: int,
+    qx: float,
+    qy: float,
+) -> int:
+    """
+    Invalidates the nominal configurations and response matrices of both beams for the provided
+    inputs, for instance to force their recomputation after a change in a file called by the
+    *sequence* or *opticsfile*.
+
+    Args:
+        cache (NominalConfigCache): the cache of nominal configurations.
+        responses (ResponseMatrixStore): the store of response matrices.
+        sequence (Path): `~pathlib.Path` to the LHC sequence file.
+        opticsfile (Path): `~pathlib.Path` to the LHC optics file.
+        energy (float): beam energy for the setup, in [GeV].
+        ip (int): the IP of the waist shift.
+        qx (float): the horizontal tune of the nominal configuration.
+        qy (float): the vertical tune of the nominal configuration.
+
+    Returns:
+        The number of removed entries.
+    """
+    removed = 0
+    for beam in (1, 2):
+        removed += cache.invalidate(cache.get_key(sequence, opticsfile, energy=energy, beam=beam, ip=ip, qx=qx, qy=qy))
+        removed += responses.invalidate(responses.get_key(sequence, opticsfile, energy=energy, beam=beam, ip=ip))
+    logger.info(f"Invalidated {removed} cache entries for IP{ip:d}")
+    return removed
+
+
+# ----- Helpers ----- #
+
+
+def _hash_inputs(files: Sequence[Path], **parameters: Any) -> str:
+    """Returns the hash of the contents of the provided *files*, the *parameters* and the package version."""
+    digest = hashlib.sha256()
+    for filepath in files:
+        digest.update(Path(filepath).read_bytes())
+    digest.update(json.dumps(dict(parameters, version=VERSION), sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+def _save_table(file_path: Path, dataframe: pd.DataFrame) -> None:
+    """
+    Writes *dataframe* to an ``.npz`` file at *file_path*, with its index and each column as their own
+    array (strings as fixed-width unicode) and the names, dtypes and headers as ``JSON`` metadata.
+    """
+    arrays = {"index": _to_storable(dataframe.index.to_numpy())}
+    for position, column in enumerate(dataframe.columns):
+        arrays[f"column_{position:d}"] = _to_storable(dataframe[column].to_numpy())
+    metadata = dict(
+        columns=[str(column) for column in dataframe.columns],
+        dtypes=[str(dtype) for dtype in dataframe.dtypes],
+        index=dataframe.index.name,
+        index_dtype=str(dataframe.index.dtype),
+        headers={key: _jsonable(value) for key, value in getattr(dataframe, "headers", {}).items()},
+    )
+    arrays["metadata"] = np.array(json.dumps(metadata))
+    with Path(file_path).open("wb") as table_file:  # a file object, so numpy does not change the file name
+        np.savez(table_file, **arrays)
+
+
+def _load_table(file_path: Path) -> tfs.TfsDataFrame:
+    """Reads a table written by `~._save_table`, with its dtypes, index and headers. Pickles are never allowed."""
+    with np.load(file_path, allow_pickle=False) as data:
+        metadata = json.loads(str(data["metadata"]))
+        index = pd.Index(data["index"], name=metadata["index"]).astype(metadata["index_dtype"])
+        columns = {
+            column: pd.Series(data[f"column_{position:d}"], index=index).astype(dtype)
+            for position, (column, dtype) in enumerate(zip(metadata["columns"], metadata["dtypes"]))
+        }
+    dataframe = tfs.TfsDataFrame(columns, index=index)
+    dataframe.headers = metadata["headers"]
+    return dataframe
+
+
+def _to_storable(values: np.ndarray) -> np.ndarray:
+    """Converts object arrays (strings) to fixed-width unicode, which can be loaded without pickles."""
+    return values.astype(str) if values.dtype == object else values
+
+
+def _jsonable(value: Any) -> Any:
+    """Converts numpy scalars from ``TFS`` headers to their Python equivalents, for ``JSON`` serialization."""
+    return value.item() if isinstance(value, np.generic) else value
@@ -53,3 +53,36 @@ def style_fields_changes(nominal_fields_dataframe: pd.DataFrame, matched_fields_
     .highlight_between(left=5, right=100, axis=1, props="color:white; background:red;") \
     .set_caption("Change in Powering of Affected Magnets [% of max powering]")
     # fmt: on
+
+
+# ----- Feasibility Checks ----- #
+
+
+def get_powering_violations(dataframe: pd.DataFrame, max_percent: float) -> pd.Series:
+    """
+    Returns the powering of the magnets in the provided fields *dataframe* which exceed the given
+    threshold, in percent of their maximum powering, from the highest to the lowest. An empty result
+    means the configuration is feasible.
+
+    .. important::
+        The provided *dataframe* should hold the ``percent`` column, as the fields tables of this
+        package do (see `~pyrws.fields.get_magnets_powering`).
+
+    Args:
+        dataframe (pd.DataFrame): the fields dataframe, indexed by magnet name.
+        max_percent (float): the highest accepted powering, in percent of the maximum powering.
+
+    Returns:
+        A `~pandas.Series` of the powering percentages of the offending magnets, indexed by name.
+    """
+    percent = dataframe["percent"]
+    return percent[percent > max_percent].sort_values(ascending=False)
+
+
+def format_powering_violations(violations: pd.Series, max_percent: float) -> str:
+    """
+    Returns a human-readable description of the provided powering *violations*, as given by
+    `~.get_powering_violations`, to record why a configuration was deemed infeasible.
+    """
+    magnets = ", ".join(f"{name.upper()} at {percent:.1f}%" for name, percent in violations.items())
+    return f"{len(violations)} affected magnet(s) above {max_percent:g}% of their maximum powering: {magnets}"
@@ -3,46 +3,37 @@
 
 Main command line script.
 """
+import multiprocessing
+import os
+
+from concurrent.futures import Future, ProcessPoolExecutor
+from contextlib import nullcontext
 from pathlib import Path
-from typing import Optional, Tuple
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 import matplotlib
+import pandas as pd
 import rich_click as click
 import tfs
 
-from cpymad.madx import Madx
 from loguru import logger
 from matplotlib import pyplot as plt
 from rich.traceback import install as install_traceback
 
-from pyhdtoolkit.cpymadtools import lhc
 from pyhdtoolkit.utils.contexts import timeit
 from pyhdtoolkit.utils.logging import config_logger
-from pyrws.constants import AFFECTED_ELEMENTS
-from pyrws.core import (
-    get_bare_waist_shift_beam1_config,
-    get_bare_waist_shift_beam2_config,
-    get_matched_waist_shift_config,
-    get_nominal_beam_config,
-    get_waist_shift_config_from_applied_existing_knobs,
-)
-from pyrws.plotting import (
-    plot_betas_comparison,
-    plot_betas_deviation,
-    plot_phase_advances_comparison,
-    plot_phase_differences,
-    plot_waist_shift_betabeatings,
-    plot_waist_shift_betabeatings_comparison,
-)
+from pyrws import profiling
+from pyrws.bundle import get_beam_bundle_contents, write_result_bundle
+from pyrws.cache import NominalConfigCache, ResponseMatrixStore, invalidate_entries
+from pyrws.pipeline import NominalResult, WaistShiftResult, get_knobs_stages, run_stages
+from pyrws.plan import FINAL_SECTIONS, load_recorded_durations, plan_stages, print_plan
+from pyrws.plotting import FIGURES, PLOT_MODES, PLOTTED_COLUMNS, create_figure
 from pyrws.utils import (
-    add_betabeating_columns,
-    fullpath,
-    only_export_columns,
-    only_monitors,
+    OutputsWriter,
+    get_ip_directory,
     prepare_output_directories,
-    write_knob_changeparameters,
-    write_knob_delta,
-    write_knob_powering,
+    write_beam_outputs,
+    write_infeasibility_record,
 )
 
 install_traceback(width=130, suppress=[click])  # Rich handling of uncaught exceptions for the tracebacks
@@ -65,10 +56,13 @@ install_traceback(width=130, suppress=[click])  # Rich handling of uncaught exce
 @click.option(
     "--ip",
     type=click.IntRange(min=1, max=8),
-    default=1,
+    multiple=True,
+    default=(1,),
     show_default=True,
     required=True,
-    help="Which IP to prepare the waist shift knob for. Should be 1, 2, 5 or 8.",
+    help="Which IP to prepare the waist shift knob for. Should be 1, 2, 5 or 8. Can be given several times, in which "
+    "case the nominal configurations are determined only once for all IPs, the waist shift stages of the different IPs "
+    "are independent (and run concurrently with --parallel) and the outputs of each IP are in an 'IP[n]' sub-directory.",
 )
 @click.option(
     "--waist_shift_setting",
@@ -93,6 +87,15 @@ install_traceback(width=130, suppress=[click])  # Rich handling of uncaught exce
     "knobs will then be retrieved from their expected location in this directory and used for this run, instead of "
     "attempting a rematching of the waist shift knob (which can sometimes fail at very low betastar configurations).",
 )
+@click.option(
+    "--warm_start_from",
+    type=click.Path(exists=True, dir_okay=True, file_okay=False, resolve_path=True, path_type=Path),
+    default=None,
+    show_default=True,
+    help="If provided, should point to the output directory of a previous run of this script, typically for a close "
+    "waist shift setting. The improved waist shift matching will then start from the quadrupole knobs of this run "
+    "instead of the bare waist shift powering, which usually converges in fewer MAD-X calls for close settings.",
+)
 @click.option("--energy", type=click.FloatRange(min=0), default=6800, show_default=True, help="Beam energy in [GeV]")
 @click.option(
     "--qx",
@@ -108,6 +111,97 @@ install_traceback(width=130, suppress=[click])  # Rich handling of uncaught exce
     show_default=True,
     help="The vertical tune to match to.",
 )
+@click.option(
+    "--engine",
+    type=click.Choice(["match", "response"]),
+    default="match",
+    show_default=True,
+    help="How to improve the waist shift. With 'match' a full MAD-X matching is done, while with 'response' the "
+    "quadrupole knobs are solved for from a response matrix computed once in the nominal configuration, with a single "
+    "TWISS per iteration. The full matching is still done if the residual stays above --max_residual.",
+)
+@click.option(
+    "--max_residual",
+    type=click.FloatRange(min=0),
+    default=1e-4,
+    show_default=True,
+    help="Highest accepted residual (MAD-X penalty function value) for the 'response' engine.",
+)
+@click.option(
+    "--ir_segment",
+    type=click.BOOL,
+    default=False,
+    show_default=True,
+    help="Whether to do the improved waist shift matching on the IR segment only (from S.DS.L to E.DS.R of the IP), "
+    "with initial conditions from the bare waist shift TWISS, which makes each matching iteration much cheaper. A "
+    "single full ring TWISS is done afterwards to check the result.",
+)
+@click.option(
+    "--max_powering",
+    type=click.FloatRange(min=0),
+    default=None,
+    help="If provided, highest accepted powering of the affected magnets in the bare waist shift configuration, in "
+    "percent of their maximum powering. Beyond it the waist shift is deemed infeasible at this IP: the improved matching "
+    "and plots are skipped, the reason is written to an 'infeasible.json' file and the program exits with an error.",
+)
+@click.option(
+    "--parallel",
+    type=click.BOOL,
+    default=False,
+    show_default=True,
+    help="Whether to run the MAD-X stages concurrently in separate processes, following their dependencies. The "
+    "nominal configurations of both beams and the beam 1 waist shift are run at the same time, and the beam 2 waist "
+    "shift is started as soon as the beam 1 triplets powering is determined.",
+)
+@click.option(
+    "--reuse_session",
+    type=click.BOOL,
+    default=False,
+    show_default=True,
+    help="Whether to load the sequence and optics only once per beam, in a single MAD-X session reused for the nominal "
+    "and waist shift stages. Globals are restored before each stage, which also sets up the sequence and beams again, "
+    "while other MAD-X state (tables, variables created by previous stages) is shared. The MAD-X commands and outputs "
+    "are then logged to the 'session_b[12].madx' and 'session_b[12].out' files.",
+)
+@click.option(
+    "--cache_dir",
+    type=click.Path(exists=False, file_okay=False, resolve_path=True, path_type=Path),
+    default=None,
+    help="If provided, directory of a persistent cache for the nominal configurations and response matrices. These only "
+    "depend on the sequence, optics, energy, IP and tunes, and will be loaded from the cache instead of recomputed when "
+    "available.",
+)
+@click.option(
+    "--cache_size",
+    type=click.FloatRange(min=0),
+    default=1000,
+    show_default=True,
+    help="Maximum size of the nominal configurations cache, in [MB]. Least recently used entries are evicted beyond.",
+)
+@click.option(
+    "--refresh_cache",
+    type=click.BOOL,
+    default=False,
+    show_default=True,
+    help="Whether to invalidate the cache entries for the inputs of this run before running, to force their "
+    "recomputation. Useful if a file called by the sequence or optics file changed, as only their own contents are hashed.",
+)
+@click.option(
+    "--bundle",
+    type=click.BOOL,
+    default=False,
+    show_default=True,
+    help="Whether to also write all results (TWISS and fields tables, knobs) in a single binary 'results.npz' bundle in "
+    "the output directory, which is much faster to load than the TFS files. See the pyrws.bundle module.",
+)
+@click.option(
+    "--skip_plots",
+    type=click.BOOL,
+    default=False,
+    show_default=True,
+    help="Whether to skip the generation of plots entirely, for instance for headless runs. Otherwise, and unless they "
+    "are to be shown, plots are rendered and saved in background processes as soon as the results of each beam are ready.",
+)
 @click.option(
     "--show_plots",
     type=click.BOOL,
@@ -128,6 +222,38 @@ install_traceback(width=130, suppress=[click])  # Rich handling of uncaught exce
     "Will affect the visibility of the plots. "
     "Defaults to the standard matplotlib rcParams value.",
 )
+@click.option(
+    "--plot_mode",
+    type=click.Choice(PLOT_MODES),
+    default="full",
+    show_default=True,
+    help="How to draw the full-ring data in plots. With 'decimated', only the minimum and maximum values in each bin "
+    "along S are drawn, which keeps peaks visible. With 'rasterized', lines are embedded as images in the PDF files. Both "
+    "make for much lighter files, exact data being in the TFS outputs.",
+)
+@click.option(
+    "--plot_max_points",
+    type=click.IntRange(min=2),
+    help="Maximum number of points per line in 'decimated' plot mode, to trade details for file size and rendering time. "
+    "Defaults to two per horizontal pixel of the axes.",
+)
+@click.option(
+    "--plan",
+    type=click.BOOL,
+    default=False,
+    show_default=True,
+    help="Whether to only plan the run: the stages that would be executed are listed with their estimated durations from "
+    "the timings of previous runs, whether they would be served from the cache, and the critical path. MAD-X is not "
+    "started and no output is written.",
+)
+@click.option(
+    "--plan_from",
+    type=click.Path(exists=True, path_type=Path),
+    multiple=True,
+    help="Timings file of a previous run (or its output directory) to estimate durations from with --plan, ideally with "
+    "similar options. Can be given several times, the median durations are used. Defaults to the 'timings.json' file in "
+    "the output directory, if it exists.",
+)
 @click.option(
     "--loglevel",
     type=click.Choice(["trace", "debug", "info", "warning", "error", "critical"]),
@@ -138,16 +264,32 @@ install_traceback(width=130, suppress=[click])  # Rich handling of uncaught exce
 def create_knobs(
     sequence: Path,
     opticsfile: Path,
-    ip: int,
+    ip: Tuple[int, ...],
     waist_shift_setting: float,
     outputdir: Path,
     use_knobs_from: Path,
+    warm_start_from: Path,
     energy: Optional[float],
     qx: Optional[float],
     qy: Optional[float],
+    engine: Optional[str],
+    max_residual: Optional[float],
+    ir_segment: Optional[bool],
+    max_powering: Optional[float],
+    parallel: Optional[bool],
+    reuse_session: Optional[bool],
+    cache_dir: Optional[Path],
+    cache_size: Optional[float],
+    refresh_cache: Optional[bool],
+    bundle: Optional[bool],
+    skip_plots: Optional[bool],
     show_plots: Optional[bool],
     mplstyle: Optional[str],
     figsize: Optional[Tuple[int, int]],
+    plot_mode: Optional[str],
+    plot_max_points: Optional[int],
+    plan: Optional[bool],
+    plan_from: Tuple[Path, ...],
     loglevel: Optional[str],
 ):
     """
@@ -157,368 +299,309 @@ def create_knobs(
     """
     # ----- Configuration ----- #
     config_logger(level=loglevel)
-    b1_dirs, b2_dirs = prepare_output_directories(outputdir)
+    ips = tuple(dict.fromkeys(ip))  # without duplicates, in the given order
+    dirs: Dict[int, Tuple[Dict[str, Path], Dict[str, Path]]] = {}
+    if not plan:
+        dirs = {run_ip: prepare_output_directories(get_ip_directory(outputdir, run_ip, ips)) for run_ip in ips}
 
     if mplstyle:
         plt.style.use(mplstyle)
 
-    # ----- Beam 1 Nominal ----- #
-    logger.info("Preparing beam 1 nominal configuration")
-    nominal_b1_in = b1_dirs["main"] / "nominal_b1.madx"
-    nominal_b1_out = b1_dirs["main"] / "nominal_b1.out"
-    affected_b1_elements = [element.format(ip=ip, beam=1) for element in AFFECTED_ELEMENTS]
-    with nominal_b1_in.open("w") as commands, nominal_b1_out.open("w") as outputs:
-        with Madx(command_log=commands, stdout=outputs) as madxb1:
-            madxb1.option(echo=False, warn=False)
-            madxb1.call(fullpath(sequence))
-            lhc.make_lhc_beams(madxb1, energy=energy)  # needs to be defined here if we call acc-models opticsfiles
-            madxb1.call(fullpath(opticsfile))  # needs defined beams if we call acc-models opticsfiles
-
-            b1_nominal = get_nominal_beam_config(madxb1, energy=energy, beam=1, ip=ip, qx=qx, qy=qy)
-            nominal_b1_fields = lhc.get_magnets_powering(madxb1, patterns=affected_b1_elements)
-
-    # ----- Beam 1 Waist Shift ----- #
-    logger.info("Preparing beam 1 waist shift configuration")
-    waist_b1_in = b1_dirs["main"] / "waist_b1.madx"
-    waist_b1_out = b1_dirs["main"] / "waist_b1.out"
-    with waist_b1_in.open("w") as commands, waist_b1_out.open("w") as outputs:
-        with Madx(command_log=commands, stdout=outputs) as madxb1:
-            madxb1.option(echo=False, warn=False)
-            madxb1.call(fullpath(sequence))
-            lhc.make_lhc_beams(madxb1, energy=energy)  # needs to be defined here if we call acc-models opticsfiles
-            madxb1.call(fullpath(opticsfile))  # needs defined beams if we call acc-models opticsfiles
-
-            b1_bare_waist = get_bare_waist_shift_beam1_config(
-                madxb1, ip=ip, rigidty_waist_shift_value=waist_shift_setting, energy=energy, qx=qx, qy=qy
-            )
-            b1_bare_waist.twiss_tfs = add_betabeating_columns(b1_bare_waist.twiss_tfs, b1_nominal.twiss_tfs)
-
-            if use_knobs_from is not None:
-                logger.info("Using knobs from a provided previous run")
-                b1_matched_waist = get_waist_shift_config_from_applied_existing_knobs(
-                    madxb1, use_knobs_from=use_knobs_from, beam=1, ip=ip, qx=qx, qy=qy
-                )
+    if skip_plots and show_plots:
+        logger.warning("Plots are skipped, they will not be shown")
+        show_plots = False
+
+    cache, responses = None, None
+    if cache_dir is not None and not (plan and refresh_cache):  # when planning, refreshed entries count as not cached
+        cache, responses = NominalConfigCache(cache_dir, max_size=cache_size), ResponseMatrixStore(cache_dir)
+        if refresh_cache:
+            for run_ip in ips:
+                invalidate_entries(cache, responses, sequence, opticsfile, energy=energy, ip=run_ip, qx=qx, qy=qy)
+
+    # ----- Run MAD-X Stages ----- #
+    stages = get_knobs_stages(
+        workdirs={run_ip: tuple(get_ip_directory(outputdir, run_ip, ips) / f"BEAM{beam:d}" for beam in (1, 2)) for run_ip in ips},
+        sequence=sequence,
+        opticsfile=opticsfile,
+        energy=energy,
+        ips=ips,
+        qx=qx,
+        qy=qy,
+        waist_shift_setting=waist_shift_setting,
+        use_knobs_from=use_knobs_from,
+        warm_start_from=warm_start_from,
+        engine=engine,
+        max_residual=max_residual,
+        ir_segment=ir_segment,
+        max_powering=max_powering,
+        reuse_session=reuse_session,
+        cache=cache,
+        responses=responses,
+    )
 
-            else:
-                logger.info("Refining beam 1 waist shift - this may take a while...")
-                b1_matched_waist = get_matched_waist_shift_config(
-                    madxb1, beam=1, ip=ip, nominal_twiss=b1_nominal.twiss_tfs, bare_twiss=b1_bare_waist.twiss_tfs, qx=qx, qy=qy
-                )
-            b1_matched_waist.twiss_tfs = add_betabeating_columns(b1_matched_waist.twiss_tfs, b1_nominal.twiss_tfs)
-            matched_b1_fields = lhc.get_magnets_powering(madxb1, patterns=affected_b1_elements)
-
-    # ----- Beam 1 Output Files ----- #
-    with timeit(lambda spanned: logger.info(f"Wrote out B1 TFS files to disk in {spanned:.2f} seconds")):
-        tfs.write(b1_dirs["tfs"] / "nominal_b1.tfs", only_export_columns(b1_nominal.twiss_tfs))
-        tfs.write(b1_dirs["tfs"] / "nominal_b1_monitors.tfs", only_monitors(only_export_columns(b1_nominal.twiss_tfs)))
-        tfs.write(b1_dirs["tfs"] / "bare_waist_b1.tfs", only_export_columns(b1_bare_waist.twiss_tfs))
-        tfs.write(b1_dirs["tfs"] / "bare_waist_b1_monitors.tfs", only_monitors(only_export_columns(b1_bare_waist.twiss_tfs)))
-        tfs.write(b1_dirs["tfs"] / "matched_waist_b1.tfs", only_export_columns(b1_matched_waist.twiss_tfs))
-        tfs.write(
-            b1_dirs["tfs"] / "matched_waist_b1_monitors.tfs", only_monitors(only_export_columns(b1_matched_waist.twiss_tfs))
+    if plan:
+        timings_files = [path / "timings.json" if path.is_dir() else path for path in plan_from]
+        if not timings_files and (outputdir / "timings.json").is_file():
+            timings_files = [outputdir / "timings.json"]
+        durations = load_recorded_durations(timings_files, ips=len(ips))
+        final_sections = [name for name in FINAL_SECTIONS if not (name == "plots" and skip_plots)]
+        print_plan(plan_stages(stages, durations, parallel=parallel, final_sections=final_sections))
+        return
+
+    # Once both stages of a beam are done at an IP, its files are written and (unless they are to be shown) its
+    # figures are rendered in the background, while the other stages still run
+    background_figures = None
+    if not (skip_plots or show_plots):
+        background_figures = _BackgroundFigures(
+            {(run_ip, beam): dirs[run_ip][beam - 1]["plots"] for run_ip in ips for beam in (1, 2)},
+            loglevel=loglevel,
+            mplstyle=mplstyle,
+            mode=plot_mode,
+            max_points=plot_max_points,
+            figsize=figsize,
         )
-        tfs.write(b1_dirs["tfs"] / "nominal_b1_fields.tfs", nominal_b1_fields)
-        tfs.write(b1_dirs["tfs"] / "matched_waist_b1_fields.tfs", matched_b1_fields)
-
-    # ----- Write B1 Knobs ----- #
-    with timeit(lambda spanned: logger.info(f"Wrote out B1 knob powerings and deltas to disk in {spanned:.2f} seconds")):
-        write_knob_powering(b1_dirs["knobs"] / "triplets.madx", b1_matched_waist.triplets_knobs)
-        write_knob_powering(b1_dirs["knobs"] / "quadrupoles.madx", b1_matched_waist.quads_knobs)
-        write_knob_powering(b1_dirs["knobs"] / "working_point.madx", b1_matched_waist.working_point_knobs)
-        write_knob_delta(b1_dirs["knobs"] / "triplets_change.madx", b1_nominal.triplets_knobs, b1_matched_waist.triplets_knobs)
-        write_knob_delta(b1_dirs["knobs"] / "quadrupoles_change.madx", b1_nominal.quads_knobs, b1_matched_waist.quads_knobs)
-        write_knob_delta(
-            b1_dirs["knobs"] / "working_point_change.madx", b1_nominal.working_point_knobs, b1_matched_waist.working_point_knobs
-        )
-        write_knob_changeparameters(
-            file_path=b1_dirs["knobs"] / "triplets_changeparameters.tfs",
-            nominal_knobs=b1_nominal.triplets_knobs,
-            matched_knobs=b1_matched_waist.triplets_knobs,
-            knob_name="Triplets",
-        )
-        write_knob_changeparameters(
-            file_path=b1_dirs["knobs"] / "quadrupoles_changeparameters.tfs",
-            nominal_knobs=b1_nominal.quads_knobs,
-            matched_knobs=b1_matched_waist.quads_knobs,
-            knob_name="Independent quadrupoles",
-        )
-        write_knob_changeparameters(
-            file_path=b1_dirs["knobs"] / "working_point_changeparameters.tfs",
-            nominal_knobs=b1_nominal.working_point_knobs,
-            matched_knobs=b1_matched_waist.working_point_knobs,
-            knob_name="Working point",
-        )
-
-    # ----- Beam 2 Nominal ----- #
-    logger.info("Preparing beam 2 nominal configuration")
-    nominal_b2_in = b2_dirs["main"] / "nominal_b2.madx"
-    nominal_b2_out = b2_dirs["main"] / "nominal_b2.out"
-    affected_b2_elements = [element.format(ip=ip, beam=2) for element in AFFECTED_ELEMENTS]
-    with nominal_b2_in.open("w") as commands, nominal_b2_out.open("w") as outputs:
-        with Madx(command_log=commands, stdout=outputs) as madxb2:
-            madxb2.option(echo=False, warn=False)
-            madxb2.call(fullpath(sequence))
-            lhc.make_lhc_beams(madxb2, energy=energy)  # needs to be defined here if we call acc-models opticsfiles
-            madxb2.call(fullpath(opticsfile))  # needs defined beams if we call acc-models opticsfiles
-
-            b2_nominal = get_nominal_beam_config(madxb2, energy=energy, beam=2, ip=ip, qx=qx, qy=qy)
-            nominal_b2_fields = lhc.get_magnets_powering(madxb2, patterns=affected_b2_elements)
-
-    # ----- Beam 2 Waist Shift ----- #
-    logger.info("Preparing beam 2 waist shift configuration")
-    waist_b2_in = b2_dirs["main"] / "waist_b2.madx"
-    waist_b2_out = b2_dirs["main"] / "waist_b2.out"
-    with waist_b2_in.open("w") as commands, waist_b2_out.open("w") as outputs:
-        with Madx(command_log=commands, stdout=outputs) as madxb2:
-            madxb2.option(echo=False, warn=False)
-            madxb2.call(fullpath(sequence))
-            lhc.make_lhc_beams(madxb2, energy=energy)  # needs to be defined here if we call acc-models opticsfiles
-            madxb2.call(fullpath(opticsfile))  # needs defined beams if we call acc-models opticsfiles
-
-            b2_bare_waist = get_bare_waist_shift_beam2_config(
-                madxb2, ip=ip, triplet_knobs=b1_matched_waist.triplets_knobs, energy=energy, qx=qx, qy=qy
+    with OutputsWriter() as writer, background_figures or nullcontext():
+
+        def beam_completed(beam_ip: int, beam: int, nominal: NominalResult, waist: WaistShiftResult) -> None:
+            if not waist.feasible:  # recorded once both beams are done
+                return
+            beam_dirs = dirs[beam_ip][beam - 1]
+            write_beam_outputs(
+                beam_dirs, beam, nominal.config, waist.bare, waist.matched, nominal.fields, waist.fields, writer=writer
             )
-            b2_bare_waist.twiss_tfs = add_betabeating_columns(b2_bare_waist.twiss_tfs, b2_nominal.twiss_tfs)
-
-            if use_knobs_from is not None:
-                logger.info("Using knobs from a provided previous run")
-                b2_matched_waist = get_waist_shift_config_from_applied_existing_knobs(
-                    madxb2, use_knobs_from=use_knobs_from, beam=2, ip=ip, qx=qx, qy=qy
+            if background_figures is not None:
+                background_figures.submit(beam_ip, beam, nominal.config.twiss_tfs, waist.bare.twiss_tfs, waist.matched.twiss_tfs)
+
+        with profiling.section("madx_stages"), timeit(
+            lambda spanned: logger.info(f"Ran all MAD-X stages in {spanned:.2f} seconds")
+        ):
+            results = run_stages(stages, parallel=parallel, loglevel=loglevel, on_completed=_on_beam_completed(beam_completed))
+
+        infeasible_ips = []
+        for run_ip in ips:
+            nominals = {beam: results[f"nominal_b{beam:d}"][run_ip] for beam in (1, 2)}
+            waists = {beam: results[f"waist_b{beam:d}_ip{run_ip:d}"] for beam in (1, 2)}
+
+            # ----- Feasibility ----- #
+            if not all(waist.feasible for waist in waists.values()):
+                infeasible_ips.append(run_ip)
+                writer.submit(
+                    write_infeasibility_record,
+                    get_ip_directory(outputdir, run_ip, ips) / "infeasible.json",
+                    {beam: waist.infeasible for beam, waist in waists.items() if not waist.feasible},
+                    ip=run_ip,
+                    waist_shift_setting=waist_shift_setting,
+                    max_powering=max_powering,
                 )
-
-            else:
-                logger.info("Refining beam 2 waist shift - this may take a while...")
-                b2_matched_waist = get_matched_waist_shift_config(
-                    madxb2, beam=2, ip=ip, nominal_twiss=b2_nominal.twiss_tfs, bare_twiss=b2_bare_waist.twiss_tfs, qx=qx, qy=qy
+                continue
+
+            # ----- Quick Sanity check ----- #
+            assert (
+                waists[1].matched.triplets_knobs == waists[2].matched.triplets_knobs
+            ), f"Triplet knobs are different for B1 and B2 at IP{run_ip:d}!"
+
+            # ----- Output Files ----- #
+            if bundle:
+                tables, knobs = {}, {}
+                for beam in (1, 2):
+                    beam_tables, beam_knobs = get_beam_bundle_contents(
+                        beam,
+                        nominals[beam].config,
+                        waists[beam].bare,
+                        waists[beam].matched,
+                        nominals[beam].fields,
+                        waists[beam].fields,
+                    )
+                    tables.update(beam_tables)
+                    knobs.update(beam_knobs)
+                writer.submit(
+                    write_result_bundle,
+                    get_ip_directory(outputdir, run_ip, ips) / "results.npz",
+                    tables,
+                    knobs,
+                    sequence=sequence,
+                    opticsfile=opticsfile,
+                    energy=energy,
+                    ip=run_ip,
+                    waist_shift_setting=waist_shift_setting,
                 )
 
-            b2_matched_waist.twiss_tfs = add_betabeating_columns(b2_matched_waist.twiss_tfs, b2_nominal.twiss_tfs)
-            matched_b2_fields = lhc.get_magnets_powering(madxb2, patterns=affected_b2_elements)
-
-    # ----- Quick Sanity check ----- #
-    assert b1_matched_waist.triplets_knobs == b2_matched_waist.triplets_knobs, "Triplet knobs are different for B1 and B2!"
-
-    # ----- Beam 2 Output Files ----- #
-    with timeit(lambda spanned: logger.info(f"Wrote out B2 TFS files to disk in {spanned:.2f} seconds")):
-        tfs.write(b2_dirs["tfs"] / "nominal_b2.tfs", only_export_columns(b2_nominal.twiss_tfs))
-        tfs.write(b2_dirs["tfs"] / "nominal_b2_monitors.tfs", only_monitors(only_export_columns(b2_nominal.twiss_tfs)))
-        tfs.write(b2_dirs["tfs"] / "bare_waist_b2.tfs", only_export_columns(b2_bare_waist.twiss_tfs))
-        tfs.write(b2_dirs["tfs"] / "bare_waist_b2_monitors.tfs", only_monitors(only_export_columns(b2_bare_waist.twiss_tfs)))
-        tfs.write(b2_dirs["tfs"] / "matched_waist_b2.tfs", only_export_columns(b2_matched_waist.twiss_tfs))
-        tfs.write(
-            b2_dirs["tfs"] / "matched_waist_b2_monitors.tfs", only_monitors(only_export_columns(b2_matched_waist.twiss_tfs))
-        )
-        tfs.write(b2_dirs["tfs"] / "nominal_b2_fields.tfs", nominal_b2_fields)
-        tfs.write(b2_dirs["tfs"] / "matched_waist_b2_fields.tfs", matched_b2_fields)
-
-    # ----- Write B2 Knobs ----- #
-    with timeit(lambda spanned: logger.info(f"Wrote out B2 knob powerings and deltas to disk in {spanned:.2f} seconds")):
-        write_knob_powering(b2_dirs["knobs"] / "triplets.madx", b2_matched_waist.triplets_knobs)
-        write_knob_powering(b2_dirs["knobs"] / "quadrupoles.madx", b2_matched_waist.quads_knobs)
-        write_knob_powering(b2_dirs["knobs"] / "working_point.madx", b2_matched_waist.working_point_knobs)
-        write_knob_delta(b2_dirs["knobs"] / "triplets_change.madx", b2_nominal.triplets_knobs, b2_matched_waist.triplets_knobs)
-        write_knob_delta(b2_dirs["knobs"] / "quadrupoles_change.madx", b2_nominal.quads_knobs, b2_matched_waist.quads_knobs)
-        write_knob_delta(
-            b2_dirs["knobs"] / "working_point_change.madx", b2_nominal.working_point_knobs, b2_matched_waist.working_point_knobs
-        )
-        write_knob_changeparameters(
-            file_path=b2_dirs["knobs"] / "triplets_changeparameters.tfs",
-            nominal_knobs=b2_nominal.triplets_knobs,
-            matched_knobs=b2_matched_waist.triplets_knobs,
-            knob_name="Triplets",
-        )
-        write_knob_changeparameters(
-            file_path=b2_dirs["knobs"] / "quadrupoles_changeparameters.tfs",
-            nominal_knobs=b2_nominal.quads_knobs,
-            matched_knobs=b2_matched_waist.quads_knobs,
-            knob_name="Independent quadrupoles",
-        )
-        write_knob_changeparameters(
-            file_path=b2_dirs["knobs"] / "working_point_changeparameters.tfs",
-            nominal_knobs=b2_nominal.working_point_knobs,
-            matched_knobs=b2_matched_waist.working_point_knobs,
-            knob_name="Working point",
-        )
-
-    # ----- Generate Plots ----- #
-    b1_figures = _generate_beam1_figures(
-        plots_dir=b1_dirs["plots"],
-        nominal_b1=b1_nominal.twiss_tfs,
-        bare_b1=b1_bare_waist.twiss_tfs,
-        matched_b1=b1_matched_waist.twiss_tfs,
-        # kwargs
-        figsize=figsize,
-    )
-    b2_figures = _generate_beam2_figures(
-        plots_dir=b2_dirs["plots"],
-        nominal_b2=b2_nominal.twiss_tfs,
-        bare_b2=b2_bare_waist.twiss_tfs,
-        matched_b2=b2_matched_waist.twiss_tfs,
-        # kwargs
-        figsize=figsize,
+        with profiling.section("writes"):
+            writer.wait()
+
+        # ----- Generate Plots ----- #
+        with profiling.section("plots"):
+            if background_figures is not None:
+                background_figures.wait()
+            elif show_plots:  # figures need to live in this process to be shown
+                for run_ip in (run_ip for run_ip in ips if run_ip not in infeasible_ips):
+                    for beam in (1, 2):
+                        nominal, waist = results[f"nominal_b{beam:d}"][run_ip], results[f"waist_b{beam:d}_ip{run_ip:d}"]
+                        _generate_beam_figures(
+                            beam,
+                            plots_dir=dirs[run_ip][beam - 1]["plots"],
+                            nominal=nominal.config.twiss_tfs,
+                            bare=waist.bare.twiss_tfs,
+                            matched=waist.matched.twiss_tfs,
+                            mode=plot_mode,
+                            max_points=plot_max_points,
+                            # kwargs
+                            figsize=figsize,
+                        )
+
+    # ----- Timings ----- #
+    profiling.write_timings(
+        outputdir / "timings.json", sequence=sequence, opticsfile=opticsfile, ips=ips, waist_shift_setting=waist_shift_setting
     )
+    logger.info(f"Wrote timings to '{outputdir / 'timings.json'}'")
 
     # ----- Eventually Display Plots ----- #
     if show_plots:
         logger.info("Asking matplotlib to show plots")
         plt.show()
 
+    if infeasible_ips:
+        raise click.ClickException(
+            f"The waist shift is infeasible at IP(s) {', '.join(str(run_ip) for run_ip in infeasible_ips)} with a setting of "
+            f"{waist_shift_setting:g}, see the 'infeasible.json' file(s) in the output directory"
+        )
+
 
 # ----- Helper Functions ----- #
 
 
-def _generate_beam1_figures(
-    plots_dir: Path, nominal_b1: tfs.TfsDataFrame, bare_b1: tfs.TfsDataFrame, matched_b1: tfs.TfsDataFrame, **kwargs
-) -> Tuple[matplotlib.figure.Figure, ...]:
+class _BackgroundFigures:
     """
-    Helper to generate figures for beam 1 from the different result `~tfs.TfsDataFrame`
-    and take boilerplate away from the main function.
+    Renders and saves the figures of both beams at all IPs in a pool of worker processes using the
+    non-interactive ``Agg`` backend, one task per figure. The figures of a beam at an IP are meant to be
+    submitted as soon as both its stages have completed (see `~._on_beam_completed`), so they are rendered
+    while the other stages still run. Worker processes are spawned rather than forked to not inherit the ``MAD-X``
+    instances of the current process.
 
     Args:
-        plots_dir (Path): `~pathlib.Path` to the directory to save the B1 figures in. If
-            `None`, the figures are not saved to disk.
-        nominal_b1 (tfs.TfsDataFrame): `~tfs.TfsDataFrame` of the nominal B1 results.
-        bare_b1 (tfs.TfsDataFrame): `~tfs.TfsDataFrame` of the bare waist B1 results.
-        matched_b1 (tfs.TfsDataFrame): `~tfs.TfsDataFrame` of the matched waist B1 results.
-        **kwargs: any keyword argument is passed to `~matplotlib.pyplot.subplots`.
+        plots_dirs (Dict[Tuple[int, int], Path]): `~pathlib.Path` to the directory to save the figures in, per
+            IP and beam.
+        loglevel (str): the logging level to configure in the worker processes.
+        mplstyle (str): if provided, name of a matplotlib style to use in the worker processes.
+        **kwargs: any keyword argument is passed to `~pyrws.plotting.create_figure`.
+    """
 
-    Returns:
-        A tuple of all the generated figures.
+    def __init__(self, plots_dirs: Dict[Tuple[int, int], Path], loglevel: str, mplstyle: Optional[str] = None, **kwargs):
+        self.plots_dirs = plots_dirs
+        self.figure_kwargs = kwargs
+        self.futures: List[Future] = []
+        self.executor = ProcessPoolExecutor(
+            max_workers=min(len(FIGURES), os.cpu_count() or 1),
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_plotting_worker,
+            initargs=(loglevel, mplstyle),
+        )
+
+    def __enter__(self) -> "_BackgroundFigures":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        for future in self.futures:  # shutdown's cancel_futures argument is only available from Python 3.9
+            future.cancel()
+        self.executor.shutdown(wait=True)
+
+    def submit(self, ip: int, beam: int, nominal: tfs.TfsDataFrame, bare: tfs.TfsDataFrame, matched: tfs.TfsDataFrame) -> None:
+        """Submits the rendering of all the figures of the given *beam* at the given *ip*."""
+        logger.debug(f"Submitting the rendering of IP{ip:d} B{beam:d} plots")
+        nominal, bare, matched = (_plotted_columns(dataframe) for dataframe in (nominal, bare, matched))
+        for name in FIGURES:
+            self.futures.append(
+                self.executor.submit(
+                    _render_figure,
+                    self.plots_dirs[(ip, beam)] / f"{name}.pdf",
+                    name,
+                    ip,
+                    beam,
+                    nominal,
+                    bare,
+                    matched,
+                    **self.figure_kwargs,
+                )
+            )
+
+    def wait(self) -> None:
+        """Waits for all the submitted figures to be saved, and gathers the profiling records of their rendering."""
+        with timeit(lambda spanned: logger.info(f"Waited {spanned:.2f} seconds for the plots to be saved")):
+            for future in self.futures:
+                profiling.add_records(future.result())  # raises here if the rendering failed
+
+
+def _on_beam_completed(callback: Callable[[int, int, NominalResult, WaistShiftResult], None]) -> Callable[[str, Any], None]:
+    """
+    Returns a function to give as *on_completed* to `~pyrws.pipeline.run_stages`, which calls *callback* with the IP,
+    the beam number and the results of its stages as soon as the waist shift stage of a beam at an IP completed (its
+    nominal stage, on which it depends, having completed before).
     """
-    with timeit(lambda spanned: logger.info(f"Generated B1 plots in {spanned:.2f} seconds")):
-        fig_b1_bbing_before, axis = plt.subplots(**kwargs)
-        plot_waist_shift_betabeatings(axis, bare_b1, show_ips=True)
-        axis.set_title("B1 - Waist Shift Induced Beta-Beating")
-
-        fig_b1_bbing_after, axis = plt.subplots(**kwargs)
-        plot_waist_shift_betabeatings(axis, matched_b1, show_ips=True)
-        axis.set_title("B1 - Waist Shift Induced Beta-Beating, After Matching")
-
-        fig_b1_before_vs_after_bbing, (axx, axy) = plt.subplots(2, 1, sharex=True, **kwargs)
-        plot_waist_shift_betabeatings_comparison(axx, bare_b1, matched_b1, column="BBX", show_ips=True)
-        plot_waist_shift_betabeatings_comparison(axy, bare_b1, matched_b1, column="BBY", show_ips=True)
-        axx.set_title("B1 - Horizontal Waist Shift Induced Beta-Beating - Before vs After Matching")
-        axy.set_xlabel("S [m]")
-
-        fig_b1_betas, (axx, axy) = plt.subplots(2, 1, sharex=True, **kwargs)
-        plot_betas_comparison(axx, nominal_b1, bare_b1, matched_b1, column="BETX", show_ips=True)
-        plot_betas_comparison(axy, nominal_b1, bare_b1, matched_b1, column="BETY", show_ips=True)
-        axx.set_title("B1 - Beta Functions for Each Configuration")
-        axy.set_xlabel("S [m]")
-
-        fig_b1_betas_deviations, (axx, axy) = plt.subplots(2, 1, sharex=True, **kwargs)
-        plot_betas_deviation(axx, nominal_b1, bare_b1, matched_b1, column="BETX", show_ips=True)
-        plot_betas_deviation(axy, nominal_b1, bare_b1, matched_b1, column="BETY", show_ips=True)
-        axx.set_title("B1 - Variation to Nominal Beta-Functions - Before vs After Matching")
-        axy.set_xlabel("S [m]")
-
-        fig_b1_phase_advances, (axx, axy) = plt.subplots(2, 1, sharex=True, **kwargs)
-        plot_phase_advances_comparison(axx, nominal_b1, bare_b1, matched_b1, column="MUX", show_ips=True)
-        plot_phase_advances_comparison(axy, nominal_b1, bare_b1, matched_b1, column="MUY", show_ips=True)
-        axx.set_title("B1 - Phase Advances for Each Configuration")
-        axy.set_xlabel("S [m]")
-
-        fig_b1_phase_differences, (axx, axy) = plt.subplots(2, 1, sharex=True, **kwargs)
-        plot_phase_differences(axx, nominal_b1, bare_b1, matched_b1, show_ips=True)
-        plot_phase_differences(axy, nominal_b1, bare_b1, matched_b1, show_ips=True)
-        axx.set_title("B1 - Phase Differences for Each Configuration")
-        axy.set_xlabel("S [m]")
+    nominals: Dict[int, Dict[int, NominalResult]] = {}
 
-    if plots_dir:
-        logger.debug("Saving B1 plots to disk")
-        fig_b1_bbing_before.savefig(plots_dir / "waist_shift_betabeatings.pdf")
-        fig_b1_bbing_after.savefig(plots_dir / "matched_waist_shift_betabeatings.pdf")
-        fig_b1_before_vs_after_bbing.savefig(plots_dir / "bare_vs_matched_betabeatings.pdf")
-        fig_b1_betas.savefig(plots_dir / "betas.pdf")
-        fig_b1_betas_deviations.savefig(plots_dir / "betas_deviations.pdf")
-        fig_b1_phase_advances.savefig(plots_dir / "phase_advances.pdf")
-        fig_b1_phase_differences.savefig(plots_dir / "phase_differences.pdf")
-
-    return (
-        fig_b1_bbing_before,
-        fig_b1_bbing_after,
-        fig_b1_before_vs_after_bbing,
-        fig_b1_betas,
-        fig_b1_betas_deviations,
-        fig_b1_phase_advances,
-        fig_b1_phase_differences,
-    )
+    def on_completed(name: str, result: Any) -> None:
+        if name.startswith("nominal_b"):
+            nominals[int(name[-1])] = result
+        else:  # waist_b[beam]_ip[n]
+            _, beam, ip = name.split("_")
+            callback(int(ip[2:]), int(beam[1:]), nominals[int(beam[1:])][int(ip[2:])], result)
 
+    return on_completed
 
-def _generate_beam2_figures(
-    plots_dir: Path, nominal_b2: tfs.TfsDataFrame, bare_b2: tfs.TfsDataFrame, matched_b2: tfs.TfsDataFrame, **kwargs
+
+def _generate_beam_figures(
+    beam: int,
+    plots_dir: Path,
+    nominal: tfs.TfsDataFrame,
+    bare: tfs.TfsDataFrame,
+    matched: tfs.TfsDataFrame,
+    **kwargs,
 ) -> Tuple[matplotlib.figure.Figure, ...]:
     """
-    Helper to generate figures for beam 2 from the different result `~tfs.TfsDataFrame`
-    and take boilerplate away from the main function. The figures are saved to disk before
-    being returned to the caller.
+    Helper to generate figures for the given *beam* in the current process from the different
+    result `~tfs.TfsDataFrame`, and take boilerplate away from the main function. The figures are
+    saved to disk before being returned to the caller, to be shown.
 
     Args:
-        plots_dir (Path): `~pathlib.Path` to the directory to save the B2 figures in. If
+        beam (int): the beam number, should be 1 or 2.
+        plots_dir (Path): `~pathlib.Path` to the directory to save the figures in. If
             `None`, the figures are not saved to disk.
-        nominal_b2 (tfs.TfsDataFrame): `~tfs.TfsDataFrame` of the nominal B2 results.
-        bare_b2 (tfs.TfsDataFrame): `~tfs.TfsDataFrame` of the bare waist B2 results.
-        matched_b2 (tfs.TfsDataFrame): `~tfs.TfsDataFrame` of the matched waist B2 results.
-        **kwargs: any keyword argument is passed to `~matplotlib.pyplot.subplots`.
+        nominal (tfs.TfsDataFrame): `~tfs.TfsDataFrame` of the nominal results.
+        bare (tfs.TfsDataFrame): `~tfs.TfsDataFrame` of the bare waist results.
+        matched (tfs.TfsDataFrame): `~tfs.TfsDataFrame` of the matched waist results.
+        **kwargs: any keyword argument is passed to `~pyrws.plotting.create_figure`.
 
     Returns:
         A tuple of all the generated figures.
     """
-    with timeit(lambda spanned: logger.info(f"Generated B2 plots in {spanned:.2f} seconds")):
-        fig_b2_bbing_before, axis = plt.subplots(**kwargs)
-        plot_waist_shift_betabeatings(axis, bare_b2, show_ips=True)
-        axis.set_title("B2 - Waist Shift Induced Beta-Beating")
-
-        fig_b2_bbing_after, axis = plt.subplots(**kwargs)
-        plot_waist_shift_betabeatings(axis, matched_b2, show_ips=True)
-        axis.set_title("B2 - Waist Shift Induced Beta-Beating, After Matching")
-
-        fig_b2_before_vs_after_bbing, (axx, axy) = plt.subplots(2, 1, sharex=True, **kwargs)
-        plot_waist_shift_betabeatings_comparison(axx, bare_b2, matched_b2, column="BBX", show_ips=True)
-        plot_waist_shift_betabeatings_comparison(axy, bare_b2, matched_b2, column="BBY", show_ips=True)
-        axx.set_title("B2 - Horizontal Waist Shift Induced Beta-Beating - Before vs After Matching")
-        axy.set_xlabel("S [m]")
-
-        fig_b2_betas, (axx, axy) = plt.subplots(2, 1, sharex=True, **kwargs)
-        plot_betas_comparison(axx, nominal_b2, bare_b2, matched_b2, column="BETX", show_ips=True)
-        plot_betas_comparison(axy, nominal_b2, bare_b2, matched_b2, column="BETY", show_ips=True)
-        axx.set_title("B2 - Beta Functions for Each Configuration")
-        axy.set_xlabel("S [m]")
-
-        fig_b2_betas_deviations, (axx, axy) = plt.subplots(2, 1, sharex=True, **kwargs)
-        plot_betas_deviation(axx, nominal_b2, bare_b2, matched_b2, column="BETX", show_ips=True)
-        plot_betas_deviation(axy, nominal_b2, bare_b2, matched_b2, column="BETY", show_ips=True)
-        axx.set_title("B2 - Variation to Nominal Beta-Functions - Before vs After Matching")
-        axy.set_xlabel("S [m]")
-
-        fig_b2_phase_advances, (axx, axy) = plt.subplots(2, 1, sharex=True, **kwargs)
-        plot_phase_advances_comparison(axx, nominal_b2, bare_b2, matched_b2, column="MUX", show_ips=True)
-        plot_phase_advances_comparison(axy, nominal_b2, bare_b2, matched_b2, column="MUY", show_ips=True)
-        axx.set_title("B2 - Phase Advances for Each Configuration")
-        axy.set_xlabel("S [m]")
-
-        fig_b2_phase_differences, (axx, axy) = plt.subplots(2, 1, sharex=True, **kwargs)
-        plot_phase_differences(axx, nominal_b2, bare_b2, matched_b2, show_ips=True)
-        plot_phase_differences(axy, nominal_b2, bare_b2, matched_b2, show_ips=True)
-        axx.set_title("B2 - Phase Differences for Each Configuration")
-        axy.set_xlabel("S [m]")
+    with timeit(lambda spanned: logger.info(f"Generated B{beam:d} plots in {spanned:.2f} seconds")):
+        figures = tuple(create_figure(name, beam, nominal, bare, matched, **kwargs) for name in FIGURES)
 
     if plots_dir:
-        logger.debug("Saving B2 plots to disk")
-        fig_b2_bbing_before.savefig(plots_dir / "waist_shift_betabeatings.pdf")
-        fig_b2_bbing_after.savefig(plots_dir / "matched_waist_shift_betabeatings.pdf")
-        fig_b2_before_vs_after_bbing.savefig(plots_dir / "bare_vs_matched_betabeatings.pdf")
-        fig_b2_betas.savefig(plots_dir / "betas.pdf")
-        fig_b2_betas_deviations.savefig(plots_dir / "betas_deviations.pdf")
-        fig_b2_phase_advances.savefig(plots_dir / "phase_advances.pdf")
-        fig_b2_phase_differences.savefig(plots_dir / "phase_differences.pdf")
-
-    return (
-        fig_b2_bbing_before,
-        fig_b2_bbing_after,
-        fig_b2_before_vs_after_bbing,
-        fig_b2_betas,
-        fig_b2_betas_deviations,
-        fig_b2_phase_advances,
-        fig_b2_phase_differences,
-    )
+        logger.debug(f"Saving B{beam:d} plots to disk")
+        for name, figure in zip(FIGURES, figures):
+            figure.savefig(plots_dir / f"{name}.pdf")
+
+    return figures
+
+
+def _init_plotting_worker(loglevel: str, mplstyle: Optional[str]) -> None:
+    """Configures the logger, a non-interactive backend and the eventual style in a plotting worker process."""
+    config_logger(level=loglevel)
+    matplotlib.use("Agg")
+    if mplstyle:
+        plt.style.use(mplstyle)
+
+
+def _render_figure(file_path: Path, name: str, ip: int, beam: int, *dataframes: pd.DataFrame, **kwargs) -> List[Dict[str, Any]]:
+    """Creates and saves a figure in a plotting worker process, and returns the profiling records of the rendering."""
+    with profiling.worker_records() as records, profiling.section(f"ip{ip:d}_b{beam:d}_{name}"):
+        figure = create_figure(name, beam, *dataframes, **kwargs)
+        figure.savefig(file_path)
+        plt.close(figure)
+    return records
+
+
+def _plotted_columns(dataframe: tfs.TfsDataFrame) -> pd.DataFrame:
+    """Returns only the columns of *dataframe* used in plots, to limit the data sent to plotting worker processes."""
+    return pd.DataFrame(dataframe[[column for column in PLOTTED_COLUMNS if column in dataframe.columns]])
@@ -12,6 +12,9 @@ from pyhdtoolkit.cpymadtools.constants import MONITOR_TWISS_COLUMNS
 
 VARIED_IR_QUADRUPOLES: List[int] = list(range(4, 11))
 
+# Initial conditions given to the IR segment matching, taken from a full ring TWISS
+SEGMENT_INITIAL_CONDITIONS: List[str] = ["BETX", "ALFX", "BETY", "ALFY", "DX", "DPX", "DY", "DPY"]
+
 # fmt: off
 # To be formatted based on ip and beam
 AFFECTED_ELEMENTS = [
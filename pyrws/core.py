@@ -7,10 +7,11 @@ Core Functionality
 Module with functions to perform the rigid waist shift and matching through a
 `~cpymad.madx.Madx` object.
 """
-from dataclasses import dataclass
+from dataclasses import dataclass, replace
 from pathlib import Path
-from typing import Dict
+from typing import Dict, Optional, Union
 
+import pandas as pd
 import tfs
 
 from cpymad._rpc import RemoteProcessClosed, RemoteProcessCrashed
@@ -20,12 +21,22 @@ from rich.console import Console
 
 from pyhdtoolkit.cpymadtools import lhc, matching, orbit, twiss
 from pyhdtoolkit.utils.contexts import timeit
-from pyrws.constants import VARIED_IR_QUADRUPOLES
+from pyrws import profiling
+from pyrws.constants import SEGMENT_INITIAL_CONDITIONS, VARIED_IR_QUADRUPOLES
+from pyrws.response import (
+    get_observables_values,
+    get_waist_shift_observables,
+    solve_knobs_corrections,
+    weighted_residual,
+)
+from pyrws.runs import RunResult
 from pyrws.utils import (
-    fullpath,
-    get_independent_quadrupoles_powering_knobs,
-    get_triplets_powering_knobs,
-    get_tunes_and_chroma_knobs,
+    MatchingCallsCounter,
+    get_all_globals_values,
+    get_all_powering_knobs,
+    get_changed_globals,
+    get_globals_values,
+    restore_globals_snapshot,
 )
 
 console = Console()
@@ -37,12 +48,88 @@ class BeamConfig:
     triplets_knobs: Dict[str, float]
     quads_knobs: Dict[str, float]
     working_point_knobs: Dict[str, float]
+    match_residual: Optional[float] = None  # final penalty of the improved waist shift matching, if done
+    working_point_calls: Optional[Dict[str, Optional[int]]] = None  # MAD-X calls of each working point rematch stage
+
+
+# ----- Working Point ----- #
+
+
+def rematch_working_point(
+    madx: Madx,
+    beam: int,
+    qx: float,
+    qy: float,
+    dqx: float = 2.0,
+    dqy: float = 2.0,
+    tune_tolerance: float = 1e-5,
+    chroma_tolerance: float = 1e-3,
+    calls: int = 200,
+    calls_counter: Optional[MatchingCallsCounter] = None,
+) -> Dict[str, Optional[int]]:
+    """
+    Rematches the working point of the provided *beam* with the tune and chroma knobs, in up to three
+    stages: tunes, then chromaticities, then both together. Before each stage the current values are
+    checked from the ``SUMM`` table, and the stage is skipped if its targets are already within tolerance.
+    Once all targets are, the remaining stages are skipped too. A single ``TWISS`` is done up front, as each
+    matching stage ends with its own ``TWISS`` which leaves the ``SUMM`` table up to date, so that a rematch
+    of an already converged working point costs a single ``TWISS``.
+
+    Args:
+        madx (cpymad.madx.Madx): an instanciated `~cpymad.madx.Madx` object.
+        beam (int): the beam number, should be 1 or 2.
+        qx (float): the horizontal tune to match to.
+        qy (float): the vertical tune to match to.
+        dqx (float): the horizontal chromaticity to match to. Defaults to 2.
+        dqy (float): the vertical chromaticity to match to. Defaults to 2.
+        tune_tolerance (float): the accepted absolute deviation of the tunes. Defaults to 1e-5.
+        chroma_tolerance (float): the accepted absolute deviation of the chromaticities. Defaults to 1e-3.
+        calls (int): the maximum number of ``MAD-X`` calls of each matching stage. Defaults to 200.
+        calls_counter (MatchingCallsCounter): if provided, the counter of the ``MAD-X`` output from which
+            to determine the calls used by each stage.
+
+    Returns:
+        A `dict` with the number of ``MAD-X`` calls used by the ``tunes``, ``chroma`` and ``tunes_and_chroma``
+        stages: 0 if the stage was skipped, and `None` if it was run but no *calls_counter* was given.
+    """
+    sequence = f"lhcb{beam:d}"
+    stages = {
+        "tunes": lambda: matching.match_tunes(madx, "lhc", sequence, qx, qy, calls=calls),
+        "chroma": lambda: matching.match_chromaticities(madx, "lhc", sequence, dqx, dqy, calls=calls),
+        "tunes_and_chroma": lambda: matching.match_tunes_and_chromaticities(madx, "lhc", sequence, qx, qy, dqx, dqy, calls=calls),
+    }
+    stage_calls: Dict[str, Optional[int]] = dict.fromkeys(stages, 0)
+    madx.command.twiss(sequence=sequence, chrom=True)  # later checks use the TWISS done at the end of each matching
+    for stage, rematch in stages.items():
+        summ = madx.table.summ
+        tunes_ok = abs(summ.q1[0] - qx) <= tune_tolerance and abs(summ.q2[0] - qy) <= tune_tolerance
+        chroma_ok = abs(summ.dq1[0] - dqx) <= chroma_tolerance and abs(summ.dq2[0] - dqy) <= chroma_tolerance
+        if tunes_ok and chroma_ok:
+            logger.debug(f"B{beam:d} working point is within tolerance, skipping the remaining rematch stages")
+            break
+        if (stage == "tunes" and tunes_ok) or (stage == "chroma" and chroma_ok):
+            logger.trace(f"Skipping the '{stage}' working point rematch stage, already within tolerance")
+            continue
+        calls_before = calls_counter.calls if calls_counter is not None else None
+        with profiling.section(f"working_point_{stage}"):
+            rematch()
+        stage_calls[stage] = calls_counter.calls - calls_before if calls_counter is not None else None
+    logger.debug(f"B{beam:d} working point rematch calls per stage: {stage_calls}")
+    return stage_calls
 
 
 # ----- Nominal Setup ----- #
 
 
-def get_nominal_beam_config(madx: Madx, energy: float, beam: int, ip: int, qx: float, qy: float) -> BeamConfig:
+def get_nominal_beam_config(
+    madx: Madx,
+    energy: float,
+    beam: int,
+    ip: int,
+    qx: float,
+    qy: float,
+    calls_counter: Optional[MatchingCallsCounter] = None,
+) -> BeamConfig:
     """
     Provided with an active `~cpymad.madx.Madx` object, will match to the working point defined
     by the provided tunes *qx* and *qy* and return the nominal configuration for the provided *beam*
@@ -67,6 +154,8 @@ def get_nominal_beam_config(madx: Madx, energy: float, beam: int, ip: int, qx: f
             knobs values.
         qx (float): the horizontal tune to match to.
         qy (float): the vertical tune to match to.
+        calls_counter (MatchingCallsCounter): if provided, used to record the ``MAD-X`` calls of each
+            stage of the working point rematch, see `~.rematch_working_point`.
 
     Returns:
         A custom `~.BeamConfig` object containing: the result of a ``TWISS`` call as a `~tfs.TfsDataFrame`,
@@ -77,31 +166,110 @@ def get_nominal_beam_config(madx: Madx, energy: float, beam: int, ip: int, qx: f
     assert beam in (1, 2)
     assert ip in (1, 2, 5, 8)
     logger.debug("Setting up nominal beam and matching tunes")
-    lhc.re_cycle_sequence(madx, sequence=f"lhcb{beam:d}", start=f"MSIA.EXIT.B{beam:d}")
-    lhc.make_lhc_beams(madx, energy=energy, emittance=3.75e-6)
-    _ = orbit.setup_lhc_orbit(madx, scheme="flat")
-    madx.command.use(sequence=f"lhcb{beam:d}")
+    _setup_nominal_beam(madx, energy=energy, beam=beam)
 
-    matching.match_tunes(madx, "lhc", f"lhcb{beam:d}", qx, qy, calls=200)
-    matching.match_chromaticities(madx, "lhc", f"lhcb{beam:d}", 2.0, 2.0, calls=200)
-    matching.match_tunes_and_chromaticities(madx, "lhc", f"lhcb{beam:d}", qx, qy, 2.0, 2.0, calls=200)
+    working_point_calls = rematch_working_point(madx, beam=beam, qx=qx, qy=qy, calls_counter=calls_counter)
     twiss_df = twiss.get_twiss_tfs(madx, chrom=True)
-    triplets_knobs = get_triplets_powering_knobs(madx, ip=ip)
-    quads_knobs = get_independent_quadrupoles_powering_knobs(madx, quad_numbers=VARIED_IR_QUADRUPOLES, ip=ip, beam=beam)
-    working_point_knobs = get_tunes_and_chroma_knobs(madx, beam=beam)
+    triplets_knobs, quads_knobs, working_point_knobs = get_all_powering_knobs(
+        madx, quad_numbers=VARIED_IR_QUADRUPOLES, ip=ip, beam=beam
+    )
     return BeamConfig(
         twiss_tfs=twiss_df,
         triplets_knobs=triplets_knobs,
         quads_knobs=quads_knobs,
         working_point_knobs=working_point_knobs,
+        working_point_calls=working_point_calls,
     )
 
 
+def get_nominal_ip_config(madx: Madx, nominal: BeamConfig, beam: int, ip: int) -> BeamConfig:
+    """
+    Provided with an active `~cpymad.madx.Madx` object in the nominal configuration determined by
+    `~.get_nominal_beam_config` for another IP, returns the nominal configuration for the given *ip*.
+    The working point matching and ``TWISS`` do not depend on the IP, so only the triplets and
+    independent IR quadrupoles powering knobs are queried again, and the rest is shared with *nominal*.
+
+    Args:
+        madx (cpymad.madx.Madx): an instanciated `~cpymad.madx.Madx` object, in the nominal configuration.
+        nominal (BeamConfig): the nominal configuration of the *beam*, determined for another IP.
+        beam (int): the beam number, should be 1 or 2.
+        ip (int): the IP for which to get triplets and independent quadrupoles powering knobs values.
+
+    Returns:
+        A `~.BeamConfig` object sharing the ``TWISS`` table and working point knobs of *nominal*,
+        with the knobs of the given *ip*.
+    """
+    assert beam in (1, 2)
+    assert ip in (1, 2, 5, 8)
+    logger.debug(f"Querying nominal beam {beam:d} knobs at IP{ip:d}")
+    triplets_knobs, quads_knobs, _ = get_all_powering_knobs(madx, quad_numbers=VARIED_IR_QUADRUPOLES, ip=ip, beam=beam)
+    return replace(nominal, triplets_knobs=triplets_knobs, quads_knobs=quads_knobs)
+
+
+def get_split_tunes_globals(
+    madx: Madx,
+    energy: float,
+    beam: int,
+    qx: float,
+    qy: float,
+    calls_counter: Optional[MatchingCallsCounter] = None,
+) -> Dict[str, Union[float, str]]:
+    """
+    Provided with an active `~cpymad.madx.Madx` object in which the sequence and opticsfile have just been
+    called, sets up the nominal configuration of the given *beam* with split tunes (*qx* - 0.04, *qy* + 0.04),
+    which is the starting point of the bare waist shift, and returns the globals it changed. These can be
+    given to `~.get_bare_waist_shift_beam1_config` and `~.get_bare_waist_shift_beam2_config`, for them to
+    restore this state (see `~.apply_split_tunes_globals`) instead of rematching it for each waist shift.
+
+    Args:
+        madx (cpymad.madx.Madx): an instanciated `~cpymad.madx.Madx` object.
+        energy (float): beam energy for the setup, in [GeV].
+        beam (int): the beam number, should be 1 or 2.
+        qx (float): the horizontal tune of the waist shift, from which the split tunes are derived.
+        qy (float): the vertical tune of the waist shift, from which the split tunes are derived.
+        calls_counter (MatchingCallsCounter): if provided, used to record the ``MAD-X`` calls of each
+            stage of the working point rematch, see `~.rematch_working_point`.
+
+    Returns:
+        A `dict` of the names and definitions of the global variables changed by the setup, as given
+        by `~pyrws.utils.get_changed_globals`.
+    """
+    before = get_all_globals_values(madx)
+    logger.debug(f"Setting up beam {beam:d} with split tunes")
+    _setup_nominal_beam(madx, energy=energy, beam=beam)
+    rematch_working_point(madx, beam=beam, qx=qx - 0.04, qy=qy + 0.04, calls_counter=calls_counter)
+    return get_changed_globals(madx, before)
+
+
+def apply_split_tunes_globals(madx: Madx, energy: float, beam: int, split_tunes_globals: Dict[str, Union[float, str]]) -> None:
+    """
+    Provided with an active `~cpymad.madx.Madx` object in which the sequence and opticsfile have just been
+    called, sets up the nominal configuration of the given *beam* with split tunes from the globals given by
+    `~.get_split_tunes_globals`, which leaves it in the same state as the rematch done there.
+
+    Args:
+        madx (cpymad.madx.Madx): an instanciated `~cpymad.madx.Madx` object.
+        energy (float): beam energy for the setup, in [GeV].
+        beam (int): the beam number, should be 1 or 2.
+        split_tunes_globals (Dict[str, Union[float, str]]): the globals changed by the split tunes setup.
+    """
+    logger.debug(f"Setting up beam {beam:d} with split tunes from {len(split_tunes_globals)} saved globals")
+    _setup_nominal_beam(madx, energy=energy, beam=beam)
+    restore_globals_snapshot(madx, split_tunes_globals)
+
+
 # ----- Implement Bare Waist Shift ----- #
 
 
 def get_bare_waist_shift_beam1_config(
-    madx: Madx, ip: int, rigidty_waist_shift_value: float, energy: float, qx: float, qy: float
+    madx: Madx,
+    ip: int,
+    rigidty_waist_shift_value: float,
+    energy: float,
+    qx: float,
+    qy: float,
+    calls_counter: Optional[MatchingCallsCounter] = None,
+    split_tunes_globals: Optional[Dict[str, Union[float, str]]] = None,
 ) -> BeamConfig:
     """
     Applies the rigid waist shift at the provided *ip* for beam 1, and returns the corresponding
@@ -125,6 +293,11 @@ def get_bare_waist_shift_beam1_config(
             waist shift.
         qy (float): the vertical tune to re-match to after applying the rigit
             waist shift.
+        calls_counter (MatchingCallsCounter): if provided, used to record the ``MAD-X`` calls of each
+            stage of the working point rematch, see `~.rematch_working_point`.
+        split_tunes_globals (Dict[str, Union[float, str]]): if provided, the globals of the split tunes
+            nominal configuration to start from, as given by `~.get_split_tunes_globals`. Otherwise, this
+            configuration is rematched first.
 
     Returns:
         A custom `~.BeamConfig` object containing: the result of a ``TWISS`` call as a `~tfs.TfsDataFrame`,
@@ -132,28 +305,37 @@ def get_bare_waist_shift_beam1_config(
         of the independent IR quadrupoles powering knobs and a `dict` with the names and values of the working
         point knobs (tunes and chroma).
     """
-    _ = get_nominal_beam_config(madx, energy=energy, beam=1, ip=ip, qx=qx - 0.04, qy=qy + 0.04)
+    if split_tunes_globals is not None:
+        apply_split_tunes_globals(madx, energy=energy, beam=1, split_tunes_globals=split_tunes_globals)
+    else:
+        _ = get_nominal_beam_config(madx, energy=energy, beam=1, ip=ip, qx=qx - 0.04, qy=qy + 0.04, calls_counter=calls_counter)
     logger.debug(f"Applying rigidity waist shift to beam 1 at IP{ip}")
     lhc.apply_lhc_rigidity_waist_shift_knob(madx, rigidty_waist_shift_value=rigidty_waist_shift_value, ir=ip)
-    matching.match_tunes(madx, "lhc", "lhcb1", qx, qy, calls=200)
-    matching.match_chromaticities(madx, "lhc", "lhcb1", 2.0, 2.0, calls=200)
-    matching.match_tunes_and_chromaticities(madx, "lhc", "lhcb1", qx, qy, 2.0, 2.0, calls=200)
+    working_point_calls = rematch_working_point(madx, beam=1, qx=qx, qy=qy, calls_counter=calls_counter)
     logger.debug(f"Managed to rematch B1 to Qx = {madx.table.summ.q1[0]} and Qy = {madx.table.summ.q2[0]}")
 
     twiss_df = twiss.get_twiss_tfs(madx, chrom=True)
-    triplets_knobs = get_triplets_powering_knobs(madx, ip=ip)
-    quads_knobs = get_independent_quadrupoles_powering_knobs(madx, quad_numbers=VARIED_IR_QUADRUPOLES, ip=ip, beam=1)
-    working_point_knobs = get_tunes_and_chroma_knobs(madx, beam=1)
+    triplets_knobs, quads_knobs, working_point_knobs = get_all_powering_knobs(
+        madx, quad_numbers=VARIED_IR_QUADRUPOLES, ip=ip, beam=1
+    )
     return BeamConfig(
         twiss_tfs=twiss_df,
         triplets_knobs=triplets_knobs,
         quads_knobs=quads_knobs,
         working_point_knobs=working_point_knobs,
+        working_point_calls=working_point_calls,
     )
 
 
 def get_bare_waist_shift_beam2_config(
-    madx: Madx, ip: int, triplet_knobs: Dict[str, float], energy: float, qx: float, qy: float
+    madx: Madx,
+    ip: int,
+    triplet_knobs: Dict[str, float],
+    energy: float,
+    qx: float,
+    qy: float,
+    calls_counter: Optional[MatchingCallsCounter] = None,
+    split_tunes_globals: Optional[Dict[str, Union[float, str]]] = None,
 ) -> BeamConfig:
     """
     Applies the rigid waist shift at the provided *ip* for beam 1, and returns the corresponding
@@ -178,6 +360,11 @@ def get_bare_waist_shift_beam2_config(
             waist shift.
         qy (float): the vertical tune to re-match to after applying the rigit
             waist shift.
+        calls_counter (MatchingCallsCounter): if provided, used to record the ``MAD-X`` calls of each
+            stage of the working point rematch, see `~.rematch_working_point`.
+        split_tunes_globals (Dict[str, Union[float, str]]): if provided, the globals of the split tunes
+            nominal configuration to start from, as given by `~.get_split_tunes_globals`. Otherwise, this
+            configuration is rematched first.
 
     Returns:
         A custom `~.BeamConfig` object containing: the result of a ``TWISS`` call as a `~tfs.TfsDataFrame`,
@@ -185,25 +372,27 @@ def get_bare_waist_shift_beam2_config(
         of the independent IR quadrupoles powering knobs and a `dict` with the names and values of the working
         point knobs (tunes and chroma).
     """
-    _ = get_nominal_beam_config(madx, energy=energy, beam=2, ip=ip, qx=qx - 0.04, qy=qy + 0.04)
+    if split_tunes_globals is not None:
+        apply_split_tunes_globals(madx, energy=energy, beam=2, split_tunes_globals=split_tunes_globals)
+    else:
+        _ = get_nominal_beam_config(madx, energy=energy, beam=2, ip=ip, qx=qx - 0.04, qy=qy + 0.04, calls_counter=calls_counter)
     logger.info(f"Applying rigidity waist shift to beam 2 at IP{ip}, as determined by the beam 1 triplet knobs")
     logger.debug(f"Triplet knobs are: {triplet_knobs}")
     with madx.batch():
         madx.globals.update(triplet_knobs)
-    matching.match_tunes(madx, "lhc", "lhcb2", qx, qy, calls=200)
-    matching.match_chromaticities(madx, "lhc", "lhcb2", 2.0, 2.0, calls=200)
-    matching.match_tunes_and_chromaticities(madx, "lhc", "lhcb2", qx, qy, 2.0, 2.0, calls=200)
+    working_point_calls = rematch_working_point(madx, beam=2, qx=qx, qy=qy, calls_counter=calls_counter)
     logger.debug(f"Managed to rematch B2 to Qx = {madx.table.summ.q1[0]} and Qy = {madx.table.summ.q2[0]}")
 
     twiss_df = twiss.get_twiss_tfs(madx, chrom=True)
-    triplets_knobs = get_triplets_powering_knobs(madx, ip=ip)
-    quads_knobs = get_independent_quadrupoles_powering_knobs(madx, quad_numbers=VARIED_IR_QUADRUPOLES, ip=ip, beam=2)
-    working_point_knobs = get_tunes_and_chroma_knobs(madx, beam=2)
+    triplets_knobs, quads_knobs, working_point_knobs = get_all_powering_knobs(
+        madx, quad_numbers=VARIED_IR_QUADRUPOLES, ip=ip, beam=2
+    )
     return BeamConfig(
         twiss_tfs=twiss_df,
         triplets_knobs=triplets_knobs,
         quads_knobs=quads_knobs,
         working_point_knobs=working_point_knobs,
+        working_point_calls=working_point_calls,
     )
 
 
@@ -211,7 +400,16 @@ def get_bare_waist_shift_beam2_config(
 
 
 def get_matched_waist_shift_config(
-    madx: Madx, beam: int, ip: int, nominal_twiss: tfs.TfsDataFrame, bare_twiss: tfs.TfsDataFrame, qx: float, qy: float
+    madx: Madx,
+    beam: int,
+    ip: int,
+    nominal_twiss: tfs.TfsDataFrame,
+    bare_twiss: tfs.TfsDataFrame,
+    qx: float,
+    qy: float,
+    initial_quads_knobs: Optional[Dict[str, float]] = None,
+    ir_segment: bool = False,
+    calls_counter: Optional[MatchingCallsCounter] = None,
 ) -> BeamConfig:
     """
     Performs relevant matchings to improve the rigid waist shift at the provided *ip* for beam 1,
@@ -239,100 +437,246 @@ def get_matched_waist_shift_config(
             waist shift.
         qy (float): the vertical tune to re-match to after applying the rigit
             waist shift.
+        initial_quads_knobs (Dict[str, float]): if provided, independent quadrupoles powering knobs
+            values to apply before matching, as a warm start.
+        ir_segment (bool): if `True`, the matching is done on the IR segment only, from ``S.DS.L[ip]``
+            to ``E.DS.R[ip]``, with initial conditions taken from *bare_twiss*. Each iteration then
+            only twisses a fraction of the ring, and a single full ring ``TWISS`` is done afterwards
+            to determine the residual. Defaults to `False`.
+        calls_counter (MatchingCallsCounter): if provided, used to record the ``MAD-X`` calls of each
+            stage of the working point rematch, see `~.rematch_working_point`.
 
     Returns:
         A custom `~.BeamConfig` object containing: the result of a ``TWISS`` call as a `~tfs.TfsDataFrame`,
         a `dict` with the names and values of the triplets powering knobs, a `dict` with the names and values
-        of the independent IR quadrupoles powering knobs and a `dict` with the names and values of the working
-        point knobs (tunes and chroma).
+        of the independent IR quadrupoles powering knobs, a `dict` with the names and values of the working
+        point knobs (tunes and chroma) and the final penalty function value of the matching.
     """
     assert beam in (1, 2)
     assert ip in (1, 2, 5, 8)
-    logger.debug("Defining matching points to improve the waist shift")
-    MATCH_IP_POINT = f"IP{ip:d}"  # IP marker
-    MATCH_Q3_LEFT = f"MQXA.3L{ip:d}"  # Q3 left of provided IP
-    MATCH_Q3_RIGHT = f"MQXA.3R{ip:d}"  # Q3 right of provided IP
-    MATCH_Q11_LEFT = f"MQ.11L{ip:d}.B{beam:d}"  # Q11 left of provided IP
-    MATCH_Q11_RIGHT = f"MQ.11R{ip:d}.B{beam:d}"  # Q11 right of provided IP
     SEQUENCE = f"lhcb{beam:d}"  # sequence name, depending on the beam
-    logger.debug(
-        "Match point names are: "
-        f"'{MATCH_IP_POINT}', '{MATCH_Q3_LEFT}', '{MATCH_Q3_RIGHT}', '{MATCH_Q11_LEFT}', '{MATCH_Q11_RIGHT}'"
-    )
+    targets = get_waist_shift_targets(beam, ip, nominal_twiss, bare_twiss)
+    logger.debug(f"Match point names are: {', '.join(repr(name) for name in targets.index.unique(level='ELEMENT'))}")
+
+    if initial_quads_knobs is not None:  # set before the MATCH block, as the initial state of the matching
+        logger.debug("Warm-starting the matching from provided independent quadrupoles powering")
+        with madx.batch():
+            madx.globals.update(initial_quads_knobs)
 
     logger.debug("Matching for the beta-functions and dispersion")
-    madx.command.match(sequence=SEQUENCE, chrom=True)
-    # First we give constraints for the IP point, same as in the bare waist
-    madx.command.constraint(
-        sequence=SEQUENCE,
-        range_=MATCH_IP_POINT,
-        betx=bare_twiss.BETX[MATCH_IP_POINT],
-        bety=bare_twiss.BETY[MATCH_IP_POINT],
-        dx=0,
-        dy=0,
-    )
-    # Then constraints at Q3 matching points, also same as in the bare waist
-    madx.command.constraint(
-        sequence=SEQUENCE,
-        range_=MATCH_Q3_LEFT.upper(),
-        betx=bare_twiss.BETX[MATCH_Q3_LEFT],
-        bety=bare_twiss.BETY[MATCH_Q3_LEFT],
-    )
-    madx.command.constraint(
-        sequence=SEQUENCE,
-        range_=MATCH_Q3_RIGHT.upper(),
-        betx=bare_twiss.BETX[MATCH_Q3_RIGHT],
-        bety=bare_twiss.BETY[MATCH_Q3_RIGHT],
-    )
-    # Then constraints at Q11 matching points, now the same as in the nominal scenario
-    madx.command.constraint(
-        sequence=SEQUENCE,
-        range_=MATCH_Q11_LEFT.upper(),
-        betx=nominal_twiss.BETX[MATCH_Q11_LEFT],
-        bety=nominal_twiss.BETY[MATCH_Q11_LEFT],
-    )
-    madx.command.constraint(
-        sequence=SEQUENCE,
-        range_=MATCH_Q11_RIGHT.upper(),
-        betx=nominal_twiss.BETX[MATCH_Q11_RIGHT],
-        bety=nominal_twiss.BETY[MATCH_Q11_RIGHT],
-    )
+    if ir_segment:
+        segment_start, segment_end = f"S.DS.L{ip:d}.B{beam:d}", f"E.DS.R{ip:d}.B{beam:d}"
+        logger.debug(f"Matching on the '{segment_start}' to '{segment_end}' segment only")
+        initial_conditions = {column.lower(): bare_twiss.loc[segment_start, column] for column in SEGMENT_INITIAL_CONDITIONS}
+        madx.command.match(sequence=SEQUENCE, range_=f"{segment_start}/{segment_end}", chrom=True, **initial_conditions)
+    else:
+        madx.command.match(sequence=SEQUENCE, chrom=True)
+    for element, element_targets in targets.groupby(level="ELEMENT", sort=False):
+        madx.command.constraint(
+            sequence=SEQUENCE,
+            range_=element,
+            **{column.lower(): value for (_, column), value in element_targets.items()},
+        )
     # Could add some constraints for the alpha at Q11 match points with a lower weight
     # (let's say 0.5 to get half of the beta weight) to help the matching a little bit
 
     # We make a knob varying Q4 to Q10 included and we match
     lhc.vary_independent_ir_quadrupoles(madx, quad_numbers=VARIED_IR_QUADRUPOLES, sides=("R", "L"), ip=ip, beam=beam)
+    match_residual = None
     try:
         with timeit(lambda spanned: logger.debug(f"Rematched the waist shift in {spanned} seconds")):
             madx.command.jacobian(calls=25, strategy=1, tolerance=1.0e-21)
             madx.command.endmatch()
+        match_residual = madx.globals["tar"]  # final penalty function value, overwritten by later matchings
+        logger.debug(f"Waist shift matching residual is {match_residual}")
+        if ir_segment:  # the segment penalty assumes unchanged incoming optics, check on the full ring
+            match_residual = weighted_residual(targets - get_observables_values(madx, SEQUENCE, targets.index))
+            logger.debug(f"Waist shift full ring residual is {match_residual}")
     except (RemoteProcessClosed, RemoteProcessCrashed, TwissFailed):
         logger.error("A crash occured in MAD-X when trying to rematch the waist shift")
         console.print_exception()
 
     # Sanity check: use MQTs (minimal beta-beating impact) to get back to working point in case of drift
-    matching.match_tunes(madx, "lhc", SEQUENCE, qx, qy, calls=200)
-    matching.match_chromaticities(madx, "lhc", SEQUENCE, 2.0, 2.0, calls=200)
-    matching.match_tunes_and_chromaticities(madx, "lhc", SEQUENCE, qx, qy, 2.0, 2.0, calls=200)
+    working_point_calls = rematch_working_point(madx, beam=beam, qx=qx, qy=qy, calls_counter=calls_counter)
     logger.debug(f"Managed to rematch B{beam:d} to Qx = {madx.table.summ.q1[0]} and Qy = {madx.table.summ.q2[0]}")
 
     twiss_df = twiss.get_twiss_tfs(madx, chrom=True)
-    triplets_knobs = get_triplets_powering_knobs(madx, ip=ip)
-    quads_knobs = get_independent_quadrupoles_powering_knobs(madx, quad_numbers=VARIED_IR_QUADRUPOLES, ip=ip, beam=beam)
-    working_point_knobs = get_tunes_and_chroma_knobs(madx, beam=beam)
+    triplets_knobs, quads_knobs, working_point_knobs = get_all_powering_knobs(
+        madx, quad_numbers=VARIED_IR_QUADRUPOLES, ip=ip, beam=beam
+    )
     return BeamConfig(
         twiss_tfs=twiss_df,
         triplets_knobs=triplets_knobs,
         quads_knobs=quads_knobs,
         working_point_knobs=working_point_knobs,
+        match_residual=match_residual,
+        working_point_calls=working_point_calls,
     )
 
 
+def get_linearised_waist_shift_config(
+    madx: Madx,
+    beam: int,
+    ip: int,
+    nominal_twiss: tfs.TfsDataFrame,
+    bare_twiss: tfs.TfsDataFrame,
+    qx: float,
+    qy: float,
+    response: pd.DataFrame,
+    max_residual: float = 1e-4,
+    iterations: int = 5,
+    initial_quads_knobs: Optional[Dict[str, float]] = None,
+    ir_segment: bool = False,
+    calls_counter: Optional[MatchingCallsCounter] = None,
+) -> BeamConfig:
+    """
+    Improves the rigid waist shift at the provided *ip* like `~.get_matched_waist_shift_config`, but
+    determines the independent IR quadrupoles powering from a pre-computed *response* matrix instead
+    of through a ``MAD-X`` matching. Each iteration solves the linear problem and checks the result
+    with a single ``TWISS``, stopping as soon as the penalty function is below *max_residual*. If it
+    is still above after all *iterations*, the best found powering is used as starting point of the
+    full `~.get_matched_waist_shift_config` matching.
+
+    .. important::
+        This assumes to whole setups from `~.get_nominal_beam_config` and then
+        `~.get_bare_waist_shift_beam1_config` or `~.get_bare_waist_shift_beam2_config` have been
+        called beforehand (aka the waist shift is applied).
+
+    Args:
+        madx (cpymad.madx.Madx): an instanciated `~cpymad.madx.Madx` object.
+        beam (int): the beam number, should be 1 or 2.
+        ip (int): the IP at which to apply the rigid waist shift.
+        nominal_twiss (tfs.TfsDataFrame): the `~tfs.TfsDataFrame` with the ``TWISS`` table from the
+            nominal scenario, which is used to determine matching constraint values.
+        bare_twiss (tfs.TfsDataFrame): the `~tfs.TfsDataFrame` with the ``TWISS`` table from the
+            bare waist shift scenario, which is used to determine matching constraint values.
+        qx (float): the horizontal tune to re-match to after applying the rigid
+            waist shift.
+        qy (float): the vertical tune to re-match to after applying the rigit
+            waist shift.
+        response (pd.DataFrame): the response matrix of the matching constraints to the independent
+            IR quadrupoles powering knobs, as given by `~pyrws.response.get_response_matrix`.
+        max_residual (float): the penalty function value below which the solution is accepted.
+            Defaults to 1e-4.
+        iterations (int): the maximum number of linear solving iterations. Defaults to 5.
+        initial_quads_knobs (Dict[str, float]): if provided, independent quadrupoles powering knobs
+            values to apply before solving, as a warm start.
+        ir_segment (bool): if `True` and the full matching is needed, it is done on the IR segment
+            only. See `~.get_matched_waist_shift_config`. Defaults to `False`.
+        calls_counter (MatchingCallsCounter): if provided, used to record the ``MAD-X`` calls of each
+            stage of the working point rematch, see `~.rematch_working_point`.
+
+    Returns:
+        A custom `~.BeamConfig` object containing: the result of a ``TWISS`` call as a `~tfs.TfsDataFrame`,
+        a `dict` with the names and values of the triplets powering knobs, a `dict` with the names and values
+        of the independent IR quadrupoles powering knobs, a `dict` with the names and values of the working
+        point knobs (tunes and chroma) and the final penalty function value.
+    """
+    assert beam in (1, 2)
+    assert ip in (1, 2, 5, 8)
+    SEQUENCE = f"lhcb{beam:d}"  # sequence name, depending on the beam
+    targets = get_waist_shift_targets(beam, ip, nominal_twiss, bare_twiss)
+
+    if initial_quads_knobs is not None:
+        logger.debug("Warm-starting the solving from provided independent quadrupoles powering")
+        with madx.batch():
+            madx.globals.update(initial_quads_knobs)
+
+    knobs = get_globals_values(madx, response.columns)
+    differences = targets - get_observables_values(madx, SEQUENCE, targets.index)
+    best_knobs, best_residual = dict(knobs), weighted_residual(differences)
+    with timeit(lambda spanned: logger.debug(f"Solved the waist shift from the response matrix in {spanned} seconds")):
+        for iteration in range(1, iterations + 1):
+            if best_residual <= max_residual:
+                break
+            corrections = solve_knobs_corrections(response, differences)
+            knobs = {knob: value + corrections[knob] for knob, value in knobs.items()}
+            with madx.batch():
+                madx.globals.update(knobs)
+            differences = targets - get_observables_values(madx, SEQUENCE, targets.index)
+            residual = weighted_residual(differences)
+            logger.debug(f"Response matrix iteration {iteration} residual is {residual}")
+            if residual < best_residual:
+                best_knobs, best_residual = dict(knobs), residual
+
+    if best_residual > max_residual:
+        logger.warning(
+            f"Residual from the response matrix ({best_residual:.2e}) is above {max_residual:.2e}, "
+            "falling back to the full matching"
+        )
+        return get_matched_waist_shift_config(
+            madx,
+            beam=beam,
+            ip=ip,
+            nominal_twiss=nominal_twiss,
+            bare_twiss=bare_twiss,
+            qx=qx,
+            qy=qy,
+            initial_quads_knobs=best_knobs,
+            ir_segment=ir_segment,
+            calls_counter=calls_counter,
+        )
+    with madx.batch():
+        madx.globals.update(best_knobs)
+    logger.debug(f"Waist shift residual from the response matrix is {best_residual}")
+
+    # Sanity check: use MQTs (minimal beta-beating impact) to get back to working point in case of drift
+    working_point_calls = rematch_working_point(madx, beam=beam, qx=qx, qy=qy, calls_counter=calls_counter)
+    logger.debug(f"Managed to rematch B{beam:d} to Qx = {madx.table.summ.q1[0]} and Qy = {madx.table.summ.q2[0]}")
+
+    twiss_df = twiss.get_twiss_tfs(madx, chrom=True)
+    triplets_knobs, quads_knobs, working_point_knobs = get_all_powering_knobs(
+        madx, quad_numbers=VARIED_IR_QUADRUPOLES, ip=ip, beam=beam
+    )
+    return BeamConfig(
+        twiss_tfs=twiss_df,
+        triplets_knobs=triplets_knobs,
+        quads_knobs=quads_knobs,
+        working_point_knobs=working_point_knobs,
+        match_residual=best_residual,
+        working_point_calls=working_point_calls,
+    )
+
+
+def get_waist_shift_targets(beam: int, ip: int, nominal_twiss: tfs.TfsDataFrame, bare_twiss: tfs.TfsDataFrame) -> pd.Series:
+    """
+    Returns the target values of the improved waist shift matching constraints at the provided *ip*.
+
+    Args:
+        beam (int): the beam number, should be 1 or 2.
+        ip (int): the IP at which to apply the rigid waist shift.
+        nominal_twiss (tfs.TfsDataFrame): the `~tfs.TfsDataFrame` with the ``TWISS`` table from the
+            nominal scenario.
+        bare_twiss (tfs.TfsDataFrame): the `~tfs.TfsDataFrame` with the ``TWISS`` table from the
+            bare waist shift scenario.
+
+    Returns:
+        A `~pandas.Series` of the target values, indexed as given by
+        `~pyrws.response.get_waist_shift_observables`.
+    """
+    observables = get_waist_shift_observables(beam, ip)
+    targets = pd.Series(index=observables, dtype=float)
+    for element, column in observables:
+        if column in ("DX", "DY"):  # no dispersion at the IP
+            targets[element, column] = 0
+        elif element.startswith("MQ.11"):  # same beta-functions as in the nominal scenario at Q11
+            targets[element, column] = nominal_twiss.loc[element, column]
+        else:  # same beta-functions as in the bare waist at the IP and Q3
+            targets[element, column] = bare_twiss.loc[element, column]
+    return targets
+
+
 # ----- Apply a Different Config's Knobs ----- #
 
 
 def get_waist_shift_config_from_applied_existing_knobs(
-    madx: Madx, use_knobs_from: Path, beam: int, ip: int, qx: float, qy: float
+    madx: Madx,
+    use_knobs_from: Path,
+    beam: int,
+    ip: int,
+    qx: float,
+    qy: float,
+    calls_counter: Optional[MatchingCallsCounter] = None,
 ) -> BeamConfig:
     """
     Performs relevant matchings to improve the rigid waist shift at the provided *ip* for beam 1,
@@ -354,6 +698,8 @@ def get_waist_shift_config_from_applied_existing_knobs(
             waist shift.
         qy (float): the vertical tune to re-match to after applying the rigit
             waist shift.
+        calls_counter (MatchingCallsCounter): if provided, used to record the ``MAD-X`` calls of each
+            stage of the working point rematch, see `~.rematch_working_point`.
 
     Returns:
         A custom `~.BeamConfig` object containing: the result of a ``TWISS`` call as a `~tfs.TfsDataFrame`,
@@ -364,24 +710,34 @@ def get_waist_shift_config_from_applied_existing_knobs(
     # The waist shift is already applied when calling this function and there will be a rematching of the
     # working point later on so the only knobsfile called from the previous configuration is the independent
     # quadrupoles powering.
-    previous_conf_quads_knob_file: Path = use_knobs_from / f"BEAM{beam:d}" / "KNOBS" / "quadrupoles.madx"
-    logger.debug(f"Applying the knobs from '{previous_conf_quads_knob_file}' on this configuration")
-    madx.call(fullpath(previous_conf_quads_knob_file))
+    logger.debug(f"Applying the B{beam:d} quadrupoles knobs from '{use_knobs_from}' on this configuration")
+    with madx.batch():
+        madx.globals.update(RunResult(use_knobs_from).knobs(beam, "quadrupoles"))
 
     # Sanity check: use MQTs (minimal beta-beating impact) to get back to working point in case of drift
-    matching.match_tunes(madx, "lhc", f"lhcb{beam:d}", qx, qy, calls=200)
-    matching.match_chromaticities(madx, "lhc", f"lhcb{beam:d}", 2.0, 2.0, calls=200)
-    matching.match_tunes_and_chromaticities(madx, "lhc", f"lhcb{beam:d}", qx, qy, 2.0, 2.0, calls=200)
+    working_point_calls = rematch_working_point(madx, beam=beam, qx=qx, qy=qy, calls_counter=calls_counter)
     logger.debug(f"Managed to rematch B{beam:d} to Qx = {madx.table.summ.q1[0]} and Qy = {madx.table.summ.q2[0]}")
 
     # Query and return all the relevant knobs
     twiss_df = twiss.get_twiss_tfs(madx, chrom=True)
-    triplets_knobs = get_triplets_powering_knobs(madx, ip=ip)
-    quads_knobs = get_independent_quadrupoles_powering_knobs(madx, quad_numbers=VARIED_IR_QUADRUPOLES, ip=ip, beam=beam)
-    working_point_knobs = get_tunes_and_chroma_knobs(madx, beam=beam)
+    triplets_knobs, quads_knobs, working_point_knobs = get_all_powering_knobs(
+        madx, quad_numbers=VARIED_IR_QUADRUPOLES, ip=ip, beam=beam
+    )
     return BeamConfig(
         twiss_tfs=twiss_df,
         triplets_knobs=triplets_knobs,
         quads_knobs=quads_knobs,
         working_point_knobs=working_point_knobs,
+        working_point_calls=working_point_calls,
     )
+
+
+# ----- Helpers ----- #
+
+
+def _setup_nominal_beam(madx: Madx, energy: float, beam: int) -> None:
+    """Re-cycles the sequence of *beam* from ``MSIA.EXIT.B[12]``, creates the beams, sets up a flat orbit and uses the sequence."""
+    lhc.re_cycle_sequence(madx, sequence=f"lhcb{beam:d}", start=f"MSIA.EXIT.B{beam:d}")
+    lhc.make_lhc_beams(madx, energy=energy, emittance=3.75e-6)
+    _ = orbit.setup_lhc_orbit(madx, scheme="flat")
+    madx.command.use(sequence=f"lhcb{beam:d}")
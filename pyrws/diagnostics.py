@@ -0,0 +1,146 @@
+"""
+.. _diagnostics:
+
+Diagnostics
+-----------
+
+Module with functions to compare many configurations at once, for instance all the settings of a
+scan. The ``TWISS`` results are aligned on element names and stacked as one 2D array per column,
+with one row per configuration, from which beta-beatings, phase advance deltas and their summaries
+are computed for all configurations in a single vectorized pass.
+"""
+from dataclasses import dataclass
+from typing import Dict, List, Mapping, Sequence
+
+import numpy as np
+import pandas as pd
+
+from loguru import logger
+
+from pyrws.utils import betabeating
+
+# Columns stacked by default, which are the ones needed for all diagnostics of this module
+STACKED_COLUMNS: Sequence[str] = ("S", "BETX", "BETY", "MUX", "MUY")
+
+
+@dataclass
+class TwissStack:
+    """
+    ``TWISS`` results of several configurations aligned on the same elements. Each entry of *columns*
+    is an array of shape (number of configurations, number of elements), with rows in the order of
+    *labels* and columns in the order of *names*.
+    """
+
+    labels: List[str]
+    names: np.ndarray
+    columns: Dict[str, np.ndarray]
+
+    def __getitem__(self, column: str) -> np.ndarray:
+        return self.columns[column]
+
+    def row(self, label: str) -> int:
+        """Returns the row index of the configuration with the given *label*."""
+        return self.labels.index(label)
+
+
+def stack_twiss(dataframes: Mapping[str, pd.DataFrame], columns: Sequence[str] = STACKED_COLUMNS) -> TwissStack:
+    """
+    Aligns the provided ``TWISS`` dataframes on their element names and stacks the requested *columns*.
+    Only the elements present in all dataframes are kept, in the order of the first one. The values are
+    gathered directly from the underlying arrays, without copying any dataframe.
+
+    Args:
+        dataframes (Mapping[str, pd.DataFrame]): the ``TWISS`` dataframes, indexed by element ``NAME``
+            (as returned by `~pyhdtoolkit.cpymadtools.twiss.get_twiss_tfs`), for each configuration label.
+        columns (Sequence[str]): the columns to stack. Defaults to `~.STACKED_COLUMNS`.
+
+    Returns:
+        A `~.TwissStack` with the configurations in the order of *dataframes*.
+    """
+    labels = list(dataframes.keys())
+    if not labels:
+        raise ValueError("At least one dataframe is needed to stack")
+
+    names = dataframes[labels[0]].index
+    for dataframe in dataframes.values():
+        names = names[names.isin(dataframe.index)]
+    if len(names) < len(dataframes[labels[0]].index):
+        logger.warning(f"Only {len(names)} elements are common to all configurations, the others are dropped")
+
+    stacked = {column: np.empty((len(labels), len(names))) for column in columns}
+    for row, dataframe in enumerate(dataframes.values()):
+        indexer = dataframe.index.get_indexer(names)
+        for column in columns:
+            stacked[column][row] = dataframe[column].to_numpy()[indexer]
+    return TwissStack(labels=labels, names=names.to_numpy(), columns=stacked)
+
+
+def get_betabeatings(stack: TwissStack, reference: str) -> Dict[str, np.ndarray]:
+    """
+    Computes the horizontal and vertical beta-beatings of all configurations relative to the *reference* one.
+
+    Args:
+        stack (TwissStack): the stacked ``TWISS`` results, with ``BETX`` and ``BETY`` columns.
+        reference (str): the label of the reference configuration, typically the nominal one.
+
+    Returns:
+        A `dict` with ``BBX`` and ``BBY`` arrays of the same shape as the stacked columns.
+    """
+    row = stack.row(reference)
+    return {
+        "BBX": betabeating(stack["BETX"][row], stack["BETX"]),
+        "BBY": betabeating(stack["BETY"][row], stack["BETY"]),
+    }
+
+
+def get_phase_advance_deltas(stack: TwissStack, reference: str) -> Dict[str, np.ndarray]:
+    """
+    Computes the differences of the horizontal and vertical phase advances of all configurations to the
+    ones of the *reference* configuration.
+
+    Args:
+        stack (TwissStack): the stacked ``TWISS`` results, with ``MUX`` and ``MUY`` columns.
+        reference (str): the label of the reference configuration, typically the nominal one.
+
+    Returns:
+        A `dict` with ``DMUX`` and ``DMUY`` arrays of the same shape as the stacked columns, in [2pi].
+    """
+    row = stack.row(reference)
+    return {"DMUX": stack["MUX"] - stack["MUX"][row], "DMUY": stack["MUY"] - stack["MUY"][row]}
+
+
+def get_phase_differences(stack: TwissStack) -> np.ndarray:
+    """
+    Computes :math:`\\mu_x - \\mu_y` for all configurations, see `~pyrws.plotting.plot_phase_differences`.
+
+    Args:
+        stack (TwissStack): the stacked ``TWISS`` results, with ``MUX`` and ``MUY`` columns.
+
+    Returns:
+        An array of the same shape as the stacked columns, in [2pi].
+    """
+    return stack["MUX"] - stack["MUY"]
+
+
+def summarize(stack: TwissStack, reference: str) -> pd.DataFrame:
+    """
+    Computes the RMS and peak absolute values of the beta-beatings, of the phase advance deltas and of
+    the changes to :math:`\\mu_x - \\mu_y` relative to the *reference* configuration, for all configurations.
+
+    Args:
+        stack (TwissStack): the stacked ``TWISS`` results, with at least the `~.STACKED_COLUMNS`.
+        reference (str): the label of the reference configuration, typically the nominal one.
+
+    Returns:
+        A `~pandas.DataFrame` indexed by configuration label, with ``RMS_[quantity]`` and ``PEAK_[quantity]``
+        columns for each of ``BBX``, ``BBY``, ``DMUX``, ``DMUY`` and ``DPHASE``.
+    """
+    quantities = {**get_betabeatings(stack, reference), **get_phase_advance_deltas(stack, reference)}
+    phase_differences = get_phase_differences(stack)
+    quantities["DPHASE"] = phase_differences - phase_differences[stack.row(reference)]
+
+    summary = {}
+    for quantity, values in quantities.items():
+        summary[f"RMS_{quantity}"] = np.sqrt(np.mean(values**2, axis=1))
+        summary[f"PEAK_{quantity}"] = np.max(np.abs(values), axis=1)
+    return pd.DataFrame(summary, index=pd.Index(stack.labels, name="CONFIGURATION"))
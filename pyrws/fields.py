@@ -0,0 +1,121 @@
+"""
+.. _fields:
+
+Magnets Fields
+--------------
+
+Module with functions to determine the fields and powering of the magnets affected by the waist
+shift. These are computed with the formulas of the ``LHC`` optics toolkit's ``list_fields_currents``
+script, directly from the ``TWISS`` table of a configuration (which holds the strengths, maximum
+strengths and calibrations of all elements) instead of running one more ``TWISS`` with selections
+and deferred expression columns as `pyhdtoolkit.cpymadtools.lhc.get_magnets_powering` does.
+"""
+from functools import lru_cache
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+import tfs
+
+from cpymad.madx import Madx
+from loguru import logger
+
+from pyrws.constants import AFFECTED_ELEMENTS
+from pyrws.utils import get_globals_values
+
+# Columns of the fields tables, the same as the ones of pyhdtoolkit.cpymadtools.lhc.get_magnets_powering
+FIELDS_COLUMNS: List[str] = ["name", "keyword", "ampere", "imax", "percent", "kn", "kmax", "integrated_field", "l"]
+
+# TWISS columns summed into the total strength of an element, in the order of the toolkit script
+STRENGTH_COLUMNS: List[str] = [f"K{order}{skew}L" for order in range(6) for skew in ("", "S")] + ["HKICK", "VKICK"]
+
+_EPSILON = 1e-20  # same as in the toolkit script, to avoid divisions by zero
+
+
+@lru_cache(maxsize=None)
+def get_affected_elements(ip: int, beam: int) -> Tuple[str, ...]:
+    """
+    Returns the names of the magnets affected by the waist shift at the given *ip* for the given
+    *beam*, from `~pyrws.constants.AFFECTED_ELEMENTS` and in uppercase as in the ``TWISS`` tables
+    of the configurations. They are determined once per IP and beam.
+
+    Args:
+        ip (int): the IP at which the rigid waist shift is applied.
+        beam (int): the beam number, should be 1 or 2.
+
+    Returns:
+        A `tuple` of the element names.
+    """
+    return tuple(element.format(ip=ip, beam=beam).upper() for element in AFFECTED_ELEMENTS)
+
+
+def get_magnets_powering(
+    madx: Madx, twiss_tfs: tfs.TfsDataFrame, elements: Sequence[str], brho: Optional[float] = None
+) -> tfs.TfsDataFrame:
+    """
+    Returns the fields and powering of the provided *elements*, as computed by
+    `pyhdtoolkit.cpymadtools.lhc.get_magnets_powering` but from the provided ``TWISS`` table, in a
+    single vectorized pass. The table should have been computed in the current state of *madx*,
+    as the ``TWISS`` of a configuration is (see `~pyrws.core.BeamConfig`), and no ``TWISS`` is run.
+
+    .. note::
+        Elements are selected by their exact names (case-insensitive), and those which are not in
+        the table are skipped with a warning. As the feasibility checks rely on this table, an error
+        is raised if none of them is found, for instance with a sliced or renamed sequence.
+
+    Args:
+        madx (cpymad.madx.Madx): an instanciated `~cpymad.madx.Madx` object, to get the magnetic
+            rigidity from if *brho* is not provided.
+        twiss_tfs (tfs.TfsDataFrame): the ``TWISS`` table of the configuration, with uppercase
+            element names as index and uppercase columns, as given by `~.twiss.get_twiss_tfs`.
+        elements (Sequence[str]): the names of the elements to get the fields and powering of,
+            as given by `~.get_affected_elements`.
+        brho (float): optional, the magnetic rigidity in [Tm]. If not given, the ``brho`` quantity
+            defined in the ``MAD-X`` globals is used.
+
+    Returns:
+        A `~tfs.TfsDataFrame` with the `~.FIELDS_COLUMNS` for the selected elements, in the order of
+        the ``TWISS`` table, and the ``SUMM`` table of *twiss_tfs* as headers.
+
+    Raises:
+        ValueError: if none of the *elements* is in the ``TWISS`` table.
+    """
+    logger.debug("Computing magnets field and powering limits proportions")
+    if brho is None:
+        brho = get_globals_values(madx, ["brho"])["brho"]
+
+    index = twiss_tfs.index.str.upper()
+    rows = np.flatnonzero(index.isin([element.upper() for element in elements]))
+    if len(rows) == 0:
+        raise ValueError("None of the provided elements were found in the TWISS table")
+    found = set(index[rows])
+    missing = [element for element in elements if element.upper() not in found]
+    if missing:
+        logger.warning(f"Skipping {len(missing)} elements not found in the TWISS table: {', '.join(missing)}")
+    table = twiss_tfs.iloc[rows]
+    values = table[STRENGTH_COLUMNS + ["L", "LRAD", "KMAX", "CALIB"]].to_numpy(dtype=float)
+    strengths, (length, lrad, kmax, calib) = values[:, : len(STRENGTH_COLUMNS)], values[:, len(STRENGTH_COLUMNS) :].T
+
+    strength = strengths[:, 0].copy()
+    for column in strengths[:, 1:].T:  # summed one after the other as in MAD-X, for identical results
+        strength += column
+    length_eps, kmax_eps, calib_eps = length + lrad + _EPSILON, kmax + _EPSILON, calib + _EPSILON
+    kn = np.abs(strength) / length_eps
+    field = kn * brho
+
+    names = table.index.str.lower().rename(None)
+    fields = tfs.TfsDataFrame(
+        {
+            "name": names,
+            "keyword": table["KEYWORD"].to_numpy(),
+            "ampere": field / calib_eps,
+            "imax": kmax_eps / calib_eps,
+            "percent": field * 100 / (kmax_eps + _EPSILON),
+            "kn": kn,
+            "kmax": kmax,
+            "integrated_field": field * length_eps,
+            "l": length,
+        },
+        index=names,
+    )
+    fields.headers = dict(twiss_tfs.headers)
+    return fields
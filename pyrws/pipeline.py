@@ -0,0 +1,740 @@
+"""
+.. _pipeline:
+
+Knob Creation Pipeline
+----------------------
+
+Module with the different stages of the rigid waist shift knob creation, each running
+in its own `~cpymad.madx.Madx` instance, and the logic to schedule them as a dependency
+graph. The stages can be run one after the other in the current process, or concurrently
+in separate processes so that the total runtime is the one of the critical path.
+"""
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from contextlib import ExitStack, contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple, Union
+
+import pandas as pd
+import tfs
+
+from cpymad.madx import Madx
+from loguru import logger
+
+from pyhdtoolkit.cpymadtools import lhc
+from pyhdtoolkit.utils.contexts import timeit
+from pyhdtoolkit.utils.logging import config_logger
+from pyrws import profiling
+from pyrws.cache import NominalConfigCache, ResponseMatrixStore
+from pyrws.checks import format_powering_violations, get_powering_violations
+from pyrws.core import (
+    BeamConfig,
+    get_bare_waist_shift_beam1_config,
+    get_bare_waist_shift_beam2_config,
+    get_linearised_waist_shift_config,
+    get_matched_waist_shift_config,
+    get_nominal_beam_config,
+    get_nominal_ip_config,
+    get_split_tunes_globals,
+    get_waist_shift_config_from_applied_existing_knobs,
+)
+from pyrws.fields import get_affected_elements, get_magnets_powering
+from pyrws.response import get_response_matrix, get_waist_shift_observables
+from pyrws.runs import RunResult
+from pyrws.utils import (
+    CommandsCounter,
+    MatchingCallsCounter,
+    add_betabeating_columns,
+    fullpath,
+    get_globals_snapshot,
+    get_ip_directory,
+    restore_globals_snapshot,
+)
+
+_SESSIONS: Dict[Tuple[Path, Path, float, int], "MadxSession"] = {}  # sessions opened in the current process
+
+
+@dataclass
+class NominalResult:
+    config: BeamConfig
+    fields: tfs.TfsDataFrame
+    response: Optional[pd.DataFrame] = None  # response of the waist shift constraints to the quadrupoles knobs
+    split_tunes_globals: Optional[Dict[str, Union[float, str]]] = None  # starting point of the bare waist shift
+
+
+@dataclass
+class WaistShiftResult:
+    bare: Optional[BeamConfig]  # None if not applied, when the beam 1 waist shift was infeasible
+    matched: Optional[BeamConfig]  # None if the waist shift was infeasible
+    fields: Optional[tfs.TfsDataFrame]  # of the matched configuration
+    match_calls: Optional[int] = None  # MAD-X calls used by the improved waist shift matching, if done
+    bare_fields: Optional[tfs.TfsDataFrame] = None  # of the bare configuration, if checked for feasibility
+    infeasible: Optional[str] = None  # why the waist shift was deemed infeasible, if it was
+
+    @property
+    def feasible(self) -> bool:
+        """Whether the waist shift was deemed feasible, in which case it was improved."""
+        return self.infeasible is None
+
+
+@dataclass
+class Stage:
+    """
+    A unit of work in the pipeline. The *function* is called with the provided *kwargs*, and
+    for each entry of *depends_on* the result of the stage named by the value is given to the
+    function as the keyword argument named by the key. The value can also be a `tuple` of a
+    stage name and a key, in which case only the entry for this key of the stage's result (which
+    should then be a `dict`) is given. Stages sharing the same *affinity* are always run in the
+    same process, which lets them reuse a `~.MadxSession`.
+    """
+
+    name: str
+    function: Callable[..., Any]
+    kwargs: Dict[str, Any] = field(default_factory=dict)
+    depends_on: Dict[str, Union[str, Tuple[str, Any]]] = field(default_factory=dict)
+    affinity: Optional[str] = None
+
+    @property
+    def dependencies(self) -> List[str]:
+        """The names of the stages this stage depends on."""
+        return [dependency if isinstance(dependency, str) else dependency[0] for dependency in self.depends_on.values()]
+
+
+class MadxSession:
+    """
+    A `~cpymad.madx.Madx` instance in which the sequence and optics are loaded once, to be reused
+    by several stages for the same beam. The ``MAD-X`` commands and output of all stages are logged
+    to the ``session_b[12].madx`` and ``session_b[12].out`` files.
+
+    .. note::
+        Before each stage, the global variables are restored to their definitions right after loading
+        (see `~pyrws.utils.restore_globals_snapshot`), and each stage then re-cycles the sequence,
+        re-creates the beams, sets up the orbit and uses the sequence again (see
+        `~pyrws.core.get_nominal_beam_config`). The rest of the ``MAD-X`` state is shared between the
+        stages: variables they created (such as matching internals) are left as they are, tables they
+        computed are kept until overwritten, as are options and selections. The stages never read such
+        state from a previous stage, so their results are expected to match the ones in freshly loaded
+        instances, but this is not checked.
+    """
+
+    def __init__(self, workdir: Path, sequence: Path, opticsfile: Path, energy: float, beam: int):
+        logger.debug(f"Opening a MAD-X session for beam {beam:d}")
+        self._commands = (workdir / f"session_b{beam:d}.madx").open("w")
+        self._outputs = (workdir / f"session_b{beam:d}.out").open("w")
+        self.commands_counter = CommandsCounter(self._commands)
+        self.calls_counter = MatchingCallsCounter(self._outputs)
+        profiling.register_counters(self.commands_counter, self.calls_counter)
+        self.madx = Madx(command_log=self.commands_counter, stdout=self.calls_counter)
+        with profiling.section("sequence_load"):
+            _load_sequence_and_optics(self.madx, sequence, opticsfile, energy)
+        self._snapshot = get_globals_snapshot(self.madx)
+
+    def reset(self) -> None:
+        """Restores the globals to their definitions right after loading the sequence and optics."""
+        restore_globals_snapshot(self.madx, self._snapshot)
+
+    def close(self) -> None:
+        """Exits the ``MAD-X`` process and closes the log files."""
+        self.madx.quit()
+        self._commands.close()
+        self._outputs.close()
+
+
+# ----- Pipeline Stages ----- #
+
+
+def nominal_stage(
+    workdir: Path,
+    sequence: Path,
+    opticsfile: Path,
+    energy: float,
+    beam: int,
+    ip: int,
+    qx: float,
+    qy: float,
+    reuse_session: bool = False,
+    cache: Optional[NominalConfigCache] = None,
+    response_matrix: bool = False,
+    responses: Optional[ResponseMatrixStore] = None,
+) -> NominalResult:
+    """
+    In a `~cpymad.madx.Madx` instance with the provided *sequence* and *opticsfile* loaded,
+    determines the nominal configuration of the given *beam*, as well as the powering of the
+    magnets affected by the waist shift at the given *ip*.
+
+    Args:
+        workdir (Path): `~pathlib.Path` to the directory in which to write the ``MAD-X``
+            commands and output logs.
+        sequence (Path): `~pathlib.Path` to the LHC sequence file to use.
+        opticsfile (Path): `~pathlib.Path` to the LHC optics file to use.
+        energy (float): beam energy for the setup, in [GeV].
+        beam (int): the beam number, should be 1 or 2.
+        ip (int): the IP for which to prepare the waist shift knobs.
+        qx (float): the horizontal tune to match to.
+        qy (float): the vertical tune to match to.
+        reuse_session (bool): if `True`, runs in the `~.MadxSession` of this process for the given
+            *beam* (opening it if needed) instead of a fresh `~cpymad.madx.Madx` instance.
+        cache (NominalConfigCache): if provided, the result is loaded from this cache when available,
+            in which case ``MAD-X`` is not used at all, and stored in it otherwise.
+        response_matrix (bool): if `True`, also computes the response matrix of the improved waist
+            shift constraints to the independent IR quadrupoles powering knobs in the nominal
+            configuration, for use with the ``response`` engine of `~.waist_shift_stage`.
+        responses (ResponseMatrixStore): if provided, the response matrix is loaded from this store
+            when available, and stored in it otherwise. With a *cache* hit as well, ``MAD-X`` is not
+            used at all.
+
+    Returns:
+        A `~.NominalResult` with the nominal `~.BeamConfig`, the fields table of the affected
+        magnets and the response matrix if requested.
+    """
+    return nominal_ips_stage(
+        workdir,
+        sequence,
+        opticsfile,
+        energy,
+        beam=beam,
+        ips=(ip,),
+        qx=qx,
+        qy=qy,
+        reuse_session=reuse_session,
+        cache=cache,
+        response_matrix=response_matrix,
+        responses=responses,
+    )[ip]
+
+
+def nominal_ips_stage(
+    workdir: Path,
+    sequence: Path,
+    opticsfile: Path,
+    energy: float,
+    beam: int,
+    ips: Sequence[int],
+    qx: float,
+    qy: float,
+    reuse_session: bool = False,
+    cache: Optional[NominalConfigCache] = None,
+    response_matrix: bool = False,
+    responses: Optional[ResponseMatrixStore] = None,
+) -> Dict[int, NominalResult]:
+    """
+    Same as `~.nominal_stage` but for several IPs at once. The working point matching and ``TWISS``
+    of the nominal configuration do not depend on the IP, so they are done only once and only the
+    knobs, fields and eventual response matrix of each IP are determined on top of them (see
+    `~pyrws.core.get_nominal_ip_config`).
+
+    Args:
+        workdir (Path): `~pathlib.Path` to the directory in which to write the ``MAD-X``
+            commands and output logs.
+        sequence (Path): `~pathlib.Path` to the LHC sequence file to use.
+        opticsfile (Path): `~pathlib.Path` to the LHC optics file to use.
+        energy (float): beam energy for the setup, in [GeV].
+        beam (int): the beam number, should be 1 or 2.
+        ips (Sequence[int]): the IPs for which to prepare the waist shift knobs.
+        qx (float): the horizontal tune to match to.
+        qy (float): the vertical tune to match to.
+        reuse_session (bool): see `~.nominal_stage`.
+        cache (NominalConfigCache): see `~.nominal_stage`. ``MAD-X`` is not used at all if the results
+            of all *ips* are cached.
+        response_matrix (bool): see `~.nominal_stage`.
+        responses (ResponseMatrixStore): see `~.nominal_stage`.
+
+    Returns:
+        A `dict` with as keys the *ips* and as values their `~.NominalResult`, which all share the
+        same ``TWISS`` table.
+    """
+    keys: Dict[int, str] = {}
+    response_keys: Dict[int, str] = {}
+    cached: Dict[int, Any] = {}
+    loaded_responses: Dict[int, Optional[pd.DataFrame]] = {ip: None for ip in ips}
+    if cache is not None:
+        keys = {ip: cache.get_key(sequence, opticsfile, energy=energy, beam=beam, ip=ip, qx=qx, qy=qy) for ip in ips}
+        cached = {ip: cache.load(key) for ip, key in keys.items()}
+    if response_matrix and responses is not None:
+        response_keys = {ip: responses.get_key(sequence, opticsfile, energy=energy, beam=beam, ip=ip) for ip in ips}
+        loaded_responses = {ip: responses.load(key) for ip, key in response_keys.items()}
+    if all(cached.get(ip) is not None and (loaded_responses[ip] is not None or not response_matrix) for ip in ips):
+        logger.info(f"Using cached beam {beam:d} nominal configuration")
+        return {
+            ip: NominalResult(cached[ip][0], cached[ip][1], response=loaded_responses[ip], split_tunes_globals=cached[ip][2])
+            for ip in ips
+        }
+
+    logger.info(f"Preparing beam {beam:d} nominal configuration")
+    results: Dict[int, NominalResult] = {}
+    with _stage_madx(f"nominal_b{beam:d}", workdir, sequence, opticsfile, energy, beam, reuse_session) as (madx, calls_counter):
+        loaded = None if reuse_session else get_globals_snapshot(madx)  # a session has its own snapshot
+        with profiling.section("nominal"):
+            nominal = get_nominal_beam_config(
+                madx, energy=energy, beam=beam, ip=ips[0], qx=qx, qy=qy, calls_counter=calls_counter
+            )
+        for ip in ips:
+            config = nominal if ip == ips[0] else get_nominal_ip_config(madx, nominal, beam=beam, ip=ip)
+            with profiling.section("fields_query"):
+                nominal_fields = get_magnets_powering(madx, config.twiss_tfs, get_affected_elements(ip, beam))
+            response = loaded_responses[ip]
+            if response_matrix and response is None:
+                with profiling.section("response_matrix"), timeit(
+                    lambda spanned: logger.debug(f"Computed beam {beam:d} IP{ip:d} response matrix in {spanned:.2f} seconds")
+                ):
+                    response = get_response_matrix(
+                        madx, f"lhcb{beam:d}", knobs=list(config.quads_knobs), observables=get_waist_shift_observables(beam, ip)
+                    )
+                if responses is not None:
+                    metadata = dict(sequence=sequence, opticsfile=opticsfile, energy=energy, beam=beam, ip=ip)
+                    responses.save(response_keys[ip], response, **metadata)
+            results[ip] = NominalResult(config=config, fields=nominal_fields, response=response)
+
+        # The bare waist shifts start from a split tunes configuration, which depends neither on the IP nor on the
+        # setting: it is determined once here, from the same freshly loaded state they would rematch it from
+        if reuse_session:
+            _SESSIONS[(sequence, opticsfile, energy, beam)].reset()
+        else:
+            restore_globals_snapshot(madx, loaded)
+        with profiling.section("split_tunes"):
+            split_tunes_globals = get_split_tunes_globals(
+                madx, energy=energy, beam=beam, qx=qx, qy=qy, calls_counter=calls_counter
+            )
+        for result in results.values():
+            result.split_tunes_globals = split_tunes_globals
+
+    if cache is not None:
+        for ip, result in results.items():
+            metadata = dict(sequence=sequence, opticsfile=opticsfile, energy=energy, beam=beam, ip=ip)
+            cache.save(keys[ip], result.config, result.fields, split_tunes_globals=split_tunes_globals, **metadata)
+    return results
+
+
+def waist_shift_stage(
+    workdir: Path,
+    sequence: Path,
+    opticsfile: Path,
+    energy: float,
+    beam: int,
+    ip: int,
+    qx: float,
+    qy: float,
+    nominal: NominalResult,
+    waist_shift_setting: Optional[float] = None,
+    beam1_waist: Optional[WaistShiftResult] = None,
+    use_knobs_from: Optional[Path] = None,
+    warm_start_knobs: Optional[Dict[str, float]] = None,
+    engine: str = "match",
+    max_residual: float = 1e-4,
+    ir_segment: bool = False,
+    max_powering: Optional[float] = None,
+    reuse_session: bool = False,
+) -> WaistShiftResult:
+    """
+    In a `~cpymad.madx.Madx` instance with the provided *sequence* and *opticsfile* loaded, applies
+    the bare rigid waist shift for the given *beam* and then improves it (or applies the knobs
+    from a previous run), and returns the resulting configurations.
+
+    .. note::
+        For beam 1 the waist shift is applied from the unit *waist_shift_setting*, while for beam 2
+        the triplets powering from the *beam1_waist* result is applied, since the triplets powering
+        circuits are common to both beams.
+
+    .. note::
+        If *max_powering* is given and any affected magnet is powered beyond it in the bare waist
+        shift configuration, the waist shift is deemed infeasible and is not improved: the returned
+        result only holds the bare configuration, its fields and the reason. The beam 2 waist shift
+        is then infeasible too, and not even applied.
+
+    Args:
+        workdir (Path): `~pathlib.Path` to the directory in which to write the ``MAD-X``
+            commands and output logs.
+        sequence (Path): `~pathlib.Path` to the LHC sequence file to use.
+        opticsfile (Path): `~pathlib.Path` to the LHC optics file to use.
+        energy (float): beam energy for the setup, in [GeV].
+        beam (int): the beam number, should be 1 or 2.
+        ip (int): the IP at which to apply the rigid waist shift.
+        qx (float): the horizontal tune to match to.
+        qy (float): the vertical tune to match to.
+        nominal (NominalResult): the result of the `~.nominal_stage` for this *beam*.
+        waist_shift_setting (float): unit setting of the rigid waist shift, used for beam 1.
+        beam1_waist (WaistShiftResult): the result of this stage for beam 1, used for beam 2.
+        use_knobs_from (Path): if provided, the output directory of a previous run from which
+            to apply the quadrupoles knobs instead of rematching the waist shift.
+        warm_start_knobs (Dict[str, float]): if provided, independent quadrupoles powering knobs from
+            which to start the improved waist shift matching, typically from the solution of a close
+            waist shift setting.
+        engine (str): how to improve the waist shift, either ``match`` for the ``MAD-X`` matching
+            or ``response`` to solve from the response matrix in *nominal* (which should then have
+            been computed), falling back to the matching if the residual is above *max_residual*.
+            Defaults to ``match``.
+        max_residual (float): the highest accepted residual for the ``response`` engine.
+        ir_segment (bool): if `True`, the improved waist shift matching twisses the IR segment only,
+            see `~pyrws.core.get_matched_waist_shift_config`.
+        max_powering (float): if provided, the highest accepted powering of the affected magnets in the
+            bare waist shift configuration, in percent of their maximum powering.
+        reuse_session (bool): if `True`, runs in the `~.MadxSession` of this process for the given
+            *beam* (opening it if needed) instead of a fresh `~cpymad.madx.Madx` instance.
+
+    Returns:
+        A `~.WaistShiftResult` with the bare and matched `~.BeamConfig` objects, the fields table
+        of the affected magnets in the matched configuration and the number of ``MAD-X`` calls used
+        by the improved waist shift matching.
+    """
+    assert beam in (1, 2)
+    assert engine in ("match", "response")
+    if beam1_waist is not None and not beam1_waist.feasible:
+        logger.warning(f"Skipping beam {beam:d} waist shift at IP{ip:d}, as the beam 1 one is infeasible")
+        return WaistShiftResult(bare=None, matched=None, fields=None, infeasible=f"beam 1: {beam1_waist.infeasible}")
+
+    logger.info(f"Preparing beam {beam:d} waist shift configuration")
+    with _stage_madx(f"waist_b{beam:d}", workdir, sequence, opticsfile, energy, beam, reuse_session) as (madx, calls_counter):
+        with profiling.section("bare_waist"):
+            if beam == 1:
+                bare_waist = get_bare_waist_shift_beam1_config(
+                    madx,
+                    ip=ip,
+                    rigidty_waist_shift_value=waist_shift_setting,
+                    energy=energy,
+                    qx=qx,
+                    qy=qy,
+                    calls_counter=calls_counter,
+                    split_tunes_globals=nominal.split_tunes_globals,
+                )
+            else:
+                bare_waist = get_bare_waist_shift_beam2_config(
+                    madx,
+                    ip=ip,
+                    triplet_knobs=beam1_waist.matched.triplets_knobs,
+                    energy=energy,
+                    qx=qx,
+                    qy=qy,
+                    calls_counter=calls_counter,
+                    split_tunes_globals=nominal.split_tunes_globals,
+                )
+        bare_waist.twiss_tfs = add_betabeating_columns(bare_waist.twiss_tfs, nominal.config.twiss_tfs)
+
+        bare_fields = None
+        if max_powering is not None:
+            with profiling.section("feasibility"):
+                bare_fields = get_magnets_powering(madx, bare_waist.twiss_tfs, get_affected_elements(ip, beam))
+                violations = get_powering_violations(bare_fields, max_percent=max_powering)
+            if not violations.empty:
+                reason = format_powering_violations(violations, max_percent=max_powering)
+                logger.warning(f"Beam {beam:d} waist shift at IP{ip:d} is infeasible, skipping its improvement: {reason}")
+                return WaistShiftResult(bare=bare_waist, matched=None, fields=None, bare_fields=bare_fields, infeasible=reason)
+
+        match_calls = None
+        with profiling.section("improved_match"):
+            if use_knobs_from is not None:
+                logger.info("Using knobs from a provided previous run")
+                matched_waist = get_waist_shift_config_from_applied_existing_knobs(
+                    madx, use_knobs_from=use_knobs_from, beam=beam, ip=ip, qx=qx, qy=qy, calls_counter=calls_counter
+                )
+            else:
+                logger.info(f"Refining beam {beam:d} waist shift - this may take a while...")
+                calls_before = calls_counter.calls
+                if engine == "response":
+                    matched_waist = get_linearised_waist_shift_config(
+                        madx,
+                        beam=beam,
+                        ip=ip,
+                        nominal_twiss=nominal.config.twiss_tfs,
+                        bare_twiss=bare_waist.twiss_tfs,
+                        qx=qx,
+                        qy=qy,
+                        response=nominal.response,
+                        max_residual=max_residual,
+                        initial_quads_knobs=warm_start_knobs,
+                        ir_segment=ir_segment,
+                        calls_counter=calls_counter,
+                    )
+                else:
+                    matched_waist = get_matched_waist_shift_config(
+                        madx,
+                        beam=beam,
+                        ip=ip,
+                        nominal_twiss=nominal.config.twiss_tfs,
+                        bare_twiss=bare_waist.twiss_tfs,
+                        qx=qx,
+                        qy=qy,
+                        initial_quads_knobs=warm_start_knobs,
+                        ir_segment=ir_segment,
+                        calls_counter=calls_counter,
+                    )
+                match_calls = calls_counter.calls - calls_before
+                start = "warm" if warm_start_knobs is not None else "cold"
+                logger.info(f"Improved beam {beam:d} waist shift ({start} start) using {match_calls} MAD-X matching calls")
+        matched_waist.twiss_tfs = add_betabeating_columns(matched_waist.twiss_tfs, nominal.config.twiss_tfs)
+        with profiling.section("fields_query"):
+            matched_fields = get_magnets_powering(madx, matched_waist.twiss_tfs, get_affected_elements(ip, beam))
+    return WaistShiftResult(
+        bare=bare_waist, matched=matched_waist, fields=matched_fields, match_calls=match_calls, bare_fields=bare_fields
+    )
+
+
+def get_knobs_stages(
+    workdirs: Dict[int, Tuple[Path, Path]],
+    sequence: Path,
+    opticsfile: Path,
+    energy: float,
+    ips: Sequence[int],
+    qx: float,
+    qy: float,
+    waist_shift_setting: float,
+    use_knobs_from: Optional[Path] = None,
+    warm_start_from: Optional[Path] = None,
+    engine: str = "match",
+    max_residual: float = 1e-4,
+    ir_segment: bool = False,
+    max_powering: Optional[float] = None,
+    reuse_session: bool = False,
+    cache: Optional[NominalConfigCache] = None,
+    responses: Optional[ResponseMatrixStore] = None,
+) -> List[Stage]:
+    """
+    Builds the stage graph for the creation of the rigid waist shift knobs at the given *ips*. The
+    nominal configuration of each beam is determined once for all IPs, and the waist shifts at the
+    different IPs are independent of each other. At a given IP, the beam 1 waist shift only needs the
+    beam 1 nominal configuration, while the beam 2 waist shift also needs the triplets powering
+    determined for beam 1.
+
+    Args:
+        workdirs (Dict[int, Tuple[Path, Path]]): for each IP, `~pathlib.Path` to the directories for the
+            beam 1 and beam 2 ``MAD-X`` logs. The nominal stages log to the ones of the first IP.
+        sequence (Path): `~pathlib.Path` to the LHC sequence file to use.
+        opticsfile (Path): `~pathlib.Path` to the LHC optics file to use.
+        energy (float): beam energy for the setup, in [GeV].
+        ips (Sequence[int]): the IPs at which to apply the rigid waist shift.
+        qx (float): the horizontal tune to match to.
+        qy (float): the vertical tune to match to.
+        waist_shift_setting (float): unit setting of the rigid waist shift.
+        use_knobs_from (Path): if provided, the output directory of a previous run (for the same *ips*)
+            from which to apply the quadrupoles knobs instead of rematching the waist shift.
+        warm_start_from (Path): if provided, the output directory of a previous run (for the same *ips*,
+            typically for a close waist shift setting) from which to load the quadrupoles knobs to start
+            the improved waist shift matching from.
+        engine (str): how to improve the waist shift, see `~.waist_shift_stage`. With ``response``,
+            the response matrices are computed in the nominal stages.
+        max_residual (float): the highest accepted residual for the ``response`` engine.
+        ir_segment (bool): if `True`, the improved waist shift matchings twiss the IR segment only.
+        max_powering (float): if provided, the highest accepted powering of the affected magnets in the bare
+            waist shift configurations, see `~.waist_shift_stage`.
+        reuse_session (bool): if `True`, the stages of a given beam and IP run in the same process and
+            reuse a single `~.MadxSession` instead of loading the sequence and optics for each of them.
+        cache (NominalConfigCache): if provided, the cache from which to load and in which to store
+            the nominal configurations.
+        responses (ResponseMatrixStore): if provided, the store from which to load and in which to
+            save the response matrices for the ``response`` engine.
+
+    Returns:
+        A `list` of the `~.Stage` objects to execute, named ``nominal_b1`` and ``nominal_b2`` (with the
+        results for all IPs) and ``waist_b1_ip[n]`` and ``waist_b2_ip[n]`` for each IP.
+    """
+    common = dict(sequence=sequence, opticsfile=opticsfile, energy=energy, qx=qx, qy=qy, reuse_session=reuse_session)
+    nominal_kwargs = dict(ips=ips, cache=cache, response_matrix=engine == "response", responses=responses, **common)
+    waist_kwargs = dict(engine=engine, max_residual=max_residual, ir_segment=ir_segment, max_powering=max_powering, **common)
+    stages: List[Stage] = []
+    for beam in (1, 2):
+        stages.append(
+            Stage(
+                f"nominal_b{beam:d}",
+                nominal_ips_stage,
+                kwargs=dict(workdir=workdirs[ips[0]][beam - 1], beam=beam, **nominal_kwargs),
+                affinity=f"b{beam:d}_ip{ips[0]:d}" if reuse_session else None,
+            )
+        )
+        for ip in ips:
+            warm_start = None
+            if warm_start_from is not None:
+                warm_start = RunResult(get_ip_directory(warm_start_from, ip, ips)).knobs(beam, "quadrupoles")
+            depends_on = {"nominal": (f"nominal_b{beam:d}", ip)}
+            if beam == 2:
+                depends_on["beam1_waist"] = f"waist_b1_ip{ip:d}"
+            stages.append(
+                Stage(
+                    f"waist_b{beam:d}_ip{ip:d}",
+                    waist_shift_stage,
+                    kwargs=dict(
+                        workdir=workdirs[ip][beam - 1],
+                        beam=beam,
+                        ip=ip,
+                        waist_shift_setting=waist_shift_setting if beam == 1 else None,
+                        use_knobs_from=get_ip_directory(use_knobs_from, ip, ips) if use_knobs_from is not None else None,
+                        warm_start_knobs=warm_start,
+                        **waist_kwargs,
+                    ),
+                    depends_on=depends_on,
+                    affinity=f"b{beam:d}_ip{ip:d}" if reuse_session else None,
+                )
+            )
+    return stages
+
+
+# ----- Scheduling ----- #
+
+
+def run_stages(
+    stages: Sequence[Stage],
+    parallel: bool = False,
+    processes: Optional[int] = None,
+    loglevel: str = "info",
+    on_completed: Optional[Callable[[str, Any], None]] = None,
+) -> Dict[str, Any]:
+    """
+    Executes the provided *stages*, respecting their dependencies.
+
+    .. note::
+        In sequential mode the stages are run in the current process, in the order they are
+        provided in (as long as it respects the dependencies). In parallel mode each stage is
+        submitted to a pool of worker processes as soon as all its dependencies have completed,
+        and the total runtime becomes the one of the critical path of the graph. Stages with an
+        *affinity* are submitted to a dedicated single worker process for this affinity.
+
+    .. note::
+        Any `~.MadxSession` opened by the stages is closed once all stages have completed.
+
+    .. note::
+        Each stage is profiled in a `~pyrws.profiling.section` named after it, and the records
+        of the worker processes are gathered in the ones of the current process.
+
+    Args:
+        stages (Sequence[Stage]): the `~.Stage` objects to execute.
+        parallel (bool): whether to execute independent stages concurrently in separate processes.
+            Defaults to `False`.
+        processes (int): the maximum number of worker processes to use in parallel mode. Defaults
+            to `None`, which means one per stage.
+        loglevel (str): the logging level to configure in the worker processes. Defaults to ``info``.
+        on_completed (Callable): if provided, called in the current process with the name and result
+            of each stage as soon as it completes, for instance to start using them while the other
+            stages still run.
+
+    Returns:
+        A `dict` with as keys the stage names and as values their results.
+    """
+    _check_stage_graph(stages)
+    ordered_stages = _topological_order(stages)  # also raises on dependency cycles
+    results: Dict[str, Any] = {}
+
+    if not parallel:
+        try:
+            for stage in ordered_stages:
+                with profiling.section(stage.name), timeit(
+                    lambda spanned, name=stage.name: logger.debug(f"Stage '{name}' ran in {spanned:.2f} seconds")
+                ):
+                    results[stage.name] = stage.function(**_stage_kwargs(stage, results))
+                if on_completed is not None:
+                    on_completed(stage.name, results[stage.name])
+        finally:
+            close_sessions()
+        return results
+
+    pending: List[Stage] = list(ordered_stages)
+    running: Dict[Future, Stage] = {}
+    logger.debug(f"Running {len(stages)} stages in parallel")
+    with ExitStack() as executors:
+        pool = executors.enter_context(
+            ProcessPoolExecutor(max_workers=processes or len(stages), initializer=config_logger, initargs=(loglevel,))
+        )
+        dedicated = {
+            affinity: executors.enter_context(ProcessPoolExecutor(max_workers=1, initializer=config_logger, initargs=(loglevel,)))
+            for affinity in {stage.affinity for stage in stages if stage.affinity is not None}
+        }
+        try:
+            while pending or running:
+                for stage in [stage for stage in pending if all(dep in results for dep in stage.dependencies)]:
+                    logger.debug(f"Submitting stage '{stage.name}'")
+                    executor = dedicated.get(stage.affinity, pool)
+                    running[executor.submit(_run_profiled, stage.name, stage.function, _stage_kwargs(stage, results))] = stage
+                    pending.remove(stage)
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage = running.pop(future)
+                    results[stage.name], records = future.result()  # raises here if the stage failed
+                    profiling.add_records(records)
+                    logger.debug(f"Stage '{stage.name}' completed")
+                    if on_completed is not None:
+                        on_completed(stage.name, results[stage.name])
+        finally:
+            wait([executor.submit(close_sessions) for executor in dedicated.values()])
+    return results
+
+
+def close_sessions() -> None:
+    """Closes all the `~.MadxSession` objects opened in the current process."""
+    while _SESSIONS:
+        _, session = _SESSIONS.popitem()
+        session.close()
+
+
+# ----- Helpers ----- #
+
+
+def _load_sequence_and_optics(madx: Madx, sequence: Path, opticsfile: Path, energy: float) -> None:
+    """Calls the *sequence* and *opticsfile* in *madx*, with the beams defined in between."""
+    madx.option(echo=False, warn=False)
+    madx.call(fullpath(sequence))
+    lhc.make_lhc_beams(madx, energy=energy)  # needs to be defined here if we call acc-models opticsfiles
+    madx.call(fullpath(opticsfile))  # needs defined beams if we call acc-models opticsfiles
+
+
+@contextmanager
+def _stage_madx(
+    name: str, workdir: Path, sequence: Path, opticsfile: Path, energy: float, beam: int, reuse_session: bool
+) -> Iterator[Tuple[Madx, MatchingCallsCounter]]:
+    """
+    Yields a `~cpymad.madx.Madx` instance with the *sequence* and *opticsfile* loaded for a stage, and
+    the `~pyrws.utils.MatchingCallsCounter` of its output. This is either the reset `~.MadxSession` of
+    the current process for this *beam*, or a fresh instance logging to ``name.madx`` and ``name.out``
+    files in *workdir* and closed when leaving the context.
+    """
+    if reuse_session:
+        key = (sequence, opticsfile, energy, beam)
+        if key not in _SESSIONS:
+            _SESSIONS[key] = MadxSession(workdir, sequence, opticsfile, energy, beam)
+        _SESSIONS[key].reset()
+        yield _SESSIONS[key].madx, _SESSIONS[key].calls_counter
+    else:
+        with (workdir / f"{name}.madx").open("w") as commands, (workdir / f"{name}.out").open("w") as outputs:
+            commands_counter, calls_counter = CommandsCounter(commands), MatchingCallsCounter(outputs)
+            profiling.register_counters(commands_counter, calls_counter)
+            with Madx(command_log=commands_counter, stdout=calls_counter) as madx:
+                with profiling.section("sequence_load"):
+                    _load_sequence_and_optics(madx, sequence, opticsfile, energy)
+                yield madx, calls_counter
+
+
+def _run_profiled(name: str, function: Callable[..., Any], kwargs: Dict[str, Any]) -> Tuple[Any, List[Dict[str, Any]]]:
+    """Runs a stage in a worker process, and returns its result and profiling records to the main process."""
+    with profiling.worker_records() as records, profiling.section(name), timeit(
+        lambda spanned: logger.debug(f"Stage '{name}' ran in {spanned:.2f} seconds")
+    ):
+        result = function(**kwargs)
+    return result, records
+
+
+def _stage_kwargs(stage: Stage, results: Dict[str, Any]) -> Dict[str, Any]:
+    """Returns the keyword arguments for *stage*, including the results of its dependencies."""
+    kwargs = dict(stage.kwargs)
+    for kwarg, dependency in stage.depends_on.items():
+        kwargs[kwarg] = results[dependency] if isinstance(dependency, str) else results[dependency[0]][dependency[1]]
+    return kwargs
+
+
+def _check_stage_graph(stages: Sequence[Stage]) -> None:
+    """Ensures stage names are unique and all dependencies refer to provided stages."""
+    names = [stage.name for stage in stages]
+    if len(names) != len(set(names)):
+        raise ValueError(f"Stage names should be unique, got {names}")
+    for stage in stages:
+        unknown = set(stage.dependencies) - set(names)
+        if unknown:
+            raise ValueError(f"Stage '{stage.name}' depends on unknown stages {sorted(unknown)}")
+
+
+def _topological_order(stages: Sequence[Stage]) -> List[Stage]:
+    """Returns the *stages* ordered so that each comes after its dependencies, keeping the given order otherwise."""
+    ordered: List[Stage] = []
+    pending = list(stages)
+    while pending:
+        ready = [stage for stage in pending if all(dep in {s.name for s in ordered} for dep in stage.dependencies)]
+        if not ready:
+            raise ValueError(f"Dependency cycle between stages {[stage.name for stage in pending]}")
+        ordered.append(ready[0])
+        pending.remove(ready[0])
+    return ordered
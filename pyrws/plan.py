@@ -0,0 +1,198 @@
+"""
+.. _plan:
+
+Run Planning
+------------
+
+Module to estimate the duration of a run before launching it, from the timings recorded by previous
+runs (see `~pyrws.profiling.write_timings`). The stage graph that would be executed is laid out with
+the recorded duration of each stage, taking into account the stages which would be served from the
+nominal configurations cache, and its critical path is determined. Nothing is computed and ``MAD-X``
+is never started.
+"""
+import json
+import re
+
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from loguru import logger
+from rich.console import Console
+from rich.table import Table
+
+from pyrws.pipeline import Stage, _topological_order, nominal_ips_stage, nominal_stage
+
+# Sections of the runs timings holding the stages, and the ones after them
+STAGES_SECTIONS: Tuple[str, ...] = ("madx_stages", "scan_stages")
+FINAL_SECTIONS: Tuple[str, ...] = ("writes", "plots")
+
+
+@dataclass
+class StagePlan:
+    """
+    The planned execution of a stage. The *estimate* is `None` if no duration was recorded for this
+    kind of stage, in which case it counts as 0 in *start* and *finish*, which are relative to the
+    start of the run. The *critical* flag marks stages on the critical path of the run.
+    """
+
+    name: str
+    depends_on: List[str]
+    cached: bool
+    estimate: Optional[float]
+    start: float = 0
+    finish: float = 0
+    critical: bool = False
+
+
+@dataclass
+class RunPlan:
+    """The planned stages of a run, in execution order, and the estimates of the final sections after them."""
+
+    stages: List[StagePlan]
+    final_sections: Dict[str, Optional[float]] = field(default_factory=dict)
+    parallel: bool = False
+
+    @property
+    def critical_path(self) -> List[str]:
+        """The names of the stages on the critical path of the run."""
+        return [stage.name for stage in self.stages if stage.critical]
+
+    @property
+    def duration(self) -> float:
+        """The estimated total duration of the run, in [s]."""
+        stages_end = max((stage.finish for stage in self.stages), default=0)
+        return stages_end + sum(estimate or 0 for estimate in self.final_sections.values())
+
+
+def load_recorded_durations(timings_files: Sequence[Path], ips: int = 1) -> Dict[str, List[float]]:
+    """
+    Gathers the wall times recorded for each kind of stage in the provided timings files. Stage kinds
+    are the stage names without their eventual ``_ip[n]`` suffix, and with a ``[cached]`` suffix for
+    nominal stages which were served from the cache (with no ``nominal`` sub-section recorded). The
+    final sections are also gathered, scaled from the number of IPs of the recorded run to *ips*.
+
+    Args:
+        timings_files (Sequence[Path]): `~pathlib.Path` to the ``timings.json`` files of previous runs.
+        ips (int): the number of IPs of the run to plan, to scale the final sections for. Defaults to 1.
+
+    Returns:
+        A `dict` with as keys the stage kinds and final sections, and as values their recorded wall times.
+    """
+    durations: Dict[str, List[float]] = {}
+    for timings_file in timings_files:
+        logger.debug(f"Loading recorded timings from '{timings_file}'")
+        sections = {record["name"]: record["wall_time"] for record in json.loads(Path(timings_file).read_text())["sections"]}
+        stages = [name.split("/") for name in sections if len(name.split("/")) == 2 and name.split("/")[0] in STAGES_SECTIONS]
+        for parent, stage in stages:
+            kind = get_stage_kind(stage)
+            if stage.startswith("nominal") and f"{parent}/{stage}/nominal" not in sections:
+                kind += "[cached]"
+            durations.setdefault(kind, []).append(sections[f"{parent}/{stage}"])
+        recorded_ips = len({match.group() for _, stage in stages if (match := re.search(r"_ip\d+$", stage))}) or 1
+        for name in FINAL_SECTIONS:
+            if name in sections:
+                durations.setdefault(name, []).append(sections[name] * ips / recorded_ips)
+    return durations
+
+
+def get_stage_kind(name: str) -> str:
+    """Returns the kind of the stage named *name*, which is its name without the eventual ``_ip[n]`` suffix."""
+    return re.sub(r"_ip\d+$", "", name)
+
+
+def is_served_from_cache(stage: Stage) -> bool:
+    """
+    Whether *stage* would be served from the nominal configurations cache (and response matrices store if
+    needed) without starting ``MAD-X``, which is only possible for nominal stages given a cache.
+    """
+    if stage.function not in (nominal_stage, nominal_ips_stage) or stage.kwargs.get("cache") is None:
+        return False
+    kwargs = stage.kwargs
+    cache, responses = kwargs["cache"], kwargs.get("responses")
+    inputs = dict(sequence=kwargs["sequence"], opticsfile=kwargs["opticsfile"], energy=kwargs["energy"], beam=kwargs["beam"])
+    for ip in kwargs.get("ips") or (kwargs["ip"],):
+        if cache.get_key(qx=kwargs["qx"], qy=kwargs["qy"], ip=ip, **inputs) not in cache:
+            return False
+        if kwargs.get("response_matrix") and (responses is None or responses.get_key(ip=ip, **inputs) not in responses):
+            return False
+    return True
+
+
+def plan_stages(
+    stages: Sequence[Stage],
+    durations: Dict[str, List[float]],
+    parallel: bool = False,
+    final_sections: Sequence[str] = FINAL_SECTIONS,
+) -> RunPlan:
+    """
+    Lays out the execution of the provided *stages* with the median of their recorded *durations*. In
+    parallel mode each stage starts as soon as its dependencies finished (as with one process per stage,
+    the default of `~pyrws.pipeline.run_stages`), and otherwise they run one after the other. The critical
+    path is the chain of dependencies which finishes last in parallel mode, and all stages otherwise.
+
+    Args:
+        stages (Sequence[Stage]): the `~pyrws.pipeline.Stage` objects that would be executed.
+        durations (Dict[str, List[float]]): the recorded wall times, as given by `~.load_recorded_durations`.
+        parallel (bool): whether the stages would be run in parallel. Defaults to `False`.
+        final_sections (Sequence[str]): the sections after the stages to estimate too.
+
+    Returns:
+        A `~.RunPlan` with the planned stages in execution order.
+    """
+    plans: Dict[str, StagePlan] = {}
+    elapsed = 0.0
+    for stage in _topological_order(stages):
+        cached = is_served_from_cache(stage)
+        kind = get_stage_kind(stage.name) + ("[cached]" if cached else "")
+        estimate = float(np.median(durations[kind])) if durations.get(kind) else None
+        start = max((plans[dependency].finish for dependency in stage.dependencies), default=0) if parallel else elapsed
+        plans[stage.name] = StagePlan(
+            name=stage.name,
+            depends_on=stage.dependencies,
+            cached=cached,
+            estimate=estimate,
+            start=start,
+            finish=start + (estimate or 0),
+        )
+        elapsed = plans[stage.name].finish
+
+    if parallel:  # walk back from the stage finishing last, through the dependency finishing last each time
+        current = max(plans.values(), key=lambda plan: plan.finish, default=None)
+        while current is not None:
+            current.critical = True
+            current = max((plans[dependency] for dependency in current.depends_on), key=lambda plan: plan.finish, default=None)
+    else:  # one after the other, all stages are on the critical path
+        for plan in plans.values():
+            plan.critical = True
+
+    final_estimates = {name: float(np.median(durations[name])) if durations.get(name) else None for name in final_sections}
+    return RunPlan(stages=list(plans.values()), final_sections=final_estimates, parallel=parallel)
+
+
+def print_plan(plan: RunPlan, console: Optional[Console] = None) -> None:
+    """Prints the provided *plan* as a table, followed by its estimated total duration and critical path."""
+    console = console or Console()
+    table = Table(title=f"Planned stages ({'parallel' if plan.parallel else 'sequential'})")
+    for column in ("Stage", "Depends on", "Cached", "Estimate [s]", "Start [s]", "Finish [s]"):
+        table.add_column(column, justify="left" if column in ("Stage", "Depends on") else "right")
+    for stage in plan.stages:
+        table.add_row(
+            f"[bold]{stage.name}[/bold]" if stage.critical else stage.name,
+            ", ".join(stage.depends_on) or "-",
+            "yes" if stage.cached else "no",
+            f"{stage.estimate:.1f}" if stage.estimate is not None else "unknown",
+            f"{stage.start:.1f}",
+            f"{stage.finish:.1f}",
+        )
+    for name, estimate in plan.final_sections.items():
+        table.add_row(name, "all stages", "-", f"{estimate:.1f}" if estimate is not None else "unknown", "", "")
+    console.print(table)
+    console.print(f"Critical path: {' -> '.join(plan.critical_path)}")
+    console.print(f"Estimated duration: {plan.duration:.1f} seconds")
+    unknown = [stage.name for stage in plan.stages if stage.estimate is None]
+    unknown += [name for name, estimate in plan.final_sections.items() if estimate is None]
+    if unknown:
+        logger.warning(f"No recorded timings for {', '.join(unknown)}, which are not included in the estimate")
@@ -6,16 +6,29 @@ Plotting Functions
 
 Module with functions to create different plots relevant to the rigid waist shift configurations.
 """
+from typing import Optional, Tuple
+
 import matplotlib
+import numpy as np
 import pandas as pd
 
 from loguru import logger
 from matplotlib import pyplot as plt
 
+# How lines are drawn: every point as vectors, only the extrema of each bin along S as vectors (so
+# peaks remain visible), or every point but rasterized in the vector output formats
+PLOT_MODES: Tuple[str, ...] = ("full", "decimated", "rasterized")
+
 # ----- Beta-Beating Plotters ----- #
 
 
-def plot_waist_shift_betabeatings(axis: matplotlib.axes.Axes, dataframe: pd.DataFrame, show_ips: bool = False) -> None:
+def plot_waist_shift_betabeatings(
+    axis: matplotlib.axes.Axes,
+    dataframe: pd.DataFrame,
+    show_ips: bool = False,
+    mode: str = "full",
+    max_points: Optional[int] = None,
+) -> None:
     """Plots the horizontal and vertical beta-beatings on the given *axis*.
 
     .. note::
@@ -28,23 +41,32 @@ def plot_waist_shift_betabeatings(axis: matplotlib.axes.Axes, dataframe: pd.Data
             the longitudinal coordinate ``S``.
         show_ips (bool): if `True`, will show the IPs locations with vertical lines on the plot.
             Defaults to `False`.
+        mode (str): how to draw the data, one of `~.PLOT_MODES`. Defaults to ``full``.
+        max_points (int): the maximum number of points per line in ``decimated`` mode. Defaults
+            to two per horizontal pixel of the *axis*.
     """
     logger.debug("Plotting waist shift induced beta-beating.")
-    axis.plot(
+    _plot(
+        axis,
         dataframe.S,
         100 * dataframe.BBX,
         "o",
         ls="",
         mfc="none",
         label=r"$\Delta \beta_x / \beta_x$",
+        mode=mode,
+        max_points=max_points,
     )
-    axis.plot(
+    _plot(
+        axis,
         dataframe.S,
         100 * dataframe.BBY,
         "o",
         ls="",
         mfc="none",
         label=r"$\Delta \beta_y / \beta_y$",
+        mode=mode,
+        max_points=max_points,
     )
 
     if show_ips:
@@ -61,6 +83,8 @@ def plot_waist_shift_betabeatings_comparison(
     after: pd.DataFrame,
     column: str = "BBX",
     show_ips: bool = False,
+    mode: str = "full",
+    max_points: Optional[int] = None,
 ) -> None:
     """Plots the before and after matching beta-beatings on the given *axis*.
 
@@ -80,17 +104,25 @@ def plot_waist_shift_betabeatings_comparison(
             for the horizontal beta-beating.
         show_ips (bool): if `True`, will show the IPs locations with vertical lines on the plot.
             Defaults to `False`.
+        mode (str): how to draw the data, one of `~.PLOT_MODES`. Defaults to ``full``.
+        max_points (int): the maximum number of points per line in ``decimated`` mode. Defaults
+            to two per horizontal pixel of the *axis*.
     """
     assert column in ("BBX", "BBY")
     logger.debug("Plotting waist shift induced beta-beating before and after matching.")
-    axis.plot(before.S, 100 * before[column], "o", ls="", mfc="none", label="Bare Waist Shift")
-    axis.plot(
+    _plot(
+        axis, before.S, 100 * before[column], "o", ls="", mfc="none", label="Bare Waist Shift", mode=mode, max_points=max_points
+    )
+    _plot(
+        axis,
         after.S,
         100 * after[column],
         "o",
         ls="",
         mfc="none",
         label="Improved Waist Shift",
+        mode=mode,
+        max_points=max_points,
     )
 
     if show_ips:
@@ -111,6 +143,8 @@ def plot_betas_comparison(
     after: pd.DataFrame,
     column: str = "BETX",
     show_ips: bool = False,
+    mode: str = "full",
+    max_points: Optional[int] = None,
 ) -> None:
     """
     Plots the ..math:`\beta` functions across the machine for the nominal, bare waist shift
@@ -128,29 +162,41 @@ def plot_betas_comparison(
             for the horizontal beta-functions.
         show_ips (bool): if `True`, will show the IPs locations with vertical lines on the plot.
             Defaults to `False`.
+        mode (str): how to draw the data, one of `~.PLOT_MODES`. Defaults to ``full``.
+        max_points (int): the maximum number of points per line in ``decimated`` mode. Defaults
+            to two per horizontal pixel of the *axis*.
     """
     assert column in ("BETX", "BETY")
     logger.debug("Plotting beta functions for nominal, bare waist shift and improved waist shift scenarii.")
-    axis.plot(
+    _plot(
+        axis,
         nominal.S,
         nominal[column],
         ls="--",
         mfc="none",
         label=r"$\beta_x^{nominal}$" if column == "BETX" else r"$\beta_y^{nominal}$",
+        mode=mode,
+        max_points=max_points,
     )
-    axis.plot(
+    _plot(
+        axis,
         before.S,
         before[column],
         ls="--",
         mfc="none",
         label=r"$\beta_x^{bare}$" if column == "BETX" else r"$\beta_y^{bare}$",
+        mode=mode,
+        max_points=max_points,
     )
-    axis.plot(
+    _plot(
+        axis,
         after.S,
         after[column],
         ls="--",
         mfc="none",
         label=r"$\beta_x^{improved}$" if column == "BETX" else r"$\beta_y^{improved}$",
+        mode=mode,
+        max_points=max_points,
     )
 
     if show_ips:
@@ -167,6 +213,8 @@ def plot_betas_deviation(
     after: pd.DataFrame,
     column: str = "BETX",
     show_ips: bool = False,
+    mode: str = "full",
+    max_points: Optional[int] = None,
 ) -> None:
     """
     Plots the ..math:`\beta` functions deviation from the nominal case across the machine for
@@ -184,22 +232,31 @@ def plot_betas_deviation(
             for the horizontal beta-functions.
         show_ips (bool): if `True`, will show the IPs locations with vertical lines on the plot.
             Defaults to `False`.
+        mode (str): how to draw the data, one of `~.PLOT_MODES`. Defaults to ``full``.
+        max_points (int): the maximum number of points per line in ``decimated`` mode. Defaults
+            to two per horizontal pixel of the *axis*.
     """
     assert column in ("BETX", "BETY")
     logger.debug("Plotting beta functions deviation from nominal, for bare waist shift and improved waist shift scenarii.")
-    axis.plot(
+    _plot(
+        axis,
         before.S,
         before[column] - nominal[column],
         ls="--",
         mfc="none",
         label=r"$\Delta \beta_x^{bare}$" if column == "BETX" else r"$\Delta \beta_y^{bare}$",
+        mode=mode,
+        max_points=max_points,
     )
-    axis.plot(
+    _plot(
+        axis,
         after.S,
         after[column] - nominal[column],
         ls="--",
         mfc="none",
         label=r"$\Delta \beta_x^{improved}$" if column == "BETX" else r"$\Delta \beta_y^{improved}$",
+        mode=mode,
+        max_points=max_points,
     )
 
     if show_ips:
@@ -219,6 +276,8 @@ def plot_phase_advances_comparison(
     after: pd.DataFrame,
     column: str = "MUX",
     show_ips: bool = False,
+    mode: str = "full",
+    max_points: Optional[int] = None,
 ) -> None:
     """
     Plots the phase advances (..math:`\mu_{x,y}`) across the machine for the nominal, bare waist
@@ -236,29 +295,41 @@ def plot_phase_advances_comparison(
             for the horizontal phase advances.
         show_ips (bool): if `True`, will show the IPs locations with vertical lines on the plot.
             Defaults to `False`.
+        mode (str): how to draw the data, one of `~.PLOT_MODES`. Defaults to ``full``.
+        max_points (int): the maximum number of points per line in ``decimated`` mode. Defaults
+            to two per horizontal pixel of the *axis*.
     """
     assert column in ("MUX", "MUY")
     logger.debug("Plotting phase advances for nominal, bare waist shift and improved waist shift scenarii.")
-    axis.plot(
+    _plot(
+        axis,
         nominal.S,
         nominal[column],
         ls="--",
         mfc="none",
         label=r"$\mu_x^{nominal}$" if column == "MUX" else r"$\mu_y^{nominal}$",
+        mode=mode,
+        max_points=max_points,
     )
-    axis.plot(
+    _plot(
+        axis,
         before.S,
         before[column],
         ls="--",
         mfc="none",
         label=r"$\mu_x^{bare}$" if column == "MUX" else r"$\mu_y^{bare}$",
+        mode=mode,
+        max_points=max_points,
     )
-    axis.plot(
+    _plot(
+        axis,
         after.S,
         after[column],
         ls="--",
         mfc="none",
         label=r"$\mu_x^{improved}$" if column == "MUX" else r"$\mu_y^{improved}$",
+        mode=mode,
+        max_points=max_points,
     )
 
     if show_ips:
@@ -274,6 +345,8 @@ def plot_phase_differences(
     before: pd.DataFrame,
     after: pd.DataFrame,
     show_ips: bool = False,
+    mode: str = "full",
+    max_points: Optional[int] = None,
 ) -> None:
     """
     Plots the phase advances (..math:`\mu_{x,y}`) across the machine for the nominal, bare waist
@@ -295,16 +368,24 @@ def plot_phase_differences(
             for the horizontal phase advances.
         show_ips (bool): if `True`, will show the IPs locations with vertical lines on the plot.
             Defaults to `False`.
+        mode (str): how to draw the data, one of `~.PLOT_MODES`. Defaults to ``full``.
+        max_points (int): the maximum number of points per line in ``decimated`` mode. Defaults
+            to two per horizontal pixel of the *axis*.
     """
     logger.debug("Plotting phase advances for nominal, bare waist shift and improved waist shift scenarii.")
-    axis.plot(nominal.S, nominal.MUX - nominal.MUY, ls="--", mfc="none", label="Nominal")
-    axis.plot(before.S, before.MUX - before.MUY, ls="--", mfc="none", label="Bare Waist Shift")
-    axis.plot(
+    _plot(axis, nominal.S, nominal.MUX - nominal.MUY, ls="--", mfc="none", label="Nominal", mode=mode, max_points=max_points)
+    _plot(
+        axis, before.S, before.MUX - before.MUY, ls="--", mfc="none", label="Bare Waist Shift", mode=mode, max_points=max_points
+    )
+    _plot(
+        axis,
         after.S,
         after.MUX - after.MUY,
         ls="--",
         mfc="none",
         label="Improved Waist Shift",
+        mode=mode,
+        max_points=max_points,
     )
 
     if show_ips:
@@ -314,6 +395,94 @@ def plot_phase_differences(
     axis.legend()
 
 
+# ----- Figures ----- #
+
+# Names of the figures created for each beam, also used as their file names
+FIGURES: Tuple[str, ...] = (
+    "waist_shift_betabeatings",
+    "matched_waist_shift_betabeatings",
+    "bare_vs_matched_betabeatings",
+    "betas",
+    "betas_deviations",
+    "phase_advances",
+    "phase_differences",
+)
+
+# Columns of the TWISS dataframes used by the plotters, the others can be dropped beforehand
+PLOTTED_COLUMNS: Tuple[str, ...] = ("S", "BETX", "BETY", "MUX", "MUY", "BBX", "BBY")
+
+
+def create_figure(
+    name: str,
+    beam: int,
+    nominal: pd.DataFrame,
+    bare: pd.DataFrame,
+    matched: pd.DataFrame,
+    mode: str = "full",
+    max_points: Optional[int] = None,
+    **kwargs,
+) -> matplotlib.figure.Figure:
+    """
+    Creates one of the `~.FIGURES` for the given *beam*, from the ``TWISS`` dataframes of
+    the different configurations.
+
+    Args:
+        name (str): the name of the figure to create, one of `~.FIGURES`.
+        beam (int): the beam number, used in the titles.
+        nominal (pd.DataFrame): the `~pd.DataFrame` with ``TWISS`` functions from the nominal model.
+        bare (pd.DataFrame): the `~pd.DataFrame` with ``TWISS`` functions and beta-beatings from
+            the bare waist shift implementation.
+        matched (pd.DataFrame): the `~pd.DataFrame` with ``TWISS`` functions and beta-beatings from
+            the improved waist shift implementation.
+        mode (str): how to draw the data, one of `~.PLOT_MODES`. Defaults to ``full``.
+        max_points (int): the maximum number of points per line in ``decimated`` mode. Defaults
+            to two per horizontal pixel of the axes.
+        **kwargs: any keyword argument is passed to `~matplotlib.pyplot.subplots`.
+
+    Returns:
+        The created `~matplotlib.figure.Figure`.
+    """
+    if name not in FIGURES:
+        raise ValueError(f"Unknown figure '{name}', should be one of {FIGURES}")
+    if mode not in PLOT_MODES:
+        raise ValueError(f"Unknown plotting mode '{mode}', should be one of {PLOT_MODES}")
+    options = dict(show_ips=True, mode=mode, max_points=max_points)
+
+    if name in ("waist_shift_betabeatings", "matched_waist_shift_betabeatings"):
+        figure, axis = plt.subplots(**kwargs)
+        if name == "waist_shift_betabeatings":
+            plot_waist_shift_betabeatings(axis, bare, **options)
+            axis.set_title(f"B{beam:d} - Waist Shift Induced Beta-Beating")
+        else:
+            plot_waist_shift_betabeatings(axis, matched, **options)
+            axis.set_title(f"B{beam:d} - Waist Shift Induced Beta-Beating, After Matching")
+        return figure
+
+    figure, (axx, axy) = plt.subplots(2, 1, sharex=True, **kwargs)
+    if name == "bare_vs_matched_betabeatings":
+        plot_waist_shift_betabeatings_comparison(axx, bare, matched, column="BBX", **options)
+        plot_waist_shift_betabeatings_comparison(axy, bare, matched, column="BBY", **options)
+        axx.set_title(f"B{beam:d} - Horizontal Waist Shift Induced Beta-Beating - Before vs After Matching")
+    elif name == "betas":
+        plot_betas_comparison(axx, nominal, bare, matched, column="BETX", **options)
+        plot_betas_comparison(axy, nominal, bare, matched, column="BETY", **options)
+        axx.set_title(f"B{beam:d} - Beta Functions for Each Configuration")
+    elif name == "betas_deviations":
+        plot_betas_deviation(axx, nominal, bare, matched, column="BETX", **options)
+        plot_betas_deviation(axy, nominal, bare, matched, column="BETY", **options)
+        axx.set_title(f"B{beam:d} - Variation to Nominal Beta-Functions - Before vs After Matching")
+    elif name == "phase_advances":
+        plot_phase_advances_comparison(axx, nominal, bare, matched, column="MUX", **options)
+        plot_phase_advances_comparison(axy, nominal, bare, matched, column="MUY", **options)
+        axx.set_title(f"B{beam:d} - Phase Advances for Each Configuration")
+    else:
+        plot_phase_differences(axx, nominal, bare, matched, **options)
+        plot_phase_differences(axy, nominal, bare, matched, **options)
+        axx.set_title(f"B{beam:d} - Phase Differences for Each Configuration")
+    axy.set_xlabel("S [m]")
+    return figure
+
+
 # ----- Helpers ----- #
 
 
@@ -332,3 +501,39 @@ def _highlight_ips_locations(axis: matplotlib.axes.Axes, dataframe: pd.DataFrame
             lw=2,
             label=row_tuple.NAME.upper(),
         )
+
+
+def _plot(
+    axis: matplotlib.axes.Axes,
+    s: pd.Series,
+    values: pd.Series,
+    *args,
+    mode: str = "full",
+    max_points: Optional[int] = None,
+    **kwargs,
+) -> None:
+    """
+    Plots *values* against *s* on the given *axis* according to the plotting *mode* (see `~.PLOT_MODES`).
+    Any other argument is passed to `~matplotlib.axes.Axes.plot`.
+    """
+    if mode == "decimated":
+        bins = max(1, (max_points or int(2 * axis.get_window_extent().width)) // 2)
+        keep = _decimation_indices(np.asarray(s, dtype=float), np.asarray(values, dtype=float), bins)
+        s, values = np.asarray(s)[keep], np.asarray(values)[keep]
+    axis.plot(s, values, *args, rasterized=mode == "rasterized", **kwargs)
+
+
+def _decimation_indices(s: np.ndarray, values: np.ndarray, bins: int) -> np.ndarray:
+    """
+    Splits the range of *s* in the given number of *bins* and returns the sorted indices of the minimum
+    and maximum of *values* in each, which keeps the shape and peaks of the data with at most two points
+    per bin. The first and last points are always kept.
+    """
+    if len(s) <= 2 * bins:
+        return np.arange(len(s))
+    span = s.max() - s.min()
+    bin_ids = np.zeros(len(s), dtype=int) if span == 0 else np.minimum(((s - s.min()) / span * bins).astype(int), bins - 1)
+    order = np.lexsort((values, bin_ids))  # by bin, then by value within each bin
+    firsts = np.flatnonzero(np.diff(bin_ids[order], prepend=-1))  # position of the minimum of each bin in order
+    lasts = np.append(firsts[1:] - 1, len(order) - 1)  # position of the maximum of each bin in order
+    return np.unique(np.concatenate(([0, len(s) - 1], order[firsts], order[lasts])))
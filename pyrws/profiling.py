@@ -0,0 +1,125 @@
+"""
+.. _profiling:
+
+Profiling
+---------
+
+Module to record the wall time and the ``MAD-X`` activity (commands, ``TWISS`` commands and
+matching calls) of the different steps of a run, and to export them as a ``JSON`` file. Records
+are kept per process, and the pipeline gathers the ones of its worker processes.
+"""
+import json
+import os
+import time
+
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Tuple
+
+from pyrws.utils import CommandsCounter, MatchingCallsCounter
+
+_RECORDS: List[Dict[str, Any]] = []  # records of the sections closed in the current process
+_OPEN_SECTIONS: List[str] = []  # names of the currently open sections, for nesting
+_COUNTERS: List[Tuple[CommandsCounter, MatchingCallsCounter]] = []  # counters of MAD-X instances of this process
+
+
+def register_counters(commands_counter: CommandsCounter, calls_counter: MatchingCallsCounter) -> None:
+    """
+    Registers the counters of a `~cpymad.madx.Madx` instance, so that its activity is included in
+    the records of the sections it is used in.
+
+    Args:
+        commands_counter (CommandsCounter): the counter given as *command_log* to the instance.
+        calls_counter (MatchingCallsCounter): the counter given as *stdout* to the instance.
+    """
+    _COUNTERS.append((commands_counter, calls_counter))
+
+
+@contextmanager
+def section(name: str) -> Iterator[None]:
+    """
+    Context manager recording the wall time and ``MAD-X`` activity of the enclosed code as a section
+    named *name*. Sections can be nested, in which case their recorded names are joined with a ``/``.
+    The ``MAD-X`` activity only covers the instances of the current process: work submitted to other
+    processes is recorded there, in their own sections.
+
+    Args:
+        name (str): the name of the section.
+
+    Example:
+        .. code-block:: python
+
+            >>> with section("nominal_b1"):
+            ...     with section("fields_query"):
+            ...         fields = get_magnets_powering(madx, config.twiss_tfs, get_affected_elements(ip=1, beam=1))
+    """
+    _OPEN_SECTIONS.append(name)
+    start, counts_before = time.time(), _madx_counts()
+    try:
+        yield
+    finally:
+        counts_after = _madx_counts()
+        _RECORDS.append(
+            dict(
+                name="/".join(_OPEN_SECTIONS),
+                start=start,
+                wall_time=time.time() - start,
+                pid=os.getpid(),
+                **{count: counts_after[count] - counts_before[count] for count in counts_after},
+            )
+        )
+        _OPEN_SECTIONS.pop()
+
+
+def get_records() -> List[Dict[str, Any]]:
+    """Returns the records of the current process, including the ones added from other processes."""
+    return list(_RECORDS)
+
+
+def add_records(records: List[Dict[str, Any]]) -> None:
+    """Adds the provided *records*, typically from a worker process, to the ones of the current process."""
+    prefix = "/".join(_OPEN_SECTIONS)
+    _RECORDS.extend(dict(record, name=f"{prefix}/{record['name']}" if prefix else record["name"]) for record in records)
+
+
+@contextmanager
+def worker_records() -> Iterator[List[Dict[str, Any]]]:
+    """
+    Context manager for work done on behalf of another process, typically in a worker process which
+    may have inherited the state of its parent. Sections opened within are named without the already
+    open ones, and their records are moved to the yielded `list` when leaving the context, to be sent
+    back and added to the parent's records with `~.add_records`.
+    """
+    open_sections, since = _OPEN_SECTIONS[:], len(_RECORDS)
+    _OPEN_SECTIONS.clear()
+    records: List[Dict[str, Any]] = []
+    try:
+        yield records
+    finally:
+        records.extend(_RECORDS[since:])
+        del _RECORDS[since:]
+        _OPEN_SECTIONS[:] = open_sections
+
+
+def write_timings(file_path: Path, **metadata) -> None:
+    """
+    Writes the records of the current process to *file_path* as ``JSON``, ordered by start time.
+
+    Args:
+        file_path (Path): `~pathlib.Path` to the output file, typically ``timings.json``.
+        **metadata: any keyword argument is written alongside the records for information.
+    """
+    timings = dict(
+        metadata={name: str(value) for name, value in metadata.items()},
+        sections=sorted(_RECORDS, key=lambda record: record["start"]),
+    )
+    Path(file_path).write_text(json.dumps(timings, indent=2))
+
+
+def _madx_counts() -> Dict[str, int]:
+    """Returns the total activity of all the registered ``MAD-X`` instances of the current process."""
+    return dict(
+        madx_commands=sum(commands.commands for commands, _ in _COUNTERS),
+        twiss_commands=sum(commands.twiss for commands, _ in _COUNTERS),
+        match_calls=sum(calls.calls for _, calls in _COUNTERS),
+    )
@@ -0,0 +1,133 @@
+"""
+.. _response:
+
+Response Matrix
+---------------
+
+Module with functions to determine the linear response of the improved waist shift matching
+constraints to the independent IR quadrupoles powering knobs, and to solve for the knobs
+corrections from it. This is a much cheaper alternative to the ``MAD-X`` matching, which
+re-computes the ``TWISS`` of the whole ring for every knob at every iteration.
+"""
+from typing import Dict, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+from cpymad.madx import Madx
+from loguru import logger
+
+# Same as the default weights of these constraints in MAD-X matchings, so residuals are comparable
+CONSTRAINT_WEIGHTS: Dict[str, float] = {"BETX": 1, "BETY": 1, "DX": 10, "DY": 10}
+
+
+def get_waist_shift_observables(beam: int, ip: int) -> pd.MultiIndex:
+    """
+    Returns the (element, column) pairs constrained in the improved waist shift matching at the
+    given *ip*: the beta-functions and dispersion at the IP, and the beta-functions at the Q3
+    and Q11 on both sides of the IP.
+
+    Args:
+        beam (int): the beam number, should be 1 or 2.
+        ip (int): the IP at which the rigid waist shift is applied.
+
+    Returns:
+        A `~pandas.MultiIndex` with ``ELEMENT`` and ``COLUMN`` levels, in uppercase.
+    """
+    observables = [(f"IP{ip:d}", column) for column in ("BETX", "BETY", "DX", "DY")]
+    for element in (f"MQXA.3L{ip:d}", f"MQXA.3R{ip:d}", f"MQ.11L{ip:d}.B{beam:d}", f"MQ.11R{ip:d}.B{beam:d}"):
+        observables += [(element, "BETX"), (element, "BETY")]
+    return pd.MultiIndex.from_tuples(observables, names=["ELEMENT", "COLUMN"])
+
+
+def get_observables_values(madx: Madx, sequence: str, observables: pd.MultiIndex) -> pd.Series:
+    """
+    Runs a ``TWISS`` of the given *sequence* and returns the values of the provided *observables*.
+    Only the needed columns of the ``TWISS`` table are transferred from ``MAD-X``.
+
+    Args:
+        madx (cpymad.madx.Madx): an instanciated `~cpymad.madx.Madx` object.
+        sequence (str): the name of the sequence to twiss.
+        observables (pd.MultiIndex): the (element, column) pairs to get the values of, as
+            given by `~.get_waist_shift_observables`.
+
+    Returns:
+        A `~pandas.Series` of the values, indexed by *observables*.
+    """
+    madx.select(flag="twiss", clear=True)  # in case a previous query restricted the table rows
+    table = madx.twiss(sequence=sequence)
+    positions = {name[:-2].upper(): index for index, name in enumerate(table.name)}  # remove :1 from names
+    rows = [positions[element] for element in observables.get_level_values("ELEMENT")]
+    columns = {column: table[column.lower()] for column in observables.unique(level="COLUMN")}
+    values = [columns[column][row] for row, column in zip(rows, observables.get_level_values("COLUMN"))]
+    return pd.Series(values, index=observables, dtype=float)
+
+
+def get_response_matrix(
+    madx: Madx, sequence: str, knobs: Sequence[str], observables: pd.MultiIndex, step: float = 1e-7
+) -> pd.DataFrame:
+    """
+    Computes the response of the provided *observables* to each of the *knobs* by finite differences,
+    with one ``TWISS`` call per knob. The knobs are restored to their initial values afterwards.
+
+    .. important::
+        The response is linear around the current state of the machine, which should be close to the
+        configurations it will be used for (for instance the nominal configuration for waist shifts).
+
+    Args:
+        madx (cpymad.madx.Madx): an instanciated `~cpymad.madx.Madx` object.
+        sequence (str): the name of the sequence to twiss.
+        knobs (Sequence[str]): the names of the knobs to compute the response to.
+        observables (pd.MultiIndex): the (element, column) pairs to compute the response of.
+        step (float): the change applied to each knob for the finite differences. Defaults to
+            the step of the ``VARY`` commands of the matching.
+
+    Returns:
+        A `~pandas.DataFrame` indexed by *observables* and with one column per knob.
+    """
+    logger.debug(f"Computing the response matrix of {len(observables)} observables to {len(knobs)} knobs")
+    reference = get_observables_values(madx, sequence, observables)
+    response = {}
+    for knob in knobs:
+        initial_value = madx.globals[knob]
+        madx.globals[knob] = initial_value + step
+        try:
+            response[knob] = (get_observables_values(madx, sequence, observables) - reference) / step
+        finally:
+            madx.globals[knob] = initial_value
+    return pd.DataFrame(response)
+
+
+def solve_knobs_corrections(response: pd.DataFrame, differences: pd.Series, rcond: Optional[float] = None) -> Dict[str, float]:
+    """
+    Solves for the knobs corrections cancelling the given *differences* in the least squares sense,
+    each observable being weighted as in ``MAD-X`` (see `~.CONSTRAINT_WEIGHTS`).
+
+    Args:
+        response (pd.DataFrame): the response matrix, as given by `~.get_response_matrix`.
+        differences (pd.Series): the target minus current values of the observables.
+        rcond (float): cut-off ratio for the small singular values of the weighted response
+            matrix, see `numpy.linalg.lstsq`. Defaults to machine precision based.
+
+    Returns:
+        A `dict` of the knob names and the changes to apply to them.
+    """
+    weights = response.index.get_level_values("COLUMN").map(CONSTRAINT_WEIGHTS).to_numpy(dtype=float)
+    corrections, *_ = np.linalg.lstsq(
+        weights[:, None] * response.to_numpy(), weights * differences[response.index].to_numpy(), rcond=rcond
+    )
+    return dict(zip(response.columns, corrections))
+
+
+def weighted_residual(differences: pd.Series) -> float:
+    """
+    Returns the sum of the squared weighted *differences*, which is the ``MAD-X`` penalty function.
+
+    Args:
+        differences (pd.Series): the target minus current values of the observables.
+
+    Returns:
+        The penalty function value.
+    """
+    weights = differences.index.get_level_values("COLUMN").map(CONSTRAINT_WEIGHTS).to_numpy(dtype=float)
+    return float(np.sum((weights * differences.to_numpy()) ** 2))
@@ -0,0 +1,134 @@
+"""
+.. _runs:
+
+Previous Runs
+-------------
+
+Module to access the outputs of previous runs, for instance to reuse their knobs or to compare
+many of them. The output directory is indexed when a `~.RunResult` is created, and each artifact
+is only loaded when first accessed. When a run has a ``results.npz`` bundle (see `~pyrws.bundle`),
+tables and knobs are taken from it and table columns are memory-mapped, otherwise the ``TFS`` and
+knob files are parsed.
+"""
+from functools import cached_property
+from pathlib import Path
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+import tfs
+
+from loguru import logger
+
+from pyrws.bundle import ResultBundle
+from pyrws.utils import load_knobs_file
+
+KNOB_GROUPS: Tuple[str, ...] = ("triplets", "quadrupoles", "working_point")
+
+
+class RunResult:
+    """
+    Lazy accessor to the output directory of a previous run, as created by ``create_knobs`` (see
+    `~pyrws.utils.prepare_output_directories`). Loaded artifacts are cached, so accessing them again
+    is free.
+
+    Args:
+        directory (Path): `~pathlib.Path` to the output directory of the run.
+
+    Example:
+        .. code-block:: python
+
+            >>> previous = RunResult(Path("outputs"))
+            >>> previous.knobs(beam=1, group="quadrupoles")
+            >>> previous.twiss(beam=2, config="matched_waist", columns=["S", "BBX", "BBY"])
+    """
+
+    def __init__(self, directory: Path):
+        self.directory = Path(directory)
+        if not self.directory.is_dir():
+            raise NotADirectoryError(f"No run output directory at '{self.directory}'")
+        self.files: Dict[str, Path] = {  # relative path (such as BEAM1/KNOBS/triplets.madx) to file
+            path.relative_to(self.directory).as_posix(): path for path in self.directory.glob("**/*") if path.is_file()
+        }
+        self._loaded: Dict[Tuple[Any, ...], Any] = {}
+
+    def __repr__(self) -> str:
+        return f"RunResult('{self.directory}', bundle={self.bundle is not None})"
+
+    @cached_property
+    def bundle(self) -> Optional[ResultBundle]:
+        """The `~pyrws.bundle.ResultBundle` of the run, if it was written with one."""
+        return ResultBundle(self.files["results.npz"]) if "results.npz" in self.files else None
+
+    def knobs(self, beam: int, group: str, config: str = "matched_waist") -> Dict[str, float]:
+        """
+        Returns the knobs of a given *group* for the given *beam* and configuration.
+
+        Args:
+            beam (int): the beam number, should be 1 or 2.
+            group (str): the knobs group, one of `~.KNOB_GROUPS`.
+            config (str): the configuration, one of ``nominal``, ``bare_waist`` or ``matched_waist``. Without
+                a bundle, only the ``matched_waist`` knobs are available as they are the only ones written
+                to knob files. Defaults to ``matched_waist``.
+
+        Returns:
+            A `dict` of the knob names and their values.
+        """
+        if group not in KNOB_GROUPS:
+            raise ValueError(f"Unknown knobs group '{group}', should be one of {KNOB_GROUPS}")
+        if self.bundle is not None:
+            return self.bundle.knobs(f"{config}_b{beam:d}")[group]
+        if config != "matched_waist":
+            raise FileNotFoundError(f"Only the matched waist knobs are available without a bundle in '{self.directory}'")
+        return self._load(("knobs", beam, group), load_knobs_file, self._file(f"BEAM{beam:d}/KNOBS/{group}.madx"))
+
+    def twiss(self, beam: int, config: str = "matched_waist", columns: Optional[Sequence[str]] = None) -> tfs.TfsDataFrame:
+        """
+        Returns the ``TWISS`` table of the given *beam* and configuration, as written to its ``TFS`` file.
+
+        Args:
+            beam (int): the beam number, should be 1 or 2.
+            config (str): the configuration, one of ``nominal``, ``bare_waist`` or ``matched_waist``, with
+                an eventual ``_monitors`` suffix for the monitors-only table (only available as ``TFS``).
+                Defaults to ``matched_waist``.
+            columns (Sequence[str]): if provided, only these columns are returned. With a bundle only
+                these are read at all.
+
+        Returns:
+            A `~tfs.TfsDataFrame` of the table, memory-mapped from the bundle if available.
+        """
+        return self._table(beam, f"{config}_b{beam:d}", columns)
+
+    def fields(self, beam: int, config: str = "matched_waist") -> tfs.TfsDataFrame:
+        """
+        Returns the affected magnets powering of the given *beam* and configuration.
+
+        Args:
+            beam (int): the beam number, should be 1 or 2.
+            config (str): the configuration, either ``nominal`` or ``matched_waist``. Defaults to ``matched_waist``.
+
+        Returns:
+            A `~tfs.TfsDataFrame` of the fields.
+        """
+        return self._table(beam, f"{config}_b{beam:d}_fields")
+
+    # ----- Helpers ----- #
+
+    def _table(self, beam: int, name: str, columns: Optional[Sequence[str]] = None) -> tfs.TfsDataFrame:
+        """Loads the named table of *beam* from the bundle if it has it, or from its ``TFS`` file."""
+        if self.bundle is not None and name in self.bundle.tables:
+            key = ("table", name, tuple(columns) if columns is not None else None)
+            return self._load(key, self.bundle.load_table, name, columns)
+        dataframe = self._load(("table", name, None), tfs.read, self._file(f"BEAM{beam:d}/TFS/{name}.tfs"))
+        return dataframe[list(columns)] if columns is not None else dataframe
+
+    def _file(self, relative_path: str) -> Path:
+        """Returns the path to an indexed file of the run, raising if it does not exist."""
+        if relative_path not in self.files:
+            raise FileNotFoundError(f"No '{relative_path}' file in run directory '{self.directory}'")
+        return self.files[relative_path]
+
+    def _load(self, key: Tuple[Any, ...], loader, *args) -> Any:
+        """Calls *loader* with *args* the first time *key* is requested, and returns the cached result afterwards."""
+        if key not in self._loaded:
+            logger.trace(f"Loading {key} from run directory '{self.directory}'")
+            self._loaded[key] = loader(*args)
+        return self._loaded[key]
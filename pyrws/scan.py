@@ -0,0 +1,540 @@
+"""
+.. _scan:
+
+Waist Shift Settings Scan
+-------------------------
+
+Command line script to create rigid waist shift configurations for several waist shift settings
+and IPs in a single invocation. The nominal configuration of each beam is determined once for all IPs
+and shared by all runs, which are fanned out over a pool of processes, and a consolidated summary
+table is written at the end.
+"""
+import os
+
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+import rich_click as click
+import tfs
+
+from loguru import logger
+from rich.traceback import install as install_traceback
+
+from pyhdtoolkit.utils.contexts import timeit
+from pyhdtoolkit.utils.logging import config_logger
+from pyrws import profiling
+from pyrws.cache import NominalConfigCache, ResponseMatrixStore, invalidate_entries
+from pyrws.pipeline import (
+    NominalResult,
+    Stage,
+    WaistShiftResult,
+    nominal_ips_stage,
+    run_stages,
+    waist_shift_stage,
+)
+from pyrws.utils import (
+    extrapolate_knobs,
+    powering_delta,
+    prepare_output_directories,
+    write_beam_outputs,
+    write_infeasibility_record,
+)
+
+install_traceback(width=130, suppress=[click])  # Rich handling of uncaught exceptions for the tracebacks
+
+
+@click.command()
+# ----- Required Arguments ----- #
+@click.option(
+    "--sequence",
+    type=click.Path(exists=True, file_okay=True, resolve_path=True, path_type=Path),
+    required=True,
+    help="Path to the LHC sequence file to use.",
+)
+@click.option(
+    "--opticsfile",
+    type=click.Path(exists=True, file_okay=True, resolve_path=True, path_type=Path),
+    required=True,
+    help="Path to the LHC optics file to use.",
+)
+@click.option(
+    "--ip",
+    type=click.IntRange(min=1, max=8),
+    multiple=True,
+    default=(1,),
+    show_default=True,
+    help="Which IP to prepare the waist shift knobs for. Should be 1, 2, 5 or 8. Can be given several times.",
+)
+@click.option(
+    "--waist_shift_setting",
+    type=click.FLOAT,
+    multiple=True,
+    help="Unit setting of the rigid waist shift to include in the scan. Can be given several times.",
+)
+@click.option(
+    "--settings_range",
+    type=click.Tuple([float, float, int]),
+    default=None,
+    help="Range of unit settings to include in the scan, given as START STOP NUM for evenly spaced values "
+    "(including START and STOP). Combined with the values given to --waist_shift_setting, if any.",
+)
+@click.option(
+    "--outputdir",
+    type=click.Path(exists=False, file_okay=False, resolve_path=True, path_type=Path),
+    default=Path.cwd() / "scan_outputs",
+    show_default=True,
+    help="Directory in which to write output files. Each run is written in an 'IP[n]/SETTING_[value]' sub-directory "
+    "and the summary table at the top level. Defaults to 'scan_outputs/' in the current working directory.",
+)
+# ----- Optional Arguments ----- #
+@click.option("--energy", type=click.FloatRange(min=0), default=6800, show_default=True, help="Beam energy in [GeV]")
+@click.option(
+    "--qx",
+    type=click.FloatRange(min=0),
+    default=62.31,
+    show_default=True,
+    help="The horizontal tune to match to.",
+)
+@click.option(
+    "--qy",
+    type=click.FloatRange(min=0),
+    default=60.32,
+    show_default=True,
+    help="The vertical tune to match to.",
+)
+@click.option(
+    "--engine",
+    type=click.Choice(["match", "response"]),
+    default="match",
+    show_default=True,
+    help="How to improve the waist shift. With 'match' a full MAD-X matching is done, while with 'response' the "
+    "quadrupole knobs are solved for from a response matrix computed once in the nominal configuration, with a single "
+    "TWISS per iteration. The full matching is still done if the residual stays above --max_residual.",
+)
+@click.option(
+    "--max_residual",
+    type=click.FloatRange(min=0),
+    default=1e-4,
+    show_default=True,
+    help="Highest accepted residual (MAD-X penalty function value) for the 'response' engine.",
+)
+@click.option(
+    "--ir_segment",
+    type=click.BOOL,
+    default=False,
+    show_default=True,
+    help="Whether to do the improved waist shift matching on the IR segment only (from S.DS.L to E.DS.R of the IP), "
+    "with initial conditions from the bare waist shift TWISS, which makes each matching iteration much cheaper. A "
+    "single full ring TWISS is done afterwards to check the result.",
+)
+@click.option(
+    "--max_powering",
+    type=click.FloatRange(min=0),
+    default=None,
+    help="If provided, highest accepted powering of the affected magnets in the bare waist shift configuration, in "
+    "percent of their maximum powering. Beyond it a setting is deemed infeasible: its improved matching is skipped, the "
+    "reason is written to an 'infeasible.json' file in its sub-directory and is reported in the summary table.",
+)
+@click.option(
+    "--processes",
+    type=click.IntRange(min=1),
+    default=os.cpu_count(),
+    show_default=True,
+    help="Maximum number of runs to execute concurrently, each in its own process.",
+)
+@click.option(
+    "--warm_start",
+    type=click.BOOL,
+    default=False,
+    show_default=True,
+    help="Whether to warm-start each improved waist shift matching from the solutions of the previous settings (linear "
+    "extrapolation of the last two). The settings of each IP are then split in contiguous chains, one per process, and "
+    "the runs of a chain are done in order.",
+)
+@click.option(
+    "--cache_dir",
+    type=click.Path(exists=False, file_okay=False, resolve_path=True, path_type=Path),
+    default=None,
+    help="If provided, directory of a persistent cache for the nominal configurations and response matrices, shared "
+    "with other scans and with the main command line.",
+)
+@click.option(
+    "--cache_size",
+    type=click.FloatRange(min=0),
+    default=1000,
+    show_default=True,
+    help="Maximum size of the nominal configurations cache, in [MB]. Least recently used entries are evicted beyond.",
+)
+@click.option(
+    "--refresh_cache",
+    type=click.BOOL,
+    default=False,
+    show_default=True,
+    help="Whether to invalidate the cache entries for the inputs of this run before running, to force their "
+    "recomputation. Useful if a file called by the sequence or optics file changed, as only their own contents are hashed.",
+)
+@click.option(
+    "--loglevel",
+    type=click.Choice(["trace", "debug", "info", "warning", "error", "critical"]),
+    default="info",
+    show_default=True,
+    help="Sets the logging level.",
+)
+def scan(
+    sequence: Path,
+    opticsfile: Path,
+    ip: Tuple[int, ...],
+    waist_shift_setting: Tuple[float, ...],
+    settings_range: Optional[Tuple[float, float, int]],
+    outputdir: Path,
+    energy: Optional[float],
+    qx: Optional[float],
+    qy: Optional[float],
+    engine: Optional[str],
+    max_residual: Optional[float],
+    ir_segment: Optional[bool],
+    max_powering: Optional[float],
+    processes: Optional[int],
+    warm_start: Optional[bool],
+    cache_dir: Optional[Path],
+    cache_size: Optional[float],
+    refresh_cache: Optional[bool],
+    loglevel: Optional[str],
+):
+    """
+    Command-line program to scan rigid waist shift settings for the LHC. Given a sequence,
+    optics file, IPs and RWS settings, will create the knobs for each combination of IP and
+    setting and write a summary table of the knob changes, peak beta-beatings and matching
+    residuals. No plots are generated.
+    """
+    # ----- Configuration ----- #
+    config_logger(level=loglevel)
+    ips = tuple(dict.fromkeys(ip))  # without duplicates, in the given order
+    settings = list(waist_shift_setting)
+    if settings_range is not None:
+        settings += np.linspace(*settings_range).tolist()
+    settings = sorted(set(settings))
+    if not settings:
+        raise click.UsageError("At least one setting should be given through --waist_shift_setting or --settings_range")
+    logger.info(f"Scanning {len(settings)} waist shift settings at IP(s) {', '.join(str(i) for i in ips)}")
+
+    cache, responses = None, None
+    if cache_dir is not None:
+        cache, responses = NominalConfigCache(cache_dir, max_size=cache_size), ResponseMatrixStore(cache_dir)
+        if refresh_cache:
+            for scan_ip in ips:
+                invalidate_entries(cache, responses, sequence, opticsfile, energy=energy, ip=scan_ip, qx=qx, qy=qy)
+
+    # ----- Run All Stages ----- #
+    stages = get_scan_stages(
+        outputdir=outputdir,
+        sequence=sequence,
+        opticsfile=opticsfile,
+        energy=energy,
+        ips=ips,
+        settings=settings,
+        qx=qx,
+        qy=qy,
+        chains=max(1, processes // len(ips)) if warm_start else None,
+        engine=engine,
+        max_residual=max_residual,
+        ir_segment=ir_segment,
+        max_powering=max_powering,
+        cache=cache,
+        responses=responses,
+    )
+    with profiling.section("scan_stages"), timeit(
+        lambda spanned: logger.info(f"Ran all {len(stages)} scan stages in {spanned:.2f} seconds")
+    ):
+        results = run_stages(stages, parallel=True, processes=processes, loglevel=loglevel)
+
+    # ----- Summary Table ----- #
+    summary_rows = [row for name, rows in results.items() if name.startswith("run_") for row in rows]
+    summary = tfs.TfsDataFrame(pd.DataFrame(summary_rows).sort_values(["IP", "SETTING", "BEAM"]).reset_index(drop=True))
+    summary.headers = {"SEQUENCE": str(sequence), "OPTICSFILE": str(opticsfile), "ENERGY": energy, "QX": qx, "QY": qy}
+    tfs.write(outputdir / "scan_summary.tfs", summary)
+    logger.info(f"Wrote scan summary to '{outputdir / 'scan_summary.tfs'}'")
+    if (summary.FEASIBLE == 0).any():
+        infeasible = summary[summary.FEASIBLE == 0].drop_duplicates(["IP", "SETTING"])
+        logger.warning(f"{len(infeasible)} of the scanned (IP, setting) pairs are infeasible, see the summary table")
+    profiling.write_timings(outputdir / "timings.json", sequence=sequence, opticsfile=opticsfile, ips=ips, settings=settings)
+
+    if warm_start and "WARM_START" in summary.columns and (summary.WARM_START == 1).any():
+        counted = summary[(summary.FEASIBLE == 1) & (summary.MATCH_CALLS >= 0)]  # -1 when the calls were not counted
+        cold_calls = counted.MATCH_CALLS[counted.WARM_START == 0].mean()
+        warm_calls = counted.MATCH_CALLS[counted.WARM_START == 1]
+        logger.info(
+            f"Warm-started matchings used {warm_calls.mean():.1f} MAD-X calls on average against {cold_calls:.1f} for "
+            "cold-started ones (at different settings, so this is only a comparison and not a measured saving)"
+        )
+
+
+# ----- Scan Stages ----- #
+
+
+def get_scan_stages(
+    outputdir: Path,
+    sequence: Path,
+    opticsfile: Path,
+    energy: float,
+    ips: Sequence[int],
+    settings: Sequence[float],
+    qx: float,
+    qy: float,
+    chains: Optional[int] = None,
+    engine: str = "match",
+    max_residual: float = 1e-4,
+    ir_segment: bool = False,
+    max_powering: Optional[float] = None,
+    cache: Optional[NominalConfigCache] = None,
+    responses: Optional[ResponseMatrixStore] = None,
+) -> List[Stage]:
+    """
+    Builds the stage graph of a scan: one nominal stage per beam for all IPs, named ``nominal_b[12]`` (see
+    `~pyrws.pipeline.nominal_ips_stage`) and logging to *outputdir*, and run stages which depend on the
+    nominal results of their IP. By default there is one run stage per IP and setting, named
+    ``run_ip[n]_[setting]``. If *chains* is given, the settings of each IP are
+    instead split in as many contiguous chains, each in a run stage named ``run_ip[n]_[first]-[last]``
+    in which the matchings are warm-started from the previous settings' solutions.
+
+    Args:
+        outputdir (Path): `~pathlib.Path` to the main output directory of the scan.
+        sequence (Path): `~pathlib.Path` to the LHC sequence file to use.
+        opticsfile (Path): `~pathlib.Path` to the LHC optics file to use.
+        energy (float): beam energy for the setup, in [GeV].
+        ips (Sequence[int]): the IPs at which to apply the rigid waist shift.
+        settings (Sequence[float]): the unit settings of the rigid waist shift to scan.
+        qx (float): the horizontal tune to match to.
+        qy (float): the vertical tune to match to.
+        chains (int): if provided, the number of warm-started chains to split the settings of each IP in.
+        engine (str): how to improve the waist shift, see `~pyrws.pipeline.waist_shift_stage`. With
+            ``response``, the response matrices are computed once per beam and IP in the nominal stages.
+        max_residual (float): the highest accepted residual for the ``response`` engine.
+        ir_segment (bool): if `True`, the improved waist shift matchings twiss the IR segment only.
+        max_powering (float): if provided, the highest accepted powering of the affected magnets in the bare
+            waist shift configurations, see `~pyrws.pipeline.waist_shift_stage`.
+        cache (NominalConfigCache): if provided, the cache from which to load and in which to store
+            the nominal configurations.
+        responses (ResponseMatrixStore): if provided, the store from which to load and in which to
+            save the response matrices for the ``response`` engine.
+
+    Returns:
+        A `list` of the `~pyrws.pipeline.Stage` objects to execute.
+    """
+    if chains is None:
+        settings_groups = [[setting] for setting in settings]
+    else:
+        settings_groups = [group.tolist() for group in np.array_split(sorted(settings), chains) if group.size]
+
+    common = dict(sequence=sequence, opticsfile=opticsfile, energy=energy, qx=qx, qy=qy)
+    for ip in ips:
+        (outputdir / f"IP{ip:d}").mkdir(parents=True, exist_ok=True)
+    stages: List[Stage] = [
+        Stage(
+            f"nominal_b{beam:d}",
+            nominal_ips_stage,
+            kwargs=dict(
+                workdir=outputdir,  # the logs of these stages cover all IPs
+                beam=beam,
+                ips=ips,
+                cache=cache,
+                response_matrix=engine == "response",
+                responses=responses,
+                **common,
+            ),
+        )
+        for beam in (1, 2)
+    ]
+    for ip in ips:
+        ip_dir = outputdir / f"IP{ip:d}"
+        for group in settings_groups:
+            name = f"{group[0]:g}" if len(group) == 1 else f"{group[0]:g}-{group[-1]:g}"
+            stages.append(
+                Stage(
+                    f"run_ip{ip:d}_{name}",
+                    scan_run_stage,
+                    kwargs=dict(
+                        ipdir=ip_dir,
+                        ip=ip,
+                        settings=group,
+                        warm_start=chains is not None,
+                        engine=engine,
+                        max_residual=max_residual,
+                        ir_segment=ir_segment,
+                        max_powering=max_powering,
+                        **common,
+                    ),
+                    depends_on={"nominal_b1": ("nominal_b1", ip), "nominal_b2": ("nominal_b2", ip)},
+                )
+            )
+    return stages
+
+
+def scan_run_stage(
+    ipdir: Path,
+    sequence: Path,
+    opticsfile: Path,
+    energy: float,
+    ip: int,
+    qx: float,
+    qy: float,
+    settings: Sequence[float],
+    nominal_b1: NominalResult,
+    nominal_b2: NominalResult,
+    warm_start: bool = False,
+    engine: str = "match",
+    max_residual: float = 1e-4,
+    ir_segment: bool = False,
+    max_powering: Optional[float] = None,
+) -> List[Dict[str, float]]:
+    """
+    Runs the waist shift stages of both beams for the given scan points, in order, writes their output
+    files in a ``SETTING_[value]`` sub-directory of *ipdir* and returns the summary rows.
+
+    Args:
+        ipdir (Path): `~pathlib.Path` to the output directory of the scan for this *ip*.
+        sequence (Path): `~pathlib.Path` to the LHC sequence file to use.
+        opticsfile (Path): `~pathlib.Path` to the LHC optics file to use.
+        energy (float): beam energy for the setup, in [GeV].
+        ip (int): the IP at which to apply the rigid waist shift.
+        qx (float): the horizontal tune to match to.
+        qy (float): the vertical tune to match to.
+        settings (Sequence[float]): the unit settings of the rigid waist shift to run.
+        nominal_b1 (NominalResult): the nominal configuration of beam 1 at this *ip*.
+        nominal_b2 (NominalResult): the nominal configuration of beam 2 at this *ip*.
+        warm_start (bool): if `True`, the improved waist shift matching of each setting after the
+            first one starts from an extrapolation of the previous solutions. Defaults to `False`.
+        engine (str): how to improve the waist shift, see `~pyrws.pipeline.waist_shift_stage`.
+        max_residual (float): the highest accepted residual for the ``response`` engine.
+        ir_segment (bool): if `True`, the improved waist shift matchings twiss the IR segment only.
+        max_powering (float): if provided, the highest accepted powering of the affected magnets in the bare
+            waist shift configurations. Infeasible settings are recorded but not improved, and not used to
+            warm-start the next ones.
+
+    Returns:
+        A `list` with one summary row (as a `dict`) per setting and beam, see `~.get_summary_row`.
+    """
+    common = dict(sequence=sequence, opticsfile=opticsfile, energy=energy, ip=ip, qx=qx, qy=qy)
+    common.update(engine=engine, max_residual=max_residual, ir_segment=ir_segment, max_powering=max_powering)
+    solutions: Dict[int, List[Tuple[float, Dict[str, float]]]] = {1: [], 2: []}
+    rows = []
+    for setting in settings:
+        warm_starts = {beam: extrapolate_knobs(solutions[beam], setting) if solutions[beam] else None for beam in (1, 2)}
+        waists = run_scan_point(ipdir, setting, nominal_b1, nominal_b2, warm_starts, **common)
+        for beam, nominal in ((1, nominal_b1), (2, nominal_b2)):
+            rows.append(get_summary_row(ip, setting, beam, nominal, waists[beam], warm_started=warm_starts[beam] is not None))
+            if warm_start and waists[beam].feasible:
+                solutions[beam].append((setting, waists[beam].matched.quads_knobs))
+    return rows
+
+
+def run_scan_point(
+    ipdir: Path,
+    setting: float,
+    nominal_b1: NominalResult,
+    nominal_b2: NominalResult,
+    warm_starts: Optional[Dict[int, Optional[Dict[str, float]]]] = None,
+    **kwargs,
+) -> Dict[int, WaistShiftResult]:
+    """
+    Runs the waist shift stages of both beams for a single *setting*, and writes their output files
+    in a ``SETTING_[value]`` sub-directory of *ipdir*. If the waist shift is infeasible for a beam,
+    its outputs are not written and an ``infeasible.json`` file records why instead.
+
+    Args:
+        ipdir (Path): `~pathlib.Path` to the output directory for this IP.
+        setting (float): the unit setting of the rigid waist shift to run.
+        nominal_b1 (NominalResult): the nominal configuration of beam 1 at this IP.
+        nominal_b2 (NominalResult): the nominal configuration of beam 2 at this IP.
+        warm_starts (Dict[int, Optional[Dict[str, float]]]): if provided, the independent quadrupoles
+            powering knobs to warm-start the improved waist shift matching of each beam from.
+        **kwargs: any other keyword argument (*sequence*, *opticsfile*, *energy*, *ip*, *qx*, *qy*
+            and the matching options) is given to `~pyrws.pipeline.waist_shift_stage`.
+
+    Returns:
+        A `dict` of the `~pyrws.pipeline.WaistShiftResult` for each beam.
+    """
+    warm_starts = warm_starts or {}
+    b1_dirs, b2_dirs = prepare_output_directories(ipdir / f"SETTING_{setting:g}")
+    waist_b1 = waist_shift_stage(
+        workdir=b1_dirs["main"],
+        beam=1,
+        nominal=nominal_b1,
+        waist_shift_setting=setting,
+        warm_start_knobs=warm_starts.get(1),
+        **kwargs,
+    )
+    waist_b2 = waist_shift_stage(
+        workdir=b2_dirs["main"], beam=2, nominal=nominal_b2, beam1_waist=waist_b1, warm_start_knobs=warm_starts.get(2), **kwargs
+    )
+
+    if not (waist_b1.feasible and waist_b2.feasible):
+        write_infeasibility_record(
+            ipdir / f"SETTING_{setting:g}" / "infeasible.json",
+            {beam: waist.infeasible for beam, waist in ((1, waist_b1), (2, waist_b2)) if not waist.feasible},
+            ip=kwargs.get("ip"),
+            waist_shift_setting=setting,
+            max_powering=kwargs.get("max_powering"),
+        )
+
+    for beam, dirs, nominal, waist in ((1, b1_dirs, nominal_b1, waist_b1), (2, b2_dirs, nominal_b2, waist_b2)):
+        if waist.feasible:
+            with profiling.section(f"writes_{setting:g}_b{beam:d}"):
+                write_beam_outputs(dirs, beam, nominal.config, waist.bare, waist.matched, nominal.fields, waist.fields)
+    return {1: waist_b1, 2: waist_b2}
+
+
+# ----- Helpers ----- #
+
+
+def get_summary_row(
+    ip: int,
+    waist_shift_setting: float,
+    beam: int,
+    nominal: NominalResult,
+    waist: WaistShiftResult,
+    warm_started: bool = False,
+) -> Dict[str, float]:
+    """
+    Gathers the summary quantities of a scan point for the given *beam*: peak absolute beta-beatings
+    of the bare and matched waist shift configurations, the residual of the waist shift matching and
+    the ``MAD-X`` calls it used, and the powering change of each knob (in ``DELTA_[KNOB]`` entries).
+    For an infeasible scan point only its ``FEASIBLE`` flag and ``INFEASIBLE_REASON`` are given, the
+    other quantities being missing in the summary table.
+
+    Args:
+        ip (int): the IP at which the rigid waist shift is applied.
+        waist_shift_setting (float): unit setting of the rigid waist shift.
+        beam (int): the beam number.
+        nominal (NominalResult): the nominal configuration of the *beam*.
+        waist (WaistShiftResult): the waist shift configurations of the *beam*.
+        warm_started (bool): whether the waist shift matching was warm-started. Defaults to `False`.
+
+    Returns:
+        A `dict` of the summary quantities for this scan point and *beam*.
+    """
+    row = dict(
+        IP=ip, SETTING=waist_shift_setting, BEAM=beam, FEASIBLE=int(waist.feasible), INFEASIBLE_REASON=waist.infeasible or ""
+    )
+    if not waist.feasible:
+        return row
+
+    row.update(
+        BARE_PEAK_BBX=waist.bare.twiss_tfs.BBX.abs().max(),
+        BARE_PEAK_BBY=waist.bare.twiss_tfs.BBY.abs().max(),
+        PEAK_BBX=waist.matched.twiss_tfs.BBX.abs().max(),
+        PEAK_BBY=waist.matched.twiss_tfs.BBY.abs().max(),
+        MATCH_RESIDUAL=waist.matched.match_residual if waist.matched.match_residual is not None else np.nan,
+        MATCH_CALLS=waist.match_calls if waist.match_calls is not None else -1,
+        WARM_START=int(warm_started),
+    )
+    for knobs in ("triplets_knobs", "quads_knobs", "working_point_knobs"):
+        deltas = powering_delta(getattr(nominal.config, knobs), getattr(waist.matched, knobs))
+        row.update({f"DELTA_{knob.upper()}": delta for knob, delta in deltas.items()})
+    return row
+
+
+if __name__ == "__main__":
+    scan()
@@ -0,0 +1,603 @@
+"""
+.. _search:
+
+Maximum Waist Shift Setting Search
+----------------------------------
+
+Command line script to find the largest rigid waist shift setting which keeps the powering of the
+affected magnets below their limits, and optionally the beta-beating below a target, at given IPs.
+Instead of a uniform scan, the limit is first bracketed by doubling the setting and then refined by
+safeguarded secant steps on the margin to the limits, each improved waist shift matching being
+warm-started from the solutions of the closest settings already run. As for scans, the nominal
+configuration of each beam is determined once for all IPs (or loaded from the cache), and the outputs
+of each run setting are written in its own sub-directory.
+"""
+import math
+import os
+
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+import rich_click as click
+import tfs
+
+from loguru import logger
+from rich.traceback import install as install_traceback
+
+from pyhdtoolkit.utils.contexts import timeit
+from pyhdtoolkit.utils.logging import config_logger
+from pyrws import profiling
+from pyrws.cache import NominalConfigCache, ResponseMatrixStore, invalidate_entries
+from pyrws.pipeline import (
+    NominalResult,
+    Stage,
+    WaistShiftResult,
+    close_sessions,
+    nominal_ips_stage,
+    run_stages,
+)
+from pyrws.scan import get_summary_row, run_scan_point
+from pyrws.utils import extrapolate_knobs
+
+install_traceback(width=130, suppress=[click])  # Rich handling of uncaught exceptions for the tracebacks
+
+
+@dataclass
+class SearchResult:
+    ip: int
+    max_setting: Optional[float]  # largest setting found within limits, None if none was
+    limit_setting: Optional[float]  # smallest setting found beyond limits, None if the upper bound is within them
+    rows: List[Dict[str, float]]  # summary rows of the run settings, in the order they were run
+
+
+@click.command()
+# ----- Required Arguments ----- #
+@click.option(
+    "--sequence",
+    type=click.Path(exists=True, file_okay=True, resolve_path=True, path_type=Path),
+    required=True,
+    help="Path to the LHC sequence file to use.",
+)
+@click.option(
+    "--opticsfile",
+    type=click.Path(exists=True, file_okay=True, resolve_path=True, path_type=Path),
+    required=True,
+    help="Path to the LHC optics file to use.",
+)
+@click.option(
+    "--ip",
+    type=click.IntRange(min=1, max=8),
+    multiple=True,
+    default=(1,),
+    show_default=True,
+    help="Which IP to search the maximum waist shift setting for. Should be 1, 2, 5 or 8. Can be given several times.",
+)
+@click.option(
+    "--outputdir",
+    type=click.Path(exists=False, file_okay=False, resolve_path=True, path_type=Path),
+    default=Path.cwd() / "search_outputs",
+    show_default=True,
+    help="Directory in which to write output files. Each run setting is written in an 'IP[n]/SETTING_[value]' "
+    "sub-directory and the summary table at the top level. Defaults to 'search_outputs/' in the current working directory.",
+)
+# ----- Search Arguments ----- #
+@click.option(
+    "--start",
+    type=click.FloatRange(min=0, min_open=True),
+    default=1,
+    show_default=True,
+    help="Unit setting of the rigid waist shift to start the search from. It is doubled until beyond the limits.",
+)
+@click.option(
+    "--max_setting",
+    type=click.FloatRange(min=0, min_open=True),
+    default=10,
+    show_default=True,
+    help="Highest unit setting of the rigid waist shift to consider.",
+)
+@click.option(
+    "--tolerance",
+    type=click.FloatRange(min=0, min_open=True),
+    default=0.05,
+    show_default=True,
+    help="Precision to which the maximum setting is determined: the search stops once the limit is bracketed by a setting "
+    "within limits and one beyond them which are closer than this.",
+)
+@click.option(
+    "--max_powering",
+    type=click.FloatRange(min=0, min_open=True),
+    default=100,
+    show_default=True,
+    help="Highest accepted powering of the affected magnets, in percent of their maximum powering. Settings beyond it in "
+    "the bare waist shift configuration are not matched at all.",
+)
+@click.option(
+    "--max_betabeating",
+    type=click.FloatRange(min=0, min_open=True),
+    default=None,
+    help="If provided, highest accepted peak beta-beating (as a fraction, for instance 0.1 for 10%) of the improved "
+    "waist shift configurations, in either plane.",
+)
+@click.option(
+    "--max_runs",
+    type=click.IntRange(min=1),
+    default=20,
+    show_default=True,
+    help="Maximum number of settings to run per IP, after which the best bracket found is reported.",
+)
+# ----- Optional Arguments ----- #
+@click.option("--energy", type=click.FloatRange(min=0), default=6800, show_default=True, help="Beam energy in [GeV]")
+@click.option(
+    "--qx",
+    type=click.FloatRange(min=0),
+    default=62.31,
+    show_default=True,
+    help="The horizontal tune to match to.",
+)
+@click.option(
+    "--qy",
+    type=click.FloatRange(min=0),
+    default=60.32,
+    show_default=True,
+    help="The vertical tune to match to.",
+)
+@click.option(
+    "--engine",
+    type=click.Choice(["match", "response"]),
+    default="match",
+    show_default=True,
+    help="How to improve the waist shift. With 'match' a full MAD-X matching is done, while with 'response' the "
+    "quadrupole knobs are solved for from a response matrix computed once in the nominal configuration, with a single "
+    "TWISS per iteration. The full matching is still done if the residual stays above --max_residual.",
+)
+@click.option(
+    "--max_residual",
+    type=click.FloatRange(min=0),
+    default=1e-4,
+    show_default=True,
+    help="Highest accepted residual (MAD-X penalty function value) for the 'response' engine.",
+)
+@click.option(
+    "--ir_segment",
+    type=click.BOOL,
+    default=False,
+    show_default=True,
+    help="Whether to do the improved waist shift matching on the IR segment only (from S.DS.L to E.DS.R of the IP), "
+    "with initial conditions from the bare waist shift TWISS, which makes each matching iteration much cheaper. A "
+    "single full ring TWISS is done afterwards to check the result.",
+)
+@click.option(
+    "--processes",
+    type=click.IntRange(min=1),
+    default=os.cpu_count(),
+    show_default=True,
+    help="Maximum number of stages to execute concurrently, each in its own process. The searches at different IPs are "
+    "independent, but the settings of a given IP are run one after the other.",
+)
+@click.option(
+    "--cache_dir",
+    type=click.Path(exists=False, file_okay=False, resolve_path=True, path_type=Path),
+    default=None,
+    help="If provided, directory of a persistent cache for the nominal configurations and response matrices, shared "
+    "with scans and with the main command line.",
+)
+@click.option(
+    "--cache_size",
+    type=click.FloatRange(min=0),
+    default=1000,
+    show_default=True,
+    help="Maximum size of the nominal configurations cache, in [MB]. Least recently used entries are evicted beyond.",
+)
+@click.option(
+    "--refresh_cache",
+    type=click.BOOL,
+    default=False,
+    show_default=True,
+    help="Whether to invalidate the cache entries for the inputs of this run before running, to force their "
+    "recomputation. Useful if a file called by the sequence or optics file changed, as only their own contents are hashed.",
+)
+@click.option(
+    "--loglevel",
+    type=click.Choice(["trace", "debug", "info", "warning", "error", "critical"]),
+    default="info",
+    show_default=True,
+    help="Sets the logging level.",
+)
+def find_max_setting(
+    sequence: Path,
+    opticsfile: Path,
+    ip: Tuple[int, ...],
+    outputdir: Path,
+    start: float,
+    max_setting: float,
+    tolerance: float,
+    max_powering: float,
+    max_betabeating: Optional[float],
+    max_runs: int,
+    energy: Optional[float],
+    qx: Optional[float],
+    qy: Optional[float],
+    engine: Optional[str],
+    max_residual: Optional[float],
+    ir_segment: Optional[bool],
+    processes: Optional[int],
+    cache_dir: Optional[Path],
+    cache_size: Optional[float],
+    refresh_cache: Optional[bool],
+    loglevel: Optional[str],
+):
+    """
+    Command-line program to find the maximum rigid waist shift setting for the LHC. Given a
+    sequence, optics file and IPs, will search for the largest setting keeping the affected
+    magnets below the powering limit (and the beta-beating below the target, if given), and
+    write the knobs of each run setting as well as a summary table. No plots are generated.
+    """
+    # ----- Configuration ----- #
+    config_logger(level=loglevel)
+    ips = tuple(dict.fromkeys(ip))  # without duplicates, in the given order
+    if start > max_setting:
+        raise click.UsageError(f"The --start setting ({start:g}) should not be above --max_setting ({max_setting:g})")
+    logger.info(f"Searching the maximum waist shift setting up to {max_setting:g} at IP(s) {', '.join(str(i) for i in ips)}")
+
+    cache, responses = None, None
+    if cache_dir is not None:
+        cache, responses = NominalConfigCache(cache_dir, max_size=cache_size), ResponseMatrixStore(cache_dir)
+        if refresh_cache:
+            for search_ip in ips:
+                invalidate_entries(cache, responses, sequence, opticsfile, energy=energy, ip=search_ip, qx=qx, qy=qy)
+
+    # ----- Run All Stages ----- #
+    stages = get_search_stages(
+        outputdir=outputdir,
+        sequence=sequence,
+        opticsfile=opticsfile,
+        energy=energy,
+        ips=ips,
+        qx=qx,
+        qy=qy,
+        start=start,
+        max_setting=max_setting,
+        tolerance=tolerance,
+        max_powering=max_powering,
+        max_betabeating=max_betabeating,
+        max_runs=max_runs,
+        engine=engine,
+        max_residual=max_residual,
+        ir_segment=ir_segment,
+        cache=cache,
+        responses=responses,
+    )
+    with profiling.section("search_stages"), timeit(
+        lambda spanned: logger.info(f"Ran all {len(stages)} search stages in {spanned:.2f} seconds")
+    ):
+        results = run_stages(stages, parallel=True, processes=processes, loglevel=loglevel)
+    searches: List[SearchResult] = [result for name, result in results.items() if name.startswith("search_")]
+
+    # ----- Summary Table ----- #
+    summary = tfs.TfsDataFrame(pd.DataFrame([row for search in searches for row in search.rows]))
+    summary.headers = {"SEQUENCE": str(sequence), "OPTICSFILE": str(opticsfile), "ENERGY": energy, "QX": qx, "QY": qy}
+    summary.headers.update(MAX_POWERING=max_powering, MAX_BETABEATING=max_betabeating or 0, TOLERANCE=tolerance)
+    for search in searches:
+        summary.headers[f"MAX_SETTING_IP{search.ip:d}"] = search.max_setting if search.max_setting is not None else np.nan
+    tfs.write(outputdir / "search_summary.tfs", summary)
+    logger.info(f"Wrote search summary to '{outputdir / 'search_summary.tfs'}'")
+    profiling.write_timings(
+        outputdir / "timings.json", sequence=sequence, opticsfile=opticsfile, ips=ips, max_setting=max_setting
+    )
+
+    uniform_runs = math.ceil(max_setting / tolerance)
+    for search in searches:
+        runs = len(search.rows) // 2
+        if search.max_setting is None:
+            logger.warning(f"No setting within limits was found at IP{search.ip:d} (down to {search.limit_setting:g})")
+        elif search.limit_setting is None:
+            logger.info(f"The highest considered setting, {search.max_setting:g}, is within limits at IP{search.ip:d}")
+        else:
+            setting_dir = outputdir / f"IP{search.ip:d}" / f"SETTING_{search.max_setting:g}"
+            logger.info(
+                f"Maximum setting within limits at IP{search.ip:d} is {search.max_setting:g} (limit below "
+                f"{search.limit_setting:g}), with outputs in '{setting_dir}'"
+            )
+        logger.info(f"Searched IP{search.ip:d} in {runs} runs, where a uniform scan at this tolerance needs {uniform_runs}")
+
+
+# ----- Search Stages ----- #
+
+
+def get_search_stages(
+    outputdir: Path,
+    sequence: Path,
+    opticsfile: Path,
+    energy: float,
+    ips: Sequence[int],
+    qx: float,
+    qy: float,
+    start: float = 1,
+    max_setting: float = 10,
+    tolerance: float = 0.05,
+    max_powering: float = 100,
+    max_betabeating: Optional[float] = None,
+    max_runs: int = 20,
+    engine: str = "match",
+    max_residual: float = 1e-4,
+    ir_segment: bool = False,
+    cache: Optional[NominalConfigCache] = None,
+    responses: Optional[ResponseMatrixStore] = None,
+) -> List[Stage]:
+    """
+    Builds the stage graph of a search: one nominal stage per beam for all IPs, named ``nominal_b[12]`` (see
+    `~pyrws.pipeline.nominal_ips_stage`) and logging to *outputdir*, and one search stage per IP, named
+    ``search_ip[n]``, which depends on the nominal results of its IP.
+
+    Args:
+        outputdir (Path): `~pathlib.Path` to the main output directory of the search.
+        sequence (Path): `~pathlib.Path` to the LHC sequence file to use.
+        opticsfile (Path): `~pathlib.Path` to the LHC optics file to use.
+        energy (float): beam energy for the setup, in [GeV].
+        ips (Sequence[int]): the IPs at which to search the maximum setting.
+        qx (float): the horizontal tune to match to.
+        qy (float): the vertical tune to match to.
+        start (float): the setting to start the search from. Defaults to 1.
+        max_setting (float): the highest setting to consider. Defaults to 10.
+        tolerance (float): the precision to which to determine the maximum setting. Defaults to 0.05.
+        max_powering (float): the highest accepted powering of the affected magnets, in percent of their
+            maximum powering. Defaults to 100.
+        max_betabeating (float): if provided, the highest accepted peak beta-beating of the improved
+            waist shift configurations.
+        max_runs (int): the maximum number of settings to run per IP. Defaults to 20.
+        engine (str): how to improve the waist shift, see `~pyrws.pipeline.waist_shift_stage`. With
+            ``response``, the response matrices are computed once per beam and IP in the nominal stages.
+        max_residual (float): the highest accepted residual for the ``response`` engine.
+        ir_segment (bool): if `True`, the improved waist shift matchings twiss the IR segment only.
+        cache (NominalConfigCache): if provided, the cache from which to load and in which to store
+            the nominal configurations.
+        responses (ResponseMatrixStore): if provided, the store from which to load and in which to
+            save the response matrices for the ``response`` engine.
+
+    Returns:
+        A `list` of the `~pyrws.pipeline.Stage` objects to execute.
+    """
+    common = dict(sequence=sequence, opticsfile=opticsfile, energy=energy, qx=qx, qy=qy)
+    for ip in ips:
+        (outputdir / f"IP{ip:d}").mkdir(parents=True, exist_ok=True)
+    stages: List[Stage] = [
+        Stage(
+            f"nominal_b{beam:d}",
+            nominal_ips_stage,
+            kwargs=dict(
+                workdir=outputdir,  # the logs of these stages cover all IPs
+                beam=beam,
+                ips=ips,
+                cache=cache,
+                response_matrix=engine == "response",
+                responses=responses,
+                **common,
+            ),
+        )
+        for beam in (1, 2)
+    ]
+    for ip in ips:
+        ip_dir = outputdir / f"IP{ip:d}"
+        stages.append(
+            Stage(
+                f"search_ip{ip:d}",
+                search_stage,
+                kwargs=dict(
+                    ipdir=ip_dir,
+                    ip=ip,
+                    start=start,
+                    max_setting=max_setting,
+                    tolerance=tolerance,
+                    max_powering=max_powering,
+                    max_betabeating=max_betabeating,
+                    max_runs=max_runs,
+                    engine=engine,
+                    max_residual=max_residual,
+                    ir_segment=ir_segment,
+                    **common,
+                ),
+                depends_on={"nominal_b1": ("nominal_b1", ip), "nominal_b2": ("nominal_b2", ip)},
+            )
+        )
+    return stages
+
+
+def search_stage(
+    ipdir: Path,
+    sequence: Path,
+    opticsfile: Path,
+    energy: float,
+    ip: int,
+    qx: float,
+    qy: float,
+    nominal_b1: NominalResult,
+    nominal_b2: NominalResult,
+    start: float = 1,
+    max_setting: float = 10,
+    tolerance: float = 0.05,
+    max_powering: float = 100,
+    max_betabeating: Optional[float] = None,
+    max_runs: int = 20,
+    engine: str = "match",
+    max_residual: float = 1e-4,
+    ir_segment: bool = False,
+) -> SearchResult:
+    """
+    Searches the maximum waist shift setting at the given *ip* (see `~.find_limit_setting`), running
+    the waist shift stages of both beams for each tried setting and writing their output files in a
+    ``SETTING_[value]`` sub-directory of *ipdir*. The improved waist shift matching of each setting is
+    warm-started from the solutions of the two closest settings already run, and the sequence and
+    optics are loaded only once per beam for all settings (see `~pyrws.pipeline.MadxSession`).
+
+    Args:
+        ipdir (Path): `~pathlib.Path` to the output directory of the search for this *ip*.
+        sequence (Path): `~pathlib.Path` to the LHC sequence file to use.
+        opticsfile (Path): `~pathlib.Path` to the LHC optics file to use.
+        energy (float): beam energy for the setup, in [GeV].
+        ip (int): the IP at which to apply the rigid waist shift.
+        qx (float): the horizontal tune to match to.
+        qy (float): the vertical tune to match to.
+        nominal_b1 (NominalResult): the nominal configuration of beam 1 at this *ip*.
+        nominal_b2 (NominalResult): the nominal configuration of beam 2 at this *ip*.
+        start (float): the setting to start the search from. Defaults to 1.
+        max_setting (float): the highest setting to consider. Defaults to 10.
+        tolerance (float): the precision to which to determine the maximum setting. Defaults to 0.05.
+        max_powering (float): the highest accepted powering of the affected magnets, in percent of their
+            maximum powering. Defaults to 100.
+        max_betabeating (float): if provided, the highest accepted peak beta-beating of the improved
+            waist shift configurations.
+        max_runs (int): the maximum number of settings to run. Defaults to 20.
+        engine (str): how to improve the waist shift, see `~pyrws.pipeline.waist_shift_stage`.
+        max_residual (float): the highest accepted residual for the ``response`` engine.
+        ir_segment (bool): if `True`, the improved waist shift matchings twiss the IR segment only.
+
+    Returns:
+        A `~.SearchResult` with the maximum setting found and the summary rows of the run settings, which
+        are the ones of scans (see `~pyrws.scan.get_summary_row`) with the ``MARGIN`` to the limits and
+        a ``WITHIN_LIMITS`` flag.
+    """
+    common = dict(sequence=sequence, opticsfile=opticsfile, energy=energy, ip=ip, qx=qx, qy=qy, reuse_session=True)
+    common.update(engine=engine, max_residual=max_residual, ir_segment=ir_segment, max_powering=max_powering)
+    solutions: Dict[int, List[Tuple[float, Dict[str, float]]]] = {1: [], 2: []}
+    rows: List[Dict[str, float]] = []
+
+    def evaluate(setting: float) -> Optional[float]:
+        logger.info(f"Running a waist shift setting of {setting:g} at IP{ip:d}")
+        warm_starts = {beam: get_warm_start_knobs(solutions[beam], setting) for beam in (1, 2)}
+        waists = run_scan_point(ipdir, setting, nominal_b1, nominal_b2, warm_starts, **common)
+        margin = get_setting_margin(waists, max_powering=max_powering, max_betabeating=max_betabeating)
+        within_limits = margin is not None and margin >= 0
+        logger.info(f"Setting {setting:g} at IP{ip:d} is {'within' if within_limits else 'beyond'} limits (margin {margin})")
+        for beam, nominal in ((1, nominal_b1), (2, nominal_b2)):
+            row = get_summary_row(ip, setting, beam, nominal, waists[beam], warm_started=warm_starts[beam] is not None)
+            rows.append({**row, "MARGIN": margin if margin is not None else np.nan, "WITHIN_LIMITS": int(within_limits)})
+            if waists[beam].matched is not None and waists[beam].matched.match_residual is not None:
+                solutions[beam].append((setting, waists[beam].matched.quads_knobs))
+        return margin
+
+    try:
+        max_found, limit_found = find_limit_setting(evaluate, start, max_setting, tolerance=tolerance, max_runs=max_runs)
+    finally:
+        close_sessions()
+    return SearchResult(ip=ip, max_setting=max_found, limit_setting=limit_found, rows=rows)
+
+
+# ----- Search Algorithm ----- #
+
+
+def find_limit_setting(
+    evaluate: Callable[[float], Optional[float]],
+    start: float,
+    max_setting: float,
+    tolerance: float,
+    max_runs: int = 20,
+) -> Tuple[Optional[float], Optional[float]]:
+    """
+    Finds the largest setting in :math:`]0, max\\_setting]` for which *evaluate* gives a positive margin
+    to the limits. The setting is doubled from *start* until the margin is negative, a setting of 0 being
+    assumed within limits, and the bracket is then shrunk by secant steps on the margin (with the Illinois
+    modification, to not keep an end of the bracket forever) or bisection steps when a margin is unknown.
+    Each step is kept at least half the *tolerance* inside the bracket, so that a step landing just within
+    the limits is followed by one just beyond them.
+
+    Args:
+        evaluate (Callable[[float], Optional[float]]): function returning the margin to the limits of
+            a setting, positive if within limits and negative otherwise, or `None` if it could not be
+            determined (for instance if the matching failed), which counts as beyond limits.
+        start (float): the setting to start from.
+        max_setting (float): the highest setting to consider.
+        tolerance (float): the width of the bracket below which the search stops.
+        max_runs (int): the maximum number of calls to *evaluate*. Defaults to 20.
+
+    Returns:
+        A `tuple` of the largest setting found within limits (`None` if none was) and the smallest
+        one found beyond limits (`None` if *max_setting* is within limits).
+    """
+    lower, lower_margin = None, None  # largest setting found within limits and its margin
+    upper, upper_margin = None, None  # smallest setting found beyond limits and its margin
+    setting, last_moved = min(start, max_setting), None
+    for _ in range(max_runs):
+        margin = evaluate(setting)
+        if margin is not None and margin >= 0:
+            lower, lower_margin, moved = setting, margin, "lower"
+        else:
+            upper, upper_margin, moved = setting, margin, "upper"
+
+        if upper is None:  # still bracketing
+            if setting >= max_setting:
+                break
+            setting = min(2 * setting, max_setting)
+            continue
+
+        low = lower if lower is not None else 0.0
+        if upper - low <= tolerance:
+            break
+        if moved == last_moved:  # Illinois: the other end of the bracket was kept twice, reduce its weight
+            if moved == "lower" and upper_margin is not None:
+                upper_margin /= 2
+            elif moved == "upper" and lower_margin is not None:
+                lower_margin /= 2
+        last_moved = moved
+        setting = _get_next_setting(low, lower_margin, upper, upper_margin, tolerance)
+    return lower, upper
+
+
+def get_setting_margin(
+    waists: Dict[int, WaistShiftResult], max_powering: float, max_betabeating: Optional[float] = None
+) -> Optional[float]:
+    """
+    Returns the relative margin to the limits of a waist shift setting, from the results of both beams:
+    the smallest of :math:`1 - percent / max\\_powering` for the highest powering of the affected magnets
+    (in the improved configuration, or in the bare one if it was deemed infeasible) and of
+    :math:`1 - peak / max\\_betabeating` for the peak beta-beating of the improved configuration.
+
+    Args:
+        waists (Dict[int, WaistShiftResult]): the results of the waist shift stages, for each beam.
+        max_powering (float): the highest accepted powering, in percent of the maximum powering.
+        max_betabeating (float): if provided, the highest accepted peak beta-beating.
+
+    Returns:
+        The margin, positive if the setting is within limits and negative otherwise, or `None` if
+        it could not be determined because an improved waist shift matching failed.
+    """
+    margins = []
+    for waist in waists.values():
+        if waist.feasible and waist.matched.match_residual is None:  # MAD-X crashed during the matching
+            return None
+        fields = waist.fields if waist.feasible else waist.bare_fields
+        if fields is not None:
+            margins.append(1 - fields.percent.max() / max_powering)
+        if waist.feasible and max_betabeating is not None:
+            peak = max(waist.matched.twiss_tfs.BBX.abs().max(), waist.matched.twiss_tfs.BBY.abs().max())
+            margins.append(1 - peak / max_betabeating)
+    return min(margins) if margins else None
+
+
+def get_warm_start_knobs(solutions: Sequence[Tuple[float, Dict[str, float]]], setting: float) -> Optional[Dict[str, float]]:
+    """
+    Estimates the knob values for the given *setting* from the two closest previous *solutions*, see
+    `~pyrws.utils.extrapolate_knobs`, or returns `None` if there is no previous solution.
+    """
+    closest = sorted(solutions, key=lambda solution: abs(solution[0] - setting), reverse=True)[-2:]
+    return extrapolate_knobs(closest, setting) if closest else None
+
+
+# ----- Helpers ----- #
+
+
+def _get_next_setting(
+    low: float, low_margin: Optional[float], high: float, high_margin: Optional[float], tolerance: float
+) -> float:
+    """Returns the next setting to try in the bracket, by a secant step if possible and bisection otherwise."""
+    if low_margin is None or high_margin is None or low_margin <= high_margin:
+        setting = (low + high) / 2
+    else:
+        setting = low + (high - low) * low_margin / (low_margin - high_margin)
+    return min(max(setting, low + tolerance / 2), high - tolerance / 2)
+
+
+if __name__ == "__main__":
+    find_max_setting()
@@ -6,10 +6,15 @@ Utilities
 
 Provides miscellaneous utility functions.
 """
-import shlex
+import json
+import os
+import re
+import threading
 
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import nullcontext
 from pathlib import Path
-from typing import Dict, Sequence, Tuple, Union
+from typing import IO, TYPE_CHECKING, Callable, Dict, List, Optional, Sequence, Tuple, Union
 
 import numpy as np
 import pandas as pd
@@ -19,12 +24,65 @@ from cpymad.madx import Madx
 from loguru import logger
 
 from pyhdtoolkit.cpymadtools.lhc import get_lhc_tune_and_chroma_knobs
+from pyhdtoolkit.utils.contexts import timeit
 from pyrws.constants import EXPORT_TWISS_COLUMNS
 
+if TYPE_CHECKING:
+    from pyrws.core import BeamConfig
+
 Array = Union[np.ndarray, pd.Series]
 
 # ----- Querying Utilities ----- #
 
+_GLOBALS_TABLE = "pyrws_globals"  # internal MAD-X table used to query globals in bulk
+
+
+def get_globals_values(madx: Madx, names: Sequence[str]) -> Dict[str, float]:
+    """
+    Returns the values of the provided global variables. Instead of one ``RPC`` round trip to the
+    ``MAD-X`` process per variable as with ``madx.globals[name]``, this takes three whatever their
+    number: an internal table with one column per variable is created and filled with their current
+    values, and its only row is read back.
+
+    .. note::
+        In a table, as in ``MAD-X`` expressions, undefined variables have a value of 0. The variables
+        with a value of 0 are then checked to be defined, with one more round trip each, so that a
+        misspelled name raises a `KeyError` as with ``madx.globals`` instead of reading as 0.
+
+    Args:
+        madx (cpymad.madx.Madx): an instantiated `~cpymad.madx.Madx` object.
+        names (Sequence[str]): the names of the global variables to get the values of.
+
+    Returns:
+        A `dict` of the variable names, as provided, and their values.
+
+    Raises:
+        KeyError: if any of the variables is not defined.
+    """
+    if len(names) == 0:
+        return {}
+    row = _query_globals(madx, names)
+    undefined = [column for column, value in row.items() if value == 0 and column not in madx.globals]
+    if undefined:
+        raise KeyError(f"Undefined global variable(s): {', '.join(undefined)}")
+    return {name: float(row[name.lower()]) for name in names}
+
+
+def get_globals_array(madx: Madx, names: Sequence[str]) -> np.ndarray:
+    """
+    Returns the values of the provided global variables as a structured `~numpy.ndarray` with one
+    field per variable, so they can be indexed by name. See `~.get_globals_values` for the details.
+
+    Args:
+        madx (cpymad.madx.Madx): an instantiated `~cpymad.madx.Madx` object.
+        names (Sequence[str]): the names of the global variables to get the values of.
+
+    Returns:
+        A 0-dimensional structured `~numpy.ndarray`, for instance ``values["kqx.r1"]``.
+    """
+    values = get_globals_values(madx, names)
+    return np.array(tuple(values.values()), dtype=[(name, float) for name in values])
+
 
 def get_triplets_powering_knobs(madx: Madx, ip: int) -> Dict[str, float]:
     """
@@ -38,8 +96,7 @@ def get_triplets_powering_knobs(madx: Madx, ip: int) -> Dict[str, float]:
         A `dict` of the knob names and their values.
     """
     logger.debug(f"Querying triplets powering knob values around IP{ip:d}.")
-    right_knob, left_knob = f"kqx.r{ip:d}", f"kqx.l{ip:d}"  # IP triplet default knobs (no trims)
-    return {right_knob: madx.globals[right_knob], left_knob: madx.globals[left_knob]}
+    return get_globals_values(madx, _get_triplets_knob_names(ip))
 
 
 def get_independent_quadrupoles_powering_knobs(madx: Madx, quad_numbers: Sequence[int], ip: int, beam: int) -> Dict[str, float]:
@@ -56,14 +113,7 @@ def get_independent_quadrupoles_powering_knobs(madx: Madx, quad_numbers: Sequenc
         A `dict` of the knob names and their values.
     """
     logger.debug(f"Querying powering knob values for quadrupoles {quad_numbers} around IP{ip:d}.")
-    powering_knobs = {}
-    sides = ("r", "l")
-    for quad in quad_numbers:
-        for side in sides:
-            logger.trace(f"Getting powering knob for Q{quad}{side.upper()}{ip}")
-            knob = f"kq{'t' if quad >= 11 else ''}{'l' if quad == 11 else ''}{quad}.{side}{ip}b{beam}"
-            powering_knobs[knob] = madx.globals[knob]
-    return powering_knobs
+    return get_globals_values(madx, _get_quadrupoles_knob_names(quad_numbers, ip, beam))
 
 
 def get_tunes_and_chroma_knobs(madx: Madx, beam: int, telescopic_squeeze: bool = True) -> Dict[str, float]:
@@ -81,7 +131,162 @@ def get_tunes_and_chroma_knobs(madx: Madx, beam: int, telescopic_squeeze: bool =
     """
     logger.debug("Querying tune and chroma knobs")
     knobs = get_lhc_tune_and_chroma_knobs("lhc", beam, telescopic_squeeze)
-    return {knob_name: madx.globals[knob_name] for knob_name in knobs}
+    return get_globals_values(madx, knobs)
+
+
+def get_all_powering_knobs(
+    madx: Madx, quad_numbers: Sequence[int], ip: int, beam: int, telescopic_squeeze: bool = True
+) -> Tuple[Dict[str, float], Dict[str, float], Dict[str, float]]:
+    """
+    Returns the triplets powering, independent quadrupoles powering and tunes and chroma knobs all at
+    once, as would `~.get_triplets_powering_knobs`, `~.get_independent_quadrupoles_powering_knobs` and
+    `~.get_tunes_and_chroma_knobs`, but in a single query of the ``MAD-X`` globals.
+
+    Args:
+        madx (cpymad.madx.Madx): an instantiated `~cpymad.madx.Madx` object.
+        quad_numbers (Sequence[int]): quadrupoles to get the powering for, by number
+            (aka position from IP).
+        ip (int): the IP around which to get the powering knobs for.
+        beam (int): the beam number to get knob values for.
+        telescopic_squeeze (bool): if set to `True`, returns the tune and chroma knobs for
+            Telescopic Squeeze configuration. Defaults to `True` to reflect run III scenarios.
+
+    Returns:
+        A `tuple` of the triplets, quadrupoles and working point knobs `dict`, each of the knob
+        names and their values.
+    """
+    logger.debug(f"Querying triplets, quadrupoles {quad_numbers} and working point knob values for IP{ip:d}.")
+    triplets = _get_triplets_knob_names(ip)
+    quadrupoles = _get_quadrupoles_knob_names(quad_numbers, ip, beam)
+    working_point = get_lhc_tune_and_chroma_knobs("lhc", beam, telescopic_squeeze)
+    values = get_globals_values(madx, [*triplets, *quadrupoles, *working_point])
+    return tuple({knob: values[knob] for knob in knobs} for knobs in (triplets, quadrupoles, working_point))
+
+
+def _get_triplets_knob_names(ip: int) -> List[str]:
+    """Returns the names of the triplets powering knobs at the given IP."""
+    return [f"kqx.r{ip:d}", f"kqx.l{ip:d}"]  # IP triplet default knobs (no trims)
+
+
+def _get_quadrupoles_knob_names(quad_numbers: Sequence[int], ip: int, beam: int) -> List[str]:
+    """Returns the names of the powering knobs of the provided quadrupoles around the given IP."""
+    knobs = []
+    sides = ("r", "l")
+    for quad in quad_numbers:
+        for side in sides:
+            knobs.append(f"kq{'t' if quad >= 11 else ''}{'l' if quad == 11 else ''}{quad}.{side}{ip}b{beam}")
+    return knobs
+
+
+def _query_globals(madx: Madx, names: Sequence[str]) -> Dict[str, float]:
+    """Returns the values of the provided global variables by lowercase name, in bulk through `~._GLOBALS_TABLE`."""
+    columns = list(dict.fromkeys(name.lower() for name in names))  # MAD-X names are case-insensitive
+    madx.input(
+        f"delete, table={_GLOBALS_TABLE}; "
+        f"create, table={_GLOBALS_TABLE}, column={', '.join(columns)}; "
+        f"fill, table={_GLOBALS_TABLE};"
+    )
+    row = madx.table[_GLOBALS_TABLE].row(0, columns)
+    return {column: float(row[column]) for column in columns}
+
+
+# ----- Globals Utilities ----- #
+
+
+def get_globals_snapshot(madx: Madx) -> Dict[str, Union[float, str]]:
+    """
+    Returns the definitions of all non-constant global variables in ``MAD-X``, which can
+    be given to `~.restore_globals_snapshot` later on.
+
+    .. note::
+        ``MAD-X`` only exposes the definitions of variables one at a time, so this takes one
+        ``RPC`` round trip per variable (about half a second for ten thousand variables). It is
+        meant to be taken once, for instance when opening a `~pyrws.pipeline.MadxSession`, while
+        the changes since are found in bulk (see `~.get_changed_globals`).
+
+    Args:
+        madx (cpymad.madx.Madx): an instantiated `~cpymad.madx.Madx` object.
+
+    Returns:
+        A `dict` of the variable names and their definitions, which is the expression
+        as a string for deferred variables and the value otherwise.
+    """
+    logger.debug("Taking a snapshot of MAD-X globals")
+    return dict(madx.globals.defs)
+
+
+def get_all_globals_values(madx: Madx) -> Dict[str, float]:
+    """
+    Returns the values of all global variables in ``MAD-X``, in bulk as in `~.get_globals_values`,
+    which can be given to `~.get_changed_globals` later on.
+
+    Args:
+        madx (cpymad.madx.Madx): an instantiated `~cpymad.madx.Madx` object.
+
+    Returns:
+        A `dict` of the variable names and their values.
+    """
+    return _query_globals(madx, list(madx.globals))
+
+
+def get_changed_globals(madx: Madx, values: Dict[str, float]) -> Dict[str, Union[float, str]]:
+    """
+    Returns the definitions of the global variables in ``MAD-X`` which were created or which value
+    changed since the provided *values* were taken (see `~.get_all_globals_values`). The values are
+    compared in bulk, and only the definitions of the changed variables are then read.
+
+    .. note::
+        Deferred variables which value changed because of the variables they depend on are included,
+        with their expression. A variable re-defined with the same value, for instance as a deferred
+        expression, is not.
+
+    Args:
+        madx (cpymad.madx.Madx): an instantiated `~cpymad.madx.Madx` object.
+        values (Dict[str, float]): the previous values of the variables.
+
+    Returns:
+        A `dict` of the variable names and their definitions, as in `~.get_globals_snapshot`.
+    """
+    current = get_all_globals_values(madx)
+    changed = [name for name, value in current.items() if values.get(name) != value]
+    return {name: madx.globals.cmdpar[name].definition for name in changed}
+
+
+def restore_globals_snapshot(madx: Madx, snapshot: Dict[str, Union[float, str]]) -> int:
+    """
+    Restores the global variables in ``MAD-X`` to their definitions in the provided *snapshot*, as
+    returned by `~.get_globals_snapshot` or `~.get_changed_globals`. The current values are compared
+    in bulk, and all variables which value has changed since are re-defined in a single batch together
+    with all the deferred ones, which are kept deferred.
+
+    .. note::
+        Variables created after the snapshot was taken can not be deleted in ``MAD-X``, and are left
+        untouched. A variable of the snapshot which was since re-defined as a deferred expression with
+        the same value is also left as is.
+
+    Args:
+        madx (cpymad.madx.Madx): an instantiated `~cpymad.madx.Madx` object.
+        snapshot (Dict[str, Union[float, str]]): the variables definitions to restore.
+
+    Returns:
+        The number of variables that were re-defined.
+    """
+    if not snapshot:
+        return 0
+    current = _query_globals(madx, list(snapshot))
+    changed = {
+        name: definition
+        for name, definition in snapshot.items()
+        if isinstance(definition, str) or current[name.lower()] != definition
+    }
+    logger.debug(f"Restoring {len(changed)} MAD-X globals from snapshot")
+    with madx.batch():
+        for name, definition in changed.items():
+            if isinstance(definition, str):  # deferred expression
+                madx.input(f"{name} := {definition};")
+            else:
+                madx.input(f"{name} = {definition!r};")
+    return len(changed)
 
 
 # ----- Computing Utilities ----- #
@@ -113,14 +318,38 @@ def add_betabeating_columns(dataframe: pd.DataFrame, nominal: pd.DataFrame) -> p
             beta-beating calculations.
 
     Returns:
-        A copy of the original *dataframe* with the new columns added.
+        A shallow copy of the original *dataframe* with the new columns added. It shares the data of the
+        existing columns and the ``headers`` (for a `~tfs.TfsDataFrame`) with *dataframe*, so these should
+        not be modified in place on either of them.
     """
-    df = dataframe.copy(deep=True)
+    df = dataframe.copy(deep=False)  # new columns are not added to the original, no need to copy its data
     df["BBX"] = betabeating(nominal.BETX, df.BETX)
     df["BBY"] = betabeating(nominal.BETY, df.BETY)
     return df
 
 
+def extrapolate_knobs(previous: Sequence[Tuple[float, Dict[str, float]]], setting: float) -> Dict[str, float]:
+    """
+    Estimates the knob values for the given waist shift *setting* from previously determined
+    solutions, to be used as a starting point for the matching. With a single previous solution
+    its values are returned, otherwise a linear extrapolation from the last two is made.
+
+    Args:
+        previous (Sequence[Tuple[float, Dict[str, float]]]): the previous solutions, as tuples of
+            the waist shift setting and the `dict` of knob names and values, in the order they were
+            determined.
+        setting (float): the waist shift setting to estimate the knob values for.
+
+    Returns:
+        A `dict` of the knob names and their estimated values.
+    """
+    if len(previous) == 1 or previous[-1][0] == previous[-2][0]:
+        return dict(previous[-1][1])
+    (setting_0, knobs_0), (setting_1, knobs_1) = previous[-2:]
+    ratio = (setting - setting_1) / (setting_1 - setting_0)
+    return {knob: value + ratio * (value - knobs_0[knob]) for knob, value in knobs_1.items()}
+
+
 def powering_delta(nominal_knobs: Dict[str, float], modified_knobs: Dict[str, float]) -> Dict[str, float]:
     """
     Compute the delta between the modified and nominal knobs, to determine the powering
@@ -151,12 +380,11 @@ def only_export_columns(dataframe: pd.DataFrame) -> pd.DataFrame:
         dataframe (pd.DataFrame): the `~pd.DataFrame` to do a selection of columns for.
 
     Returns:
-        A copy of the original *dataframe* with only the desired columns in.
+        A new `~pd.DataFrame` with only the desired columns in. It does not copy the data of
+        the original *dataframe*, and should not be modified in place.
     """
-    df = dataframe.reset_index().copy(deep=True)
-    intersect_columns = [val for val in df.columns if val in EXPORT_TWISS_COLUMNS]
-    df = df[intersect_columns]
-    return df
+    df = dataframe.reset_index()
+    return df[get_export_columns(df)]
 
 
 def only_monitors(dataframe: pd.DataFrame) -> pd.DataFrame:
@@ -170,9 +398,51 @@ def only_monitors(dataframe: pd.DataFrame) -> pd.DataFrame:
     Returns:
         A copy of the original *dataframe* with only the desired rows in.
     """
-    df = dataframe.copy(deep=True)
-    df = df[df.KEYWORD == "monitor"]
-    return df
+    return dataframe[get_monitors_mask(dataframe)]
+
+
+def get_export_columns(dataframe: pd.DataFrame) -> List[str]:
+    """
+    Returns the columns of *dataframe*, including its index if named, which are meant for writing to disk.
+
+    Args:
+        dataframe (pd.DataFrame): the `~pd.DataFrame` to get the export columns of.
+
+    Returns:
+        A `list` of the column names, in the order they would have after resetting the index.
+    """
+    return [column for column in (dataframe.index.name, *dataframe.columns) if column in EXPORT_TWISS_COLUMNS]
+
+
+def get_monitors_mask(dataframe: pd.DataFrame) -> np.ndarray:
+    """
+    Returns a boolean mask of the rows of *dataframe* corresponding to monitor elements (aka BPMs).
+
+    Args:
+        dataframe (pd.DataFrame): the `~pd.DataFrame` to get the mask for, with a ``KEYWORD`` column.
+
+    Returns:
+        A boolean `~numpy.ndarray` with one entry per row of *dataframe*.
+    """
+    return (dataframe.KEYWORD == "monitor").to_numpy()
+
+
+def get_export_views(dataframe: pd.DataFrame, monitors: np.ndarray) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Returns the full and monitors-only sub-selections of *dataframe* meant for writing to disk, with
+    only the export columns. The full selection does not copy the data of *dataframe*, and only the
+    monitor rows are gathered for the other. Neither should be modified in place.
+
+    Args:
+        dataframe (pd.DataFrame): the ``TWISS`` `~pd.DataFrame`, indexed by element ``NAME``.
+        monitors (np.ndarray): the monitors mask of *dataframe*, as given by `~.get_monitors_mask`.
+            It can be computed once for all the ``TWISS`` dataframes of the same sequence.
+
+    Returns:
+        A `tuple` of the full and monitors-only selections.
+    """
+    full = dataframe.reset_index()[get_export_columns(dataframe)]
+    return full, full[monitors]
 
 
 # ----- FileSystem Utilities ----- #
@@ -234,14 +504,90 @@ def prepare_output_directories(outputdir: Path) -> Tuple[Dict[str, Path], Dict[s
     )
 
 
+class OutputsWriter:
+    """
+    Writes output files concurrently on a pool of threads, so that the latency of each file opening
+    on network filesystems (such as ``AFS``) is not paid sequentially, and so that the caller can carry
+    on with other work (for instance the ``MAD-X`` stages of the other beam) while files are written.
+    Each file is first written to a temporary file in the same directory, then renamed to its final
+    name, so that no partially written output is ever left behind. Leaving the context waits for all
+    submitted writes.
+
+    Args:
+        max_workers (int): the maximum number of threads writing files. Defaults to `None`, for
+            the `~concurrent.futures.ThreadPoolExecutor` default.
+
+    Example:
+        .. code-block:: python
+
+            >>> with OutputsWriter() as writer:
+            ...     writer.submit(tfs.write, outputdir / "nominal_b1.tfs", dataframe)
+            ...     writer.submit(write_knob_powering, outputdir / "triplets.madx", knobs)
+    """
+
+    def __init__(self, max_workers: Optional[int] = None):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="pyrws-writer")
+        self.futures: List[Future] = []
+
+    def __enter__(self) -> "OutputsWriter":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        try:
+            if exc_info[0] is None:
+                self.wait()
+        finally:
+            self.executor.shutdown(wait=True)
+
+    def submit(self, function: Callable[..., None], file_path: Path, *args, **kwargs) -> Future:
+        """
+        Queues the writing of *file_path* by *function*, which is called as ``function(path, *args, **kwargs)``
+        with the path of a temporary file, see `~.write_atomically`.
+        """
+        future = self.executor.submit(write_atomically, function, file_path, *args, **kwargs)
+        self.futures.append(future)
+        return future
+
+    def wait(self) -> int:
+        """Waits for all queued writes to complete, raising the first error if any, and returns the number of files written."""
+        with timeit(lambda spanned: logger.debug(f"Waited {spanned:.2f} seconds for output files to be written")):
+            futures, self.futures = self.futures, []
+            for future in futures:
+                future.result()
+        logger.info(f"Wrote out {len(futures)} output files to disk")
+        return len(futures)
+
+
+def write_atomically(function: Callable[..., None], file_path: Path, *args, **kwargs) -> None:
+    """
+    Calls ``function(path, *args, **kwargs)`` with the path of a temporary file in the same directory as
+    *file_path*, then renames the temporary file to *file_path*. The temporary file is removed on failure.
+
+    Args:
+        function (Callable): the function writing a file at the path it is given as first argument,
+            for instance `tfs.write` or `~.write_knob_powering`.
+        file_path (Path): `~pathlib.Path` to the final file.
+        *args: positional arguments passed to *function* after the path.
+        **kwargs: keyword arguments passed to *function*.
+    """
+    file_path = Path(file_path)
+    # Unique per process and thread, and created by the function itself so it gets the usual permissions
+    tmpname = file_path.with_name(f".tmp_{os.getpid()}_{threading.get_ident()}_{file_path.name}")
+    try:
+        function(tmpname, *args, **kwargs)
+        os.replace(tmpname, file_path)
+    except BaseException:
+        tmpname.unlink(missing_ok=True)
+        raise
+    logger.trace(f"Wrote '{file_path.absolute()}'")
+
+
 def write_knob_powering(file_path: Path, knob_dict: Dict[str, float]) -> None:
     """
     Write the absolute powering values of the given knob `~dict` to the given file.
     """
     logger.trace(f"Writing knob powering to '{file_path.absolute()}'.")
-    with file_path.open("w") as knob_file:
-        for knob, value in knob_dict.items():
-            knob_file.write(f"{knob:<10} = {value:>22};\n")
+    file_path.write_text(format_knobs(knob_dict))
 
 
 def write_knob_delta(file_path: Path, nominal_knobs: Dict[str, float], matched_knobs: Dict[str, float]) -> None:
@@ -255,10 +601,7 @@ def write_knob_delta(file_path: Path, nominal_knobs: Dict[str, float], matched_k
     """
     deltas_dict = powering_delta(nominal_knobs, matched_knobs)
     logger.trace(f"Writing knob deltas to '{file_path.absolute()}'.")
-    with file_path.open("w") as delta_file:
-        for knob, delta in deltas_dict.items():
-            operation: str = "-" if delta < 0 else "+"
-            delta_file.write(f"{knob:<10} = {knob:>10}  {operation}  {abs(delta):>22};\n")
+    file_path.write_text(format_knob_deltas(deltas_dict))
 
 
 def write_knob_changeparameters(
@@ -283,9 +626,153 @@ def write_knob_changeparameters(
     tfs.write(file_path, changeparameters)
 
 
+def write_beam_outputs(
+    dirs: Dict[str, Path],
+    beam: int,
+    nominal: "BeamConfig",
+    bare_waist: "BeamConfig",
+    matched_waist: "BeamConfig",
+    nominal_fields: tfs.TfsDataFrame,
+    matched_fields: tfs.TfsDataFrame,
+    writer: Optional[OutputsWriter] = None,
+) -> None:
+    """
+    Writes all the ``TFS`` files and knob files for the given *beam* to the output directories.
+    If a *writer* is provided the files are only queued for writing in the background, otherwise
+    they are written concurrently and this function returns once they all are.
+
+    Args:
+        dirs (Dict[str, Path]): the output directories for this *beam*, as returned by
+            `~.prepare_output_directories`.
+        beam (int): the beam number, used in the file names.
+        nominal (BeamConfig): the nominal configuration.
+        bare_waist (BeamConfig): the bare waist shift configuration.
+        matched_waist (BeamConfig): the improved (matched) waist shift configuration.
+        nominal_fields (tfs.TfsDataFrame): the affected magnets powering in the nominal configuration.
+        matched_fields (tfs.TfsDataFrame): the affected magnets powering in the matched configuration.
+        writer (OutputsWriter): if provided, the `~.OutputsWriter` to queue the writes to. The caller is
+            then responsible for waiting on them.
+    """
+    with nullcontext(writer) if writer is not None else OutputsWriter() as writer:
+        monitors = get_monitors_mask(nominal.twiss_tfs)  # same elements in all configurations of this beam
+        for config_name, config in (("nominal", nominal), ("bare_waist", bare_waist), ("matched_waist", matched_waist)):
+            full, monitors_only = get_export_views(config.twiss_tfs, monitors)
+            writer.submit(tfs.write, dirs["tfs"] / f"{config_name}_b{beam:d}.tfs", full)
+            writer.submit(tfs.write, dirs["tfs"] / f"{config_name}_b{beam:d}_monitors.tfs", monitors_only)
+        writer.submit(tfs.write, dirs["tfs"] / f"nominal_b{beam:d}_fields.tfs", nominal_fields)
+        writer.submit(tfs.write, dirs["tfs"] / f"matched_waist_b{beam:d}_fields.tfs", matched_fields)
+
+        knobs = (
+            ("triplets", "Triplets", nominal.triplets_knobs, matched_waist.triplets_knobs),
+            ("quadrupoles", "Independent quadrupoles", nominal.quads_knobs, matched_waist.quads_knobs),
+            ("working_point", "Working point", nominal.working_point_knobs, matched_waist.working_point_knobs),
+        )
+        for file_name, knob_name, nominal_knobs, matched_knobs in knobs:
+            writer.submit(write_knob_powering, dirs["knobs"] / f"{file_name}.madx", matched_knobs)
+            writer.submit(write_knob_delta, dirs["knobs"] / f"{file_name}_change.madx", nominal_knobs, matched_knobs)
+            writer.submit(
+                write_knob_changeparameters,
+                dirs["knobs"] / f"{file_name}_changeparameters.tfs",
+                nominal_knobs=nominal_knobs,
+                matched_knobs=matched_knobs,
+                knob_name=knob_name,
+            )
+        logger.debug(f"Queued the writing of B{beam:d} output files")
+
+
+def write_infeasibility_record(file_path: Path, reasons: Dict[int, str], **metadata) -> None:
+    """
+    Writes why the waist shift was deemed infeasible for each beam in a ``JSON`` file, in place of the
+    outputs of a run which was not carried out.
+
+    Args:
+        file_path (Path): `~pathlib.Path` to the file to write, typically ``infeasible.json`` in the
+            output directory of the run.
+        reasons (Dict[int, str]): the reason the waist shift was deemed infeasible, for each beam.
+        **metadata: any keyword argument is written in the file too, to identify the run.
+    """
+    logger.debug(f"Writing infeasibility record to '{file_path}'")
+    record = {**metadata, "reasons": {f"beam{beam:d}": reason for beam, reason in reasons.items()}}
+    file_path.write_text(json.dumps(record, indent=2, default=str))
+
+
+def get_ip_directory(directory: Path, ip: int, ips: Sequence[int]) -> Path:
+    """
+    Returns the directory of the outputs for *ip* of a run for all the given *ips*. For a single IP this
+    is *directory* itself, and otherwise its ``IP[n]`` sub-directory, so that each IP has the layout of a
+    single IP run.
+
+    Args:
+        directory (Path): the path to the main output directory of the run.
+        ip (int): the IP to get the directory of.
+        ips (Sequence[int]): all the IPs of the run.
+
+    Returns:
+        The `~pathlib.Path` to the outputs directory of *ip*.
+    """
+    return directory if len(ips) == 1 else directory / f"IP{ip:d}"
+
+
 # ----- I/O Utilities ----- #
 
 
+class MatchingCallsCounter:
+    """
+    Callable to give as *stdout* to a `~cpymad.madx.Madx` instance. It writes the ``MAD-X`` output
+    to the provided *file* and keeps count of the function calls reported by the matching routines
+    (``call: N`` lines), in its *calls* attribute.
+
+    Args:
+        file (IO): the opened file object to write the ``MAD-X`` output to.
+    """
+
+    OUTPUT_LINES = re.compile(rb"^\s*(?:(START MATCHING)|call:\s+(\d+))", re.MULTILINE)
+
+    def __init__(self, file: IO):
+        self._file = file
+        self._completed = 0  # total calls of the matchings that are done
+        self._current = 0  # latest call number reported by the ongoing matching
+
+    @property
+    def calls(self) -> int:
+        """The total number of matching function calls reported so far."""
+        return self._completed + self._current
+
+    def __call__(self, output: bytes) -> None:
+        self._file.write(output.decode(errors="replace"))
+        self._file.flush()
+        for line in self.OUTPUT_LINES.finditer(output):
+            if line.group(1):  # a new matching has started
+                self._completed += self._current
+                self._current = 0
+            else:
+                self._current = int(line.group(2))
+
+
+class CommandsCounter:
+    """
+    Callable to give as *command_log* to a `~cpymad.madx.Madx` instance. It writes the ``MAD-X``
+    commands to the provided *file* and keeps count of the commands issued, and of the ``TWISS``
+    commands among them, in its *commands* and *twiss* attributes.
+
+    Args:
+        file (IO): the opened file object to write the ``MAD-X`` commands to.
+    """
+
+    TWISS_COMMANDS = re.compile(r"(?:^|;)\s*twiss\b", re.IGNORECASE)
+
+    def __init__(self, file: IO):
+        self._file = file
+        self.commands = 0
+        self.twiss = 0
+
+    def __call__(self, command: str) -> None:
+        self._file.write(command + "\n")
+        self._file.flush()
+        self.commands += sum(1 for statement in command.split(";") if statement.strip())  # batches hold several
+        self.twiss += len(self.TWISS_COMMANDS.findall(command))
+
+
 def fullpath(filepath: Path) -> str:
     """
     Returns the full string path to the provided *filepath*, which is necessary for ``AFS`` paths.
@@ -304,30 +791,90 @@ def load_knobs_file(filepath: Path) -> Dict[str, float]:
         A `~dict` of knob names and their values, in absolute powering.
     """
     logger.debug(f"Loading knob values from '{filepath.absolute()}'.")
-    knob_dict = {}
-    for line in filepath.read_text().splitlines():
-        knob_name = shlex.split(line)[0]
-        knob_value = float(shlex.split(line)[-1][:-1])  # last element is value, and we ignore the ;
-        knob_dict[knob_name] = knob_value
-    return knob_dict
+    return parse_knobs(filepath.read_text())
 
 
 def load_knobs_change_file(filepath: Path) -> Dict[str, float]:
     """
-    Loads the knob values from the file they are written in by `~.write_knob_powering`.
+    Loads the knob changes from the file they are written in by `~.write_knob_delta`.
 
     Args:
-        filepath (Path): `~pathlib.Path` object to the file with the saved knob values.
+        filepath (Path): `~pathlib.Path` object to the file with the saved knob changes.
 
     Returns:
-        A `~dict` of knob names and their values, in absolute powering.
+        A `~dict` of knob names and their changes.
     """
-    logger.debug(f"Loading knob values from '{filepath.absolute()}'.")
-    knob_dict = {}
-    for line in filepath.read_text().splitlines():
-        knob_name = shlex.split(line)[0]
-        sign, delta = shlex.split(line)[-2:]
-        delta = delta.replace(";", "")  # we ignore the ; at the end of the line
-        knob_value = float(sign + delta)  # last element is value, and we ignore the ;
-        knob_dict[knob_name] = knob_value
-    return knob_dict
+    logger.debug(f"Loading knob changes from '{filepath.absolute()}'.")
+    return parse_knob_deltas(filepath.read_text())
+
+
+def load_knobs_files(filepaths: Sequence[Path], deltas: bool = False) -> Dict[Path, Dict[str, float]]:
+    """
+    Loads many knob files at once, reading them concurrently to not pay the latency of each file
+    opening sequentially on network filesystems.
+
+    Args:
+        filepaths (Sequence[Path]): `~pathlib.Path` objects to the knob files.
+        deltas (bool): if `True`, the files are knob changes files as written by `~.write_knob_delta`,
+            otherwise knob powering files as written by `~.write_knob_powering`. Defaults to `False`.
+
+    Returns:
+        A `~dict` with as keys the provided paths and as values their loaded knobs.
+    """
+    loader = load_knobs_change_file if deltas else load_knobs_file
+    with ThreadPoolExecutor(thread_name_prefix="pyrws-reader") as executor:
+        return dict(zip(filepaths, executor.map(loader, filepaths)))
+
+
+def format_knobs(knob_dict: Dict[str, float]) -> str:
+    """Formats the knob values as ``name = value;`` lines, the format read by `~.parse_knobs`."""
+    return "".join(f"{knob:<10} = {value:>22};\n" for knob, value in knob_dict.items())
+
+
+def format_knob_deltas(deltas_dict: Dict[str, float]) -> str:
+    """Formats the knob changes as ``name = name +/- delta;`` lines, the format read by `~.parse_knob_deltas`."""
+    return "".join(
+        f"{knob:<10} = {knob:>10}  {'-' if delta < 0 else '+'}  {abs(delta):>22};\n" for knob, delta in deltas_dict.items()
+    )
+
+
+# Lines of the knob files, as written by format_knobs and format_knob_deltas
+_KNOB_LINE = re.compile(r"^[ \t]*([\w.]+)[ \t]*=[ \t]*(\S+?)[ \t]*;[ \t]*$", re.MULTILINE)
+_KNOB_DELTA_LINE = re.compile(r"^[ \t]*([\w.]+)[ \t]*=[ \t]*\1[ \t]*([+-])[ \t]*(\S+?)[ \t]*;[ \t]*$", re.MULTILINE)
+
+
+def parse_knobs(text: str) -> Dict[str, float]:
+    """
+    Parses knob values from *text* in the format of `~.format_knobs`.
+
+    Args:
+        text (str): the contents of a knob powering file.
+
+    Returns:
+        A `~dict` of knob names and their values.
+    """
+    matches = _KNOB_LINE.findall(text)
+    _check_all_lines_parsed(text, len(matches))
+    return {knob: float(value) for knob, value in matches}
+
+
+def parse_knob_deltas(text: str) -> Dict[str, float]:
+    """
+    Parses knob changes from *text* in the format of `~.format_knob_deltas`.
+
+    Args:
+        text (str): the contents of a knob changes file.
+
+    Returns:
+        A `~dict` of knob names and their changes.
+    """
+    matches = _KNOB_DELTA_LINE.findall(text)
+    _check_all_lines_parsed(text, len(matches))
+    return {knob: float(sign + delta) for knob, sign, delta in matches}
+
+
+def _check_all_lines_parsed(text: str, parsed: int) -> None:
+    """Raises if *text* has more non-empty lines than the number of *parsed* ones, to not silently drop knobs."""
+    lines = [line for line in text.splitlines() if line.strip()]
+    if len(lines) != parsed:
+        raise ValueError(f"Could only parse {parsed} of the {len(lines)} lines as knobs, is the file in the expected format?")